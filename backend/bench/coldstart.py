@@ -0,0 +1,143 @@
+"""冷启动基准：测量 main 的导入耗时，以及新进程从启动到 /api/health、首个 /api/chat_stream 的首字节时间。
+
+Serverless 每次冷启动都要重新导入和初始化，这里用新的子进程模拟。
+
+用法（在 backend 目录下）:
+    python bench/coldstart.py --runs 3
+    python bench/coldstart.py --runs 3 --preload 0    # 关闭启动后的后台预加载
+"""
+import os
+import re
+import sys
+import json
+import time
+import socket
+import argparse
+import statistics
+import subprocess
+import http.client
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+CHAT_REQUEST = {
+    "user_input": "请开始情境导入阶段的教学内容",
+    "stage": "scenario",
+    "current_task": "公园购票",
+    "context": "",
+    "student_id": "BENCH_COLDSTART",
+}
+
+
+def measure_import(env: dict) -> tuple:
+    """返回 (import main 总耗时秒, {main 直接导入的模块: 累计耗时秒})"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=SRC_DIR, env=env, capture_output=True, text=True,
+    )
+    total, children = 0.0, {}
+    for line in proc.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if not match:
+            continue
+        cumulative, indent, name = int(match.group(2)) / 1e6, len(match.group(3)), match.group(4)
+        if name == "main" and indent == 1:
+            total = cumulative
+        elif indent == 3:
+            children[name] = cumulative
+    return total, children
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _get(port: int, path: str, timeout: float = 1.0) -> int:
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+
+def _first_byte(port: int, path: str, body: dict, timeout: float) -> float:
+    started = time.perf_counter()
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    try:
+        conn.request("POST", path, json.dumps(body), {"Content-Type": "application/json"})
+        response = conn.getresponse()
+        response.read(1)
+        return time.perf_counter() - started
+    finally:
+        conn.close()
+
+
+def measure_server(env: dict, chat: bool, timeout: float) -> dict:
+    """启动一个新的 uvicorn 进程，记录各个请求的首字节时间（秒）"""
+    port = _free_port()
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=SRC_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    result = {}
+    try:
+        while True:
+            if proc.poll() is not None:
+                raise RuntimeError("uvicorn exited during startup")
+            if time.perf_counter() - started > timeout:
+                raise RuntimeError("timed out waiting for /api/health")
+            try:
+                if _get(port, "/api/health") == 200:
+                    break
+            except OSError:
+                time.sleep(0.01)
+        result["health_after_spawn"] = time.perf_counter() - started
+        request_started = time.perf_counter()
+        _get(port, "/api/health")
+        result["health_warm"] = time.perf_counter() - request_started
+        if chat:
+            result["chat_stream_first"] = _first_byte(port, "/api/chat_stream", CHAT_REQUEST, timeout)
+            result["chat_stream_second"] = _first_byte(port, "/api/chat_stream", CHAT_REQUEST, timeout)
+    finally:
+        proc.terminate()
+        proc.wait()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="冷启动耗时基准")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--preload", choices=["0", "1"], default=None, help="覆盖 PRELOAD_ENGINE")
+    parser.add_argument("--no-chat", action="store_true", help="不测 /api/chat_stream（需要模型与数据库）")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--top", type=int, default=8, help="列出 main 直接导入的最慢模块数")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    if args.preload is not None:
+        env["PRELOAD_ENGINE"] = args.preload
+
+    imports = [measure_import(env) for _ in range(args.runs)]
+    totals = [total for total, _ in imports]
+    print(f"import main: median {statistics.median(totals) * 1000:.0f}ms "
+          f"(min {min(totals) * 1000:.0f}ms, {args.runs} runs)")
+    slowest = sorted(imports[-1][1].items(), key=lambda item: -item[1])[:args.top]
+    for name, seconds in slowest:
+        print(f"  {name:<32}{seconds * 1000:>8.0f}ms")
+
+    runs = [measure_server(env, not args.no_chat, args.timeout) for _ in range(args.runs)]
+    print(f"{'metric':<24}{'median':>10}{'min':>10}{'max':>10}")
+    for metric in runs[0]:
+        values = [run[metric] * 1000 for run in runs]
+        print(f"{metric:<24}{statistics.median(values):>8.0f}ms{min(values):>8.0f}ms{max(values):>8.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""日志存储基准：比较正文直接存表与去重/压缩存储的表大小和单条写入耗时（需要 Postgres）。
+
+在 DATABASE_URL 所在的服务器上新建一个独立的基准库（默认 mcast_bench_storage），不影响业务数据。
+
+用法（在 backend 目录下）:
+    DATABASE_URL=postgresql://... python bench/log_storage_size.py --turns 5000
+"""
+import io
+import os
+import sys
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import statistics
+import contextlib
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+
+import database
+import log_storage
+
+MERMAID = [
+    "```mermaid\ngraph TD\n    A[开始] --> B{身高 > 120?}\n    B -- 是 --> C[全价票 10 元]\n"
+    "    B -- 否 --> D[半价票 5 元]\n    C --> E[结束]\n    D --> E\n```\n",
+    "```mermaid\ngraph LR\n    输入 --> 处理 --> 输出\n    处理 --> 判断{条件成立?}\n"
+    "    判断 -- 是 --> 分支一\n    判断 -- 否 --> 分支二\n```\n",
+]
+QUIZ = [
+    f"第 {i} 题：下面哪段代码可以正确判断票价？\nA. if height > 120: price = 10\nB. if height >= 120 price = 10\n"
+    f"C. if (height > 120) {{ price = 10 }}\nD. height > 120 ? 10 : 5\n请选择正确的选项，并说明理由。" * 3
+    for i in range(1, 13)
+]
+PHRASES = [
+    "你观察得很仔细！", "我们再想一想，", "如果把条件换成大于等于，", "结果会有什么不同呢？",
+    "这就是选择结构的核心：", "根据条件决定执行哪一段代码。", "注意冒号和缩进哦，", "试着把你的想法写成代码。",
+]
+
+
+def agent_response(rng: random.Random) -> str:
+    """约三成是题目、概念图等重复内容，其余为带流程图的个性化回复"""
+    if rng.random() < 0.3:
+        return rng.choice(QUIZ)
+    text_ = "".join(rng.choice(PHRASES) for _ in range(rng.randint(6, 40)))
+    if rng.random() < 0.5:
+        text_ += "\n" + rng.choice(MERMAID)
+    return text_
+
+
+async def recreate_database(name: str) -> str:
+    url = make_url(database.DATABASE_URL)
+    admin = database.engine.execution_options(isolation_level="AUTOCOMMIT")
+    async with admin.connect() as conn:
+        await conn.execute(text(f'DROP DATABASE IF EXISTS "{name}"'))
+        await conn.execute(text(f'CREATE DATABASE "{name}"'))
+    return url.set(database=name).render_as_string(hide_password=False)
+
+
+async def table_sizes() -> dict:
+    async with database.engine.connect() as conn:
+        chatlog = await conn.execute(text(
+            "SELECT coalesce(sum(pg_total_relation_size(relid)), 0) FROM pg_partition_tree('chatlog')"
+        ))
+        content = await conn.execute(text("SELECT pg_total_relation_size('chatlog_content')"))
+        contents = await conn.execute(text("SELECT count(*) FROM chatlog_content"))
+        return {"chatlog": chatlog.scalar(), "content": content.scalar(), "content_rows": contents.scalar()}
+
+
+async def run_mode(store: bool, turns: int, seed: int) -> dict:
+    log_storage.LOG_CONTENT_STORE = store
+    async with database.engine.begin() as conn:
+        await conn.execute(text("TRUNCATE chatlog, chatlog_content"))
+    rng = random.Random(seed)
+    students = [(f"S{i:04d}", uuid.uuid4()) for i in range(200)]
+    latencies = []
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(turns):
+            student_id, user_id = rng.choice(students)
+            for role, content in (("user", "我觉得应该用 if 语句"), ("agent", agent_response(rng))):
+                begin = time.perf_counter()
+                async with database.AsyncSessionLocal() as session:
+                    await database.log_message(session, user_id, role, content, student_id=student_id)
+                latencies.append((time.perf_counter() - begin) * 1000)
+    elapsed = time.perf_counter() - started
+    async with database.engine.connect() as conn:
+        await conn.execute(text("ANALYZE"))
+    latencies.sort()
+    return {
+        "rows": len(latencies),
+        "p50": statistics.median(latencies),
+        "p99": latencies[int(len(latencies) * 0.99) - 1],
+        "rows_per_sec": len(latencies) / elapsed,
+        **await table_sizes(),
+    }
+
+
+async def run(args):
+    bench_url = await recreate_database(args.database)
+    await database.engine.dispose()
+    database.engine = create_async_engine(bench_url, poolclass=NullPool)
+    database.AsyncSessionLocal.configure(bind=database.engine)
+    if os.path.exists(database.SCHEMA_MARKER):
+        os.remove(database.SCHEMA_MARKER)
+    with contextlib.redirect_stdout(io.StringIO()):
+        await database.init_db()
+
+    results = [("inline", await run_mode(False, args.turns, args.seed)),
+               ("dedup + zlib", await run_mode(True, args.turns, args.seed))]
+    print(f"{args.turns} turns ({args.turns * 2} rows)")
+    print(f"{'mode':<14}{'chatlog':>10}{'content':>10}{'total':>10}{'blobs':>8}{'p50':>9}{'p99':>9}{'rows/s':>9}")
+    for name, r in results:
+        mb = lambda n: f"{n / 1048576:.2f}MB"
+        print(f"{name:<14}{mb(r['chatlog']):>10}{mb(r['content']):>10}{mb(r['chatlog'] + r['content']):>10}"
+              f"{r['content_rows']:>8}{r['p50']:>7.2f}ms{r['p99']:>7.2f}ms{r['rows_per_sec']:>9.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="日志存储大小与写入耗时基准")
+    parser.add_argument("--turns", type=int, default=5000)
+    parser.add_argument("--database", default="mcast_bench_storage")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
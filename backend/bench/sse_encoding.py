@@ -0,0 +1,95 @@
+"""SSE 编码基准：比较逐 token 发送（旧格式）与 UTF-8 合帧、压缩后的字节数和帧数。
+
+每一帧对应一次 send 系统调用，因此帧数即每次回复的写调用次数。
+
+用法（在 backend 目录下）:
+    python bench/sse_encoding.py --token-interval-ms 20
+"""
+import os
+import sys
+import json
+import random
+import asyncio
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import sse
+
+SAMPLE_RESPONSE = (
+    "太棒了！你已经发现了售票员的判断标准：身高是否超过 120 厘米。"
+    "现在我们来想一想，如果用 Python 来表达这个判断，应该怎么写呢？"
+    "提示：我们可以用 if 语句来判断条件，条件成立时执行一段代码，不成立时执行 else 后面的代码。"
+    "注意冒号和缩进哦！比如：\n```python\nif height > 120:\n    price = 10\nelse:\n    price = 5\n```\n"
+    "你觉得刚好 120 厘米的小朋友应该买哪种票呢？请说说你的想法。"
+)
+
+
+def tokenize(text: str, seed: int = 0):
+    """模拟模型输出：中文通常每个 chunk 只有 1~3 个字符"""
+    rng = random.Random(seed)
+    tokens, i = [], 0
+    while i < len(text):
+        n = rng.randint(1, 3)
+        tokens.append(text[i:i + n])
+        i += n
+    return tokens
+
+
+async def token_events(tokens, interval_ms: float):
+    for token in tokens:
+        await asyncio.sleep(interval_ms / 1000)
+        yield {"type": "token", "content": token}
+    yield {"type": "final", "active_agent_response": "".join(tokens), "stage": "scenario", "suggestions": []}
+
+
+def legacy_frames(tokens):
+    """改造前的格式：json.dumps 默认 ASCII 转义，每个 token 一帧"""
+    for token in tokens:
+        yield f"data: {json.dumps({'type': 'token', 'content': token})}\n\n".encode("utf-8")
+    final = {"type": "final", "active_agent_response": "".join(tokens), "stage": "scenario", "suggestions": []}
+    yield f"data: {json.dumps(final)}\n\n".encode("utf-8")
+    yield sse.DONE_FRAME.encode("utf-8")
+
+
+async def measure(name, tokens, interval_ms, window_ms, encoding):
+    frames = []
+    async for frame in sse.encode_stream(token_events(tokens, interval_ms), encoding, window_ms):
+        frames.append(frame)
+    return name, len(frames), sum(len(f) for f in frames)
+
+
+async def run(args):
+    tokens = tokenize(SAMPLE_RESPONSE * args.repeat)
+    legacy = list(legacy_frames(tokens))
+    results = [("legacy (ascii, per token)", len(legacy), sum(len(f) for f in legacy))]
+
+    configs = [
+        ("utf-8, per token", 0, None),
+        (f"utf-8, {args.window_ms:g}ms window", args.window_ms, None),
+        (f"utf-8, {args.window_ms:g}ms window, gzip", args.window_ms, "gzip"),
+    ]
+    if sse.brotli is not None:
+        configs.append((f"utf-8, {args.window_ms:g}ms window, br", args.window_ms, "br"))
+    results += await asyncio.gather(*(
+        measure(name, tokens, args.token_interval_ms, window_ms, encoding)
+        for name, window_ms, encoding in configs
+    ))
+
+    base_bytes = results[0][2]
+    print(f"{len(tokens)} tokens, {len(SAMPLE_RESPONSE) * args.repeat} chars, token interval {args.token_interval_ms:g}ms")
+    print(f"{'encoding':<36}{'frames':>8}{'bytes':>10}{'ratio':>8}")
+    for name, frames, size in results:
+        print(f"{name:<36}{frames:>8}{size:>10}{size / base_bytes:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SSE 编码字节数/帧数基准")
+    parser.add_argument("--token-interval-ms", type=float, default=20)
+    parser.add_argument("--window-ms", type=float, default=sse.SSE_COALESCE_MS)
+    parser.add_argument("--repeat", type=int, default=1, help="样例回复重复次数")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""静态文件基准：比较原来的 serve_frontend（每次请求 exists/isfile + FileResponse）与 static_files.StaticSite
+的每秒请求数和传输字节数。
+
+在临时目录中生成一个类似 Vite 构建产物的 static/（index.html 与带哈希的 assets/*.js、*.css），
+直接以 ASGI 调用两个只包含静态路由的 FastAPI 应用，不经过网络，只比较应用内的开销。
+
+用法（在 backend 目录下）:
+    python bench/static_serving.py --requests 5000
+    python bench/static_serving.py --precompress     # 先生成 .gz 文件，模拟构建后预压缩
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse
+from fastapi.staticfiles import StaticFiles
+
+from static_files import StaticSite, precompress
+
+BROWSER_HEADERS = [(b"accept-encoding", b"gzip, deflate, br")]
+
+
+def build_static(root: str) -> list:
+    """生成构建产物，返回 assets 下的文件名"""
+    rng = random.Random(0)
+    words = ["const", "function", "return", "mermaid", "render", "state", "props", "useEffect", "=>", "{", "}"]
+    os.makedirs(os.path.join(root, "assets"))
+    with open(os.path.join(root, "index.html"), "w") as fd:
+        fd.write("<!doctype html><html><head><script type=\"module\" src=\"/assets/index-3f9a1c.js\"></script>"
+                 "<link rel=\"stylesheet\" href=\"/assets/index-77b2e0.css\"></head><body><div id=\"root\"></div></body></html>")
+    assets = {"index-3f9a1c.js": 400_000, "mermaid-core-c41d2a.js": 1_200_000, "index-77b2e0.css": 60_000}
+    for name, size in assets.items():
+        text = " ".join(rng.choice(words) for _ in range(size // 6))
+        with open(os.path.join(root, "assets", name), "w") as fd:
+            fd.write(text[:size])
+    return list(assets)
+
+
+def legacy_app(static_dir: str) -> FastAPI:
+    """改动前 main.py 中的静态路由"""
+    app = FastAPI()
+    app.mount("/assets", StaticFiles(directory=os.path.join(static_dir, "assets")), name="assets")
+
+    @app.get("/")
+    async def serve_index():
+        return FileResponse(os.path.join(static_dir, "index.html"))
+
+    @app.get("/{full_path:path}")
+    async def serve_frontend(full_path: str):
+        if full_path.startswith("api"):
+            raise HTTPException(status_code=404)
+        file_path = os.path.join(static_dir, full_path)
+        if os.path.exists(file_path) and os.path.isfile(file_path):
+            return FileResponse(file_path)
+        return FileResponse(os.path.join(static_dir, "index.html"))
+
+    return app
+
+
+def site_app(static_dir: str) -> FastAPI:
+    app = FastAPI()
+    site = StaticSite(static_dir)
+
+    @app.get("/")
+    async def serve_index(request: Request):
+        return site.respond("index.html", request.headers)
+
+    @app.get("/{full_path:path}")
+    async def serve_frontend(full_path: str, request: Request):
+        if full_path.startswith("api"):
+            raise HTTPException(status_code=404)
+        return site.respond(full_path, request.headers)
+
+    return app
+
+
+async def call(app, path: str, headers: list) -> tuple:
+    """(状态码, 响应头, 响应体字节数)"""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"",
+        "root_path": "", "headers": headers, "client": ("127.0.0.1", 1), "server": ("127.0.0.1", 80),
+    }
+    result = {"status": 0, "headers": {}, "bytes": 0}
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            result["status"] = message["status"]
+            result["headers"] = {k.decode(): v.decode() for k, v in message["headers"]}
+        elif message["type"] == "http.response.body":
+            result["bytes"] += len(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return result["status"], result["headers"], result["bytes"]
+
+
+async def run(app, requests: list) -> tuple:
+    """依次发送请求，模拟浏览器缓存：带上之前收到的 ETag"""
+    etags, transferred, statuses = {}, 0, {}
+    started = time.perf_counter()
+    for path, revalidate in requests:
+        headers = list(BROWSER_HEADERS)
+        if revalidate and path in etags:
+            headers.append((b"if-none-match", etags[path].encode()))
+        status, response_headers, size = await call(app, path, headers)
+        if "etag" in response_headers:
+            etags[path] = response_headers["etag"]
+        transferred += size
+        statuses[status] = statuses.get(status, 0) + 1
+    return len(requests) / (time.perf_counter() - started), transferred, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description="静态文件服务基准")
+    parser.add_argument("--requests", type=int, default=3000)
+    parser.add_argument("--revalidate", type=float, default=0.5, help="带 If-None-Match 的请求比例")
+    parser.add_argument("--precompress", action="store_true", help="先为构建产物生成 .gz 文件")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as static_dir:
+        assets = build_static(static_dir)
+        if args.precompress:
+            precompress(static_dir)
+        rng = random.Random(1)
+        paths = ["/", "/lesson/1", "/teacher"] + [f"/assets/{name}" for name in assets]
+        requests = [(rng.choice(paths), rng.random() < args.revalidate) for _ in range(args.requests)]
+
+        apps = {"legacy": legacy_app(static_dir), "static_site": site_app(static_dir)}
+        print(f"{'app':<14}{'req/s':>10}{'MB sent':>10}  statuses")
+        for name, app in apps.items():
+            asyncio.run(run(app, requests[:50]))
+            rps, transferred, statuses = asyncio.run(run(app, requests))
+            print(f"{name:<14}{rps:>10.0f}{transferred / 1e6:>10.1f}  {dict(sorted(statuses.items()))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""多 worker 基准：以 WORKERS=1/2/4/8 分别启动 main.py，对不依赖 LLM 的接口施加并发负载，
+比较吞吐与延迟，给出 worker 数建议。
+
+负载为 /api/check_syntax、/api/flowchart 与 /api/execute 的混合；代码按序号变化，
+--repeat 控制同一段代码重复出现的比例（设置了 EXECUTE_CACHE_SECONDS 时，重复的运行请求会命中共享的执行结果缓存）。
+压测客户端运行在独立的进程中，结果会受本机 CPU 核数影响，请在与线上相同规格的机器上运行。
+
+用法（在 backend 目录下）:
+    python bench/workers.py
+    python bench/workers.py --workers 1 2 4 --duration 15 --clients 4 --threads 16
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import statistics
+import threading
+import subprocess
+import http.client
+import multiprocessing
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+CODE_TEMPLATE = """height = {height}
+if height < 120:
+    print("半价 5 元")
+else:
+    print("全价 10 元")
+"""
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _request(conn: http.client.HTTPConnection, path: str, body: dict) -> int:
+    conn.request("POST", path, json.dumps(body), {"Content-Type": "application/json"})
+    response = conn.getresponse()
+    response.read()
+    return response.status
+
+
+def _client_thread(port: int, deadline: float, repeat: float, seed: int, latencies: list, errors: list) -> None:
+    rng = random.Random(seed)
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    while time.perf_counter() < deadline:
+        height = rng.randint(100, 139) if rng.random() < repeat else rng.randint(1000, 10 ** 9)
+        code = CODE_TEMPLATE.format(height=height)
+        path = rng.choice(["/api/check_syntax", "/api/flowchart", "/api/execute"])
+        started = time.perf_counter()
+        try:
+            status = _request(conn, path, {"code": code})
+        except (OSError, http.client.HTTPException):
+            errors.append(path)
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            continue
+        latencies.append((path, time.perf_counter() - started))
+        if status != 200:
+            errors.append(path)
+    conn.close()
+
+
+def _client_process(args) -> tuple:
+    port, duration, threads, repeat, seed = args
+    deadline = time.perf_counter() + duration
+    latencies, errors = [], []
+    workers = [
+        threading.Thread(target=_client_thread, args=(port, deadline, repeat, seed * 1000 + i, latencies, errors))
+        for i in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return latencies, errors
+
+
+def _wait_healthy(proc: subprocess.Popen, port: int, timeout: float) -> None:
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if proc.poll() is not None:
+            raise RuntimeError("main.py exited during startup")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/api/health")
+            if conn.getresponse().status == 200:
+                conn.close()
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("timed out waiting for /api/health")
+
+
+def _percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+def measure(n: int, args) -> dict:
+    """启动 n 个 worker，预热后压测 args.duration 秒"""
+    port = _free_port()
+    env = dict(os.environ)
+    env.update({"WORKERS": str(n), "PORT": str(port), "PRELOAD_ENGINE": "0"})
+    # 每一轮使用新的共享状态文件，避免上一轮的执行结果缓存影响结果
+    env["SHARED_STATE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="mcast_bench_"), "shared.sqlite3")
+    env.setdefault("OPENAI_API_KEY", "bench")
+    proc = subprocess.Popen(
+        [sys.executable, "main.py"], cwd=SRC_DIR, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        _wait_healthy(proc, port, args.timeout)
+        with multiprocessing.Pool(args.clients) as pool:
+            pool.map(_client_process, [(port, args.warmup, args.threads, args.repeat, -i - 1) for i in range(args.clients)])
+            results = pool.map(_client_process, [(port, args.duration, args.threads, args.repeat, i) for i in range(args.clients)])
+    finally:
+        proc.terminate()
+        proc.wait()
+    latencies = [item for result, _ in results for item in result]
+    errors = sum(len(error) for _, error in results)
+    seconds = [latency for _, latency in latencies]
+    per_path = {}
+    for path in sorted({path for path, _ in latencies}):
+        values = [latency for p, latency in latencies if p == path]
+        per_path[path] = _percentile(values, 0.95)
+    return {
+        "workers": n,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / args.duration,
+        "p50": statistics.median(seconds) if seconds else 0.0,
+        "p95": _percentile(seconds, 0.95) if seconds else 0.0,
+        "p95_by_path": per_path,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多 worker 吞吐基准")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--warmup", type=float, default=2)
+    parser.add_argument("--clients", type=int, default=2, help="压测客户端进程数")
+    parser.add_argument("--threads", type=int, default=8, help="每个客户端进程的并发连接数")
+    parser.add_argument("--repeat", type=float, default=0.5, help="重复出现的代码所占比例")
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    print(f"CPU cores: {os.cpu_count()}, {args.clients}x{args.threads} connections, {args.duration:.0f}s per run")
+    runs = [measure(n, args) for n in args.workers]
+    print(f"{'workers':<10}{'req/s':>10}{'p50':>10}{'p95':>10}{'errors':>8}")
+    for run in runs:
+        print(f"{run['workers']:<10}{run['rps']:>10.1f}{run['p50'] * 1000:>8.1f}ms{run['p95'] * 1000:>8.1f}ms{run['errors']:>8}")
+        for path, p95 in run["p95_by_path"].items():
+            print(f"  {path:<22}p95 {p95 * 1000:>8.1f}ms")
+    best = max(run["rps"] for run in runs)
+    # 达到最高吞吐 90% 的最少 worker 数：再加 worker 只会多占内存与 LLM 连接
+    recommended = min(run["workers"] for run in runs if run["rps"] >= 0.9 * best)
+    print(f"Recommended WORKERS={recommended} (smallest count within 90% of the best {best:.1f} req/s)")
+
+
+if __name__ == "__main__":
+    main()
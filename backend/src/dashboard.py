@@ -0,0 +1,234 @@
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set
+
+import metrics
+from sse import encode_event
+from token_ledger import DEFAULT_LESSON
+from shared_state import SHARED_STATE_ENABLED, shared_state
+
+# 教师看板推送增量的间隔（秒）：期间的所有变化合并成一帧
+DASHBOARD_TICK_SECONDS = float(os.getenv("DASHBOARD_TICK_SECONDS", "2"))
+# 最近多少秒内有过对话的学生算作在线
+DASHBOARD_ACTIVE_SECONDS = float(os.getenv("DASHBOARD_ACTIVE_SECONDS", "300"))
+# 每个看板连接最多积压的帧数；客户端读得太慢时丢弃积压，改发一份完整快照
+DASHBOARD_QUEUE_SIZE = int(os.getenv("DASHBOARD_QUEUE_SIZE", "30"))
+# 没有变化时发送 SSE 注释保活的间隔（秒）
+DASHBOARD_KEEPALIVE_SECONDS = 15.0
+
+# 各学习阶段对应的子阶段字段（knowledge 阶段没有子阶段）
+SUB_STAGE_FIELDS = {
+    "scenario": "agent_a_sub_stage",
+    "logic": "agent_c_sub_stage",
+    "coding": "agent_c_sub_stage",
+    "assessment": "agent_d_reflection_sub_stage",
+    "transfer": "agent_e_sub_stage",
+}
+
+
+def _contributions(student: dict) -> List[str]:
+    """一个学生计入的聚合项：阶段/子阶段人数、各维度评分分布、测验进度、分组人数"""
+    keys = [f"group:{student['group']}", f"stage:{student['stage']}"]
+    if student.get("sub_stage"):
+        keys.append(f"stage:{student['stage']}/{student['sub_stage']}")
+    for dimension, score in (student.get("scores") or {}).items():
+        keys.append(f"score:{dimension}:{score}")
+    if student["stage"] == "transfer" and student.get("quiz_index") is not None:
+        keys.append(f"quiz:{student['quiz_index']}")
+    return keys
+
+
+class LessonBoard:
+    """一节课的看板：学生最新状态与按其增量维护的计数，变化先记为脏项，每个 tick 合并成一帧增量"""
+
+    def __init__(self, lesson: str):
+        self.lesson = lesson
+        self.students: Dict[str, dict] = {}
+        self.counts: Counter = Counter()
+        # 学生 -> 最后活动时间，按时间先后排列，过期的从头部移出
+        self.recent: "OrderedDict[str, float]" = OrderedDict()
+        self.version = 0
+        # 多 worker 时已从共享状态读到的位置
+        self.seq = 0
+        self.subscribers: Set[asyncio.Queue] = set()
+        self._dirty_counts: Set[str] = set()
+        self._dirty_students: Set[str] = set()
+
+    def record(self, student_id: str, student: dict) -> None:
+        previous = self.students.get(student_id)
+        if previous is not None and not student.get("scores"):
+            # 评分只在 assessment 阶段产生，之后的轮次沿用最近一次的评分
+            student["scores"] = previous.get("scores")
+        change = Counter(_contributions(student))
+        change.subtract(_contributions(previous) if previous else [])
+        for key, delta in change.items():
+            if delta:
+                self.counts[key] += delta
+                if self.counts[key] <= 0:
+                    del self.counts[key]
+                self._dirty_counts.add(key)
+        self.students[student_id] = student
+        self._dirty_students.add(student_id)
+        self.recent[student_id] = student["last_active"]
+        self.recent.move_to_end(student_id)
+        self._dirty_counts.update(("students", "active"))
+
+    async def pull(self) -> None:
+        """多 worker 时各进程把学生状态写入共享状态，这里按 seq 读取其后的变化（SQLite 查询在线程池中执行）"""
+        rows = await asyncio.to_thread(shared_state.students_since, self.lesson, self.seq)
+        for student_id, student, seq in rows:
+            # 同时进行的另一次 pull 可能已经合并过这些行
+            if seq <= self.seq:
+                continue
+            self.record(student_id, student)
+            self.seq = seq
+
+    def _expire(self, now: float) -> None:
+        cutoff = now - DASHBOARD_ACTIVE_SECONDS
+        while self.recent and next(iter(self.recent.values())) < cutoff:
+            self.recent.popitem(last=False)
+            self._dirty_counts.add("active")
+
+    def _aggregate(self, key: str) -> int:
+        if key == "students":
+            return len(self.students)
+        if key == "active":
+            return len(self.recent)
+        return self.counts.get(key, 0)
+
+    def snapshot(self) -> bytes:
+        self._expire(time.time())
+        aggregates = dict(self.counts)
+        aggregates["students"] = len(self.students)
+        aggregates["active"] = len(self.recent)
+        event = {
+            "type": "snapshot",
+            "lesson": self.lesson,
+            "version": self.version,
+            "aggregates": aggregates,
+            "students": self.students,
+        }
+        return encode_event(event).encode("utf-8")
+
+    def clear_dirty(self) -> None:
+        self._dirty_counts.clear()
+        self._dirty_students.clear()
+
+    def delta(self) -> Optional[bytes]:
+        """自上一帧以来变化的聚合项（值为 0 表示该项已不存在）与学生；没有变化时返回 None"""
+        self._expire(time.time())
+        if not self._dirty_counts and not self._dirty_students:
+            return None
+        self.version += 1
+        event = {
+            "type": "delta",
+            "version": self.version,
+            "aggregates": {key: self._aggregate(key) for key in self._dirty_counts},
+            "students": {student_id: self.students[student_id] for student_id in self._dirty_students},
+        }
+        self.clear_dirty()
+        return encode_event(event).encode("utf-8")
+
+
+def _put_shared(lesson: str, student_id: str, student: dict) -> None:
+    try:
+        if not student["scores"]:
+            previous = shared_state.get_student(lesson, student_id)
+            student["scores"] = previous and previous.get("scores")
+        shared_state.put_student(lesson, student_id, student)
+    except Exception as e:
+        print(f"WARNING: Failed to write dashboard state for {student_id}: {e}")
+
+
+class Dashboard:
+    """各节课的看板；每个 tick 每节课只编码一次增量帧，再分发给所有订阅者"""
+
+    def __init__(self):
+        self.boards: Dict[str, LessonBoard] = {}
+        self._ticker: Optional[asyncio.Task] = None
+        # 多 worker 时写共享状态的单个后台线程：不阻塞事件循环，同一学生的多次写入保持先后顺序
+        self._writer: Optional[ThreadPoolExecutor] = None
+
+    def board(self, lesson: Optional[str]) -> LessonBoard:
+        lesson = lesson or DEFAULT_LESSON
+        if lesson not in self.boards:
+            self.boards[lesson] = LessonBoard(lesson)
+        return self.boards[lesson]
+
+    def record(self, student_id: Optional[str], group: Optional[str], lesson: Optional[str], state: dict) -> None:
+        """一轮对话结束后更新该学生的状态（在事件循环线程中调用）"""
+        if not student_id:
+            return
+        stage = state.get("stage") or "unknown"
+        field = SUB_STAGE_FIELDS.get(stage)
+        student = {
+            "group": group or "experimental",
+            "stage": stage,
+            "sub_stage": state.get(field) if field else None,
+            "scores": state.get("agent_d_evaluation_scores") or None,
+            "quiz_index": state.get("agent_e_quiz_index"),
+            "last_active": round(time.time(), 1),
+        }
+        if not SHARED_STATE_ENABLED:
+            self.board(lesson).record(student_id, student)
+            return
+        if self._writer is None:
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dashboard-writer")
+        self._writer.submit(_put_shared, lesson or DEFAULT_LESSON, student_id, student)
+
+    def _publish(self, board: LessonBoard, frame: bytes) -> None:
+        for queue in board.subscribers:
+            try:
+                queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                # 积压的增量已无意义，换成一份完整快照
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(board.snapshot())
+                metrics.incr("dashboard_resyncs")
+
+    async def _tick(self) -> None:
+        while any(board.subscribers for board in self.boards.values()):
+            await asyncio.sleep(DASHBOARD_TICK_SECONDS)
+            for board in list(self.boards.values()):
+                if not board.subscribers:
+                    continue
+                if SHARED_STATE_ENABLED:
+                    await board.pull()
+                frame = board.delta()
+                if frame is not None:
+                    self._publish(board, frame)
+                    metrics.incr("dashboard_deltas")
+        self._ticker = None
+
+    async def stream(self, lesson: Optional[str], is_disconnected: Callable[[], Awaitable[bool]]) -> AsyncIterator[bytes]:
+        """先发送完整快照，之后每个 tick 发送一帧增量"""
+        board = self.board(lesson)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=DASHBOARD_QUEUE_SIZE)
+        if SHARED_STATE_ENABLED:
+            await board.pull()
+        if not board.subscribers:
+            # 没有订阅者期间的变化已包含在快照中
+            board.clear_dirty()
+        board.subscribers.add(queue)
+        if self._ticker is None:
+            self._ticker = asyncio.create_task(self._tick())
+        metrics.incr("dashboard_subscribers_total")
+        try:
+            yield board.snapshot()
+            while True:
+                try:
+                    frame = await asyncio.wait_for(queue.get(), DASHBOARD_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if await is_disconnected():
+                        break
+                    frame = b": keepalive\n\n"
+                yield frame
+        finally:
+            board.subscribers.discard(queue)
+
+
+dashboard = Dashboard()
@@ -1,11 +1,15 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy import Column, Integer, String, DateTime, Text, text
+from sqlalchemy import Column, Integer, String, DateTime, Text, LargeBinary, JSON, Index, text, inspect
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.pool import NullPool
+from sqlalchemy.exc import ProgrammingError
 import datetime
 import uuid
 import os
+import asyncio
+import hashlib
+import tempfile
 import traceback
 from dotenv import load_dotenv
 
@@ -72,9 +76,21 @@ class ChatLog(Base):
     user_id = Column(UUID(as_uuid=True), default=uuid.uuid4)
     student_id = Column(String, nullable=True)  # Added student_id
     role = Column(String)  # 'user' or 'agent'
-    content = Column(Text)
+    content = Column(Text)  # 较长的内容存放在 chatlog_content 中，此时为空
+    content_hash = Column(String(64), nullable=True)
     group_type = Column(String, default="experimental")
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    # 回放所需的结构化信息：学生消息记录请求的阶段与子阶段字段，智能体回复记录各次 LLM 调用的原始输出与耗时
+    meta = Column(JSON, nullable=True)
+
+    # 研究人员按学生 / 实验分组 + 时间范围导出对话，分页键为 (created_at, id)
+    # Postgres 上可由运维改为按 created_at 月分区的分区表（log_storage.py --partition），之后主键为 (id, created_at)
+    __table_args__ = (
+        Index("ix_chatlog_student_created", "student_id", "created_at"),
+        Index("ix_chatlog_group_created", "group_type", "created_at"),
+        Index("ix_chatlog_created_id", "created_at", "id"),
+        Index("ix_chatlog_content_hash", "content_hash"),
+    )
 
 class ControlChatLog(Base):
     __tablename__ = "control_chat_logs"
@@ -87,26 +103,149 @@ class ControlChatLog(Base):
     group_type = Column(String, default="control")
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
 
-async def init_db():
+class ChatLogContent(Base):
+    """按 sha256 去重的日志正文（同一条智能体回复只存一份，可压缩）"""
+    __tablename__ = "chatlog_content"
+
+    content_hash = Column(String(64), primary_key=True)
+    encoding = Column(String(8), nullable=False, default="raw")  # 'raw' 或 'zlib'
+    data = Column(LargeBinary, nullable=False)
+    size = Column(Integer, nullable=False)  # 原文 UTF-8 字节数
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class TokenUsage(Base):
+    """token 用量流水：进程内按 (学生, 分组, 课) 累计，定期把增量写成一行（见 token_ledger）"""
+    __tablename__ = "token_usage"
+
+    id = Column(Integer, primary_key=True)
+    student_id = Column(String, nullable=True)
+    group_type = Column(String, nullable=True)
+    lesson = Column(String, nullable=True)
+    prompt_tokens = Column(Integer, nullable=False, default=0)
+    cached_tokens = Column(Integer, nullable=False, default=0)
+    completion_tokens = Column(Integer, nullable=False, default=0)
+    calls = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_token_usage_lesson_group_student", "lesson", "group_type", "student_id"),
+    )
+
+class SchemaVersion(Base):
+    """记录当前表结构版本，版本一致时启动跳过 create_all"""
+    __tablename__ = "mcast_schema_version"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+# 表结构版本：修改模型（新增表/列/索引）时加 1，并在 MIGRATIONS 中登记对已有表的变更
+SCHEMA_VERSION = 5
+# 同一实例再次冷启动时（/tmp 仍保留）连版本查询也省掉；按月区分，每月至少检查一次分区；
+# 文件名带上数据库地址的哈希，换库后会重新建表/迁移
+SCHEMA_MARKER = os.path.join(
+    tempfile.gettempdir(),
+    f"mcast_schema_v{SCHEMA_VERSION}_{hashlib.sha256(DATABASE_URL.encode('utf-8')).hexdigest()[:12]}"
+    f"_{datetime.datetime.utcnow():%Y%m}",
+)
+
+def _current_schema_version(sync_conn):
+    if not inspect(sync_conn).has_table(SchemaVersion.__tablename__):
+        return None
+    return sync_conn.execute(text(f"SELECT max(version) FROM {SchemaVersion.__tablename__}")).scalar()
+
+def _migrate_v2(sync_conn):
+    """chatlog 复合索引（create_all 不会给已存在的表补索引）。
+
+    数据量很大的库建议先手动 CREATE INDEX CONCURRENTLY，避免建索引期间阻塞写入。
+    """
+    for index in ChatLog.__table__.indexes:
+        index.create(sync_conn, checkfirst=True)
+
+def _migrate_v3(sync_conn):
+    """正文去重列及其索引（改为分区表是运维手动执行的 log_storage.py --partition，不在启动时做）"""
+    columns = {column["name"] for column in inspect(sync_conn).get_columns(ChatLog.__tablename__)}
+    if "content_hash" not in columns:
+        sync_conn.execute(text(f"ALTER TABLE {ChatLog.__tablename__} ADD COLUMN content_hash VARCHAR(64)"))
+    for index in ChatLog.__table__.indexes:
+        index.create(sync_conn, checkfirst=True)
+
+def _migrate_v4(sync_conn):
+    """chatlog.meta 列（已分区时加在父表上，会同步到所有分区）"""
+    columns = {column["name"] for column in inspect(sync_conn).get_columns(ChatLog.__tablename__)}
+    if "meta" not in columns:
+        sync_conn.execute(text(f"ALTER TABLE {ChatLog.__tablename__} ADD COLUMN meta JSON"))
+
+# 升级到某个版本时需要执行的变更（新表由 create_all 负责）
+MIGRATIONS = {
+    2: _migrate_v2,
+    3: _migrate_v3,
+    4: _migrate_v4,
+}
+
+async def init_db() -> bool:
     print("DEBUG: Initializing database...")
+    if os.path.exists(SCHEMA_MARKER):
+        print(f"DEBUG: Schema v{SCHEMA_VERSION} marker found, skipping DDL.")
+        return True
     try:
         async with engine.begin() as conn:
-            # Create tables if they don't exist
-            await conn.run_sync(Base.metadata.create_all)
-        print("DEBUG: Database tables created/verified successfully.")
+            current = await conn.run_sync(_current_schema_version)
+            if current == SCHEMA_VERSION:
+                print(f"DEBUG: Database schema is current (v{current}), skipping DDL.")
+            else:
+                # Create tables if they don't exist
+                await conn.run_sync(Base.metadata.create_all)
+                for version in range((current or 0) + 1, SCHEMA_VERSION + 1):
+                    if version in MIGRATIONS:
+                        print(f"DEBUG: Applying schema migration v{version}")
+                        await conn.run_sync(MIGRATIONS[version])
+                await conn.execute(SchemaVersion.__table__.delete())
+                await conn.execute(SchemaVersion.__table__.insert().values(id=1, version=SCHEMA_VERSION))
+                print(f"DEBUG: Database tables created/verified successfully (v{current} -> v{SCHEMA_VERSION}).")
+            if conn.dialect.name == "postgresql":
+                from log_storage import ensure_partitions
+                await conn.run_sync(ensure_partitions)
+        try:
+            open(SCHEMA_MARKER, "w").close()
+        except OSError:
+            pass
+        return True
     except Exception as e:
         print(f"ERROR: Database initialization failed: {e}")
         traceback.print_exc()
         # 不抛出异常，允许应用启动，但在后续操作中可能会报错
+        return False
+
+_init_task = None
+
+def forget_schema():
+    """表或列缺失（例如数据库被恢复到旧备份）时删掉标记，下次写入前重新检查表结构"""
+    global _init_task
+    try:
+        os.remove(SCHEMA_MARKER)
+    except OSError:
+        pass
+    if _init_task is not None and _init_task.done():
+        _init_task = None
+
+def ensure_db():
+    """只初始化一次数据库（启动时在后台触发，首次写日志前等待完成）；失败后下次调用重试"""
+    global _init_task
+    if _init_task is None or (_init_task.done() and (_init_task.cancelled() or not _init_task.result())):
+        _init_task = asyncio.ensure_future(init_db())
+    return _init_task
 
 async def get_db():
     async with AsyncSessionLocal() as session:
         yield session
 
-async def log_message(session: AsyncSession, user_id: uuid.UUID, role: str, content: str, group_type: str = "experimental", student_id: str = None):
+async def log_message(session: AsyncSession, user_id: uuid.UUID, role: str, content: str, group_type: str = "experimental", student_id: str = None, meta: dict = None):
     try:
+        await ensure_db()
+        from log_storage import prepare_content
         # All conversations are recorded in the chatlog table (ChatLog model)
-        new_log = ChatLog(user_id=user_id, role=role, content=content, group_type=group_type, student_id=student_id)
+        new_log = ChatLog(user_id=user_id, role=role, group_type=group_type, student_id=student_id, meta=meta, **await prepare_content(session, content))
         
         session.add(new_log)
         await session.commit()
@@ -115,3 +254,5 @@ async def log_message(session: AsyncSession, user_id: uuid.UUID, role: str, cont
         print(f"ERROR: Failed to log message: {e}")
         traceback.print_exc()
         await session.rollback()
+        if isinstance(e, ProgrammingError):
+            forget_schema()
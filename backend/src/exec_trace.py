@@ -0,0 +1,185 @@
+"""学生代码的执行轨迹：记录每一步执行的行、if/while 走了哪个分支、变量的新值。
+
+本文件既是模块也是脚本：run_code 以 `python exec_trace.py <代码文件> <轨迹文件>` 在子进程中
+运行学生代码，轨迹写入 JSON 文件（stdout/stderr 仍是学生程序自己的输出）。只依赖标准库。
+"""
+import os
+import sys
+import ast
+import json
+import reprlib
+import traceback
+from collections import deque
+from typing import Dict, List, Optional
+
+# 轨迹环形缓冲的条数，超出后丢弃最早的事件
+EXEC_TRACE_MAX_EVENTS = int(os.getenv("EXEC_TRACE_MAX_EVENTS", "200"))
+# 同一行的前若干次执行全部记录，之后每隔 EXEC_TRACE_SAMPLE_EVERY 次记录一次（长循环采样）
+EXEC_TRACE_LINE_HITS = int(os.getenv("EXEC_TRACE_LINE_HITS", "5"))
+EXEC_TRACE_SAMPLE_EVERY = int(os.getenv("EXEC_TRACE_SAMPLE_EVERY", "50"))
+# 执行步数超过该值后停止跟踪，代码继续以正常速度运行到结束
+EXEC_TRACE_MAX_STEPS = int(os.getenv("EXEC_TRACE_MAX_STEPS", "100000"))
+# 写入提示词的轨迹最多保留多少步（保留开头和结尾）
+EXEC_TRACE_PROMPT_EVENTS = int(os.getenv("EXEC_TRACE_PROMPT_EVENTS", "30"))
+
+_repr = reprlib.Repr()
+_repr.maxstring = 40
+_repr.maxother = 40
+_repr.maxlist = _repr.maxtuple = _repr.maxdict = _repr.maxset = 6
+
+
+def _decisions(tree: ast.AST) -> Dict[int, int]:
+    """if/while 条件所在行 -> 条件成立时执行的第一行"""
+    return {
+        node.lineno: node.body[0].lineno
+        for node in ast.walk(tree)
+        if isinstance(node, (ast.If, ast.While)) and node.body
+    }
+
+
+def _visible(name: str, value) -> bool:
+    if name.startswith("__"):
+        return False
+    return not (isinstance(value, type) or callable(value) or type(value).__name__ == "module")
+
+
+class Tracer:
+    """sys.settrace 回调：只跟踪学生代码文件中的帧"""
+
+    def __init__(self, path: str, decisions: Dict[int, int]):
+        self.path = path
+        self.decisions = decisions
+        self.events = deque(maxlen=EXEC_TRACE_MAX_EVENTS)
+        self.steps = 0
+        self.truncated = False
+        self.hits: Dict[int, int] = {}
+        # 帧 -> [变量快照, 上一行号, 上一行对应的事件（未采样时为 None）]
+        self.frames: Dict[object, list] = {}
+
+    def __call__(self, frame, event, arg):
+        if frame.f_code.co_filename != self.path:
+            return None
+        return self.local
+
+    def _settle(self, frame, current_line: Optional[int]) -> None:
+        """上一行执行完毕：把变量变化与分支结果记到它的事件上"""
+        snapshot, line, pending = self.frames[frame]
+        changes = {}
+        for name, value in list(frame.f_locals.items()):
+            if not _visible(name, value):
+                continue
+            text = _repr.repr(value)
+            if snapshot.get(name) != text:
+                snapshot[name] = text
+                changes[name] = text
+        if pending is None:
+            return
+        if changes:
+            pending["vars"] = changes
+        if line in self.decisions and current_line is not None:
+            pending["branch"] = current_line == self.decisions[line]
+
+    def local(self, frame, event, arg):
+        if event == "line":
+            if frame not in self.frames:
+                self.frames[frame] = [{}, None, None]
+            self._settle(frame, frame.f_lineno)
+            self.steps += 1
+            if self.steps > EXEC_TRACE_MAX_STEPS:
+                self.truncated = True
+                sys.settrace(None)
+                frame.f_trace = None
+                return None
+            hit = self.hits.get(frame.f_lineno, 0) + 1
+            self.hits[frame.f_lineno] = hit
+            pending = None
+            if hit <= EXEC_TRACE_LINE_HITS or hit % EXEC_TRACE_SAMPLE_EVERY == 0:
+                pending = {"line": frame.f_lineno, "hit": hit}
+                self.events.append(pending)
+            self.frames[frame][1:] = [frame.f_lineno, pending]
+        elif event == "exception" and frame in self.frames:
+            self._settle(frame, None)
+        elif event == "return" and frame in self.frames:
+            # 条件不成立且其后再无语句时，下一步就是离开本帧
+            self._settle(frame, 0)
+            del self.frames[frame]
+        return self.local
+
+    def result(self) -> dict:
+        return {
+            "events": list(self.events),
+            "steps": self.steps,
+            "dropped": self.steps - len(self.events),
+            "truncated": self.truncated,
+        }
+
+
+def main(code_path: str, trace_path: str) -> int:
+    with open(code_path, "r", encoding="utf-8") as fd:
+        source = fd.read()
+    code = compile(source, code_path, "exec")
+    tracer = Tracer(code_path, _decisions(ast.parse(source)))
+    namespace = {"__name__": "__main__", "__file__": code_path}
+    status = 0
+    sys.settrace(tracer)
+    try:
+        exec(code, namespace)
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException as e:
+        # 去掉本脚本自身的栈帧，报错与直接运行学生代码时一致
+        traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+        status = 1
+    finally:
+        sys.settrace(None)
+        sys.stdout.flush()
+        with open(trace_path, "w", encoding="utf-8") as fd:
+            json.dump(tracer.result(), fd, ensure_ascii=False)
+    return status
+
+
+def load_trace(trace_path: str) -> Optional[dict]:
+    try:
+        with open(trace_path, "r", encoding="utf-8") as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return None
+
+
+def compact_trace(trace: Optional[dict], code: str) -> str:
+    """写入 Agent C 提示词的精简轨迹：每步一行 `L行号 源码 → 分支 | 变量=值`"""
+    if not trace or not trace.get("events"):
+        return ""
+    source_lines = (code or "").splitlines()
+    events: List[dict] = trace["events"]
+    omitted = 0
+    if len(events) > EXEC_TRACE_PROMPT_EVENTS:
+        head = EXEC_TRACE_PROMPT_EVENTS // 2
+        tail = EXEC_TRACE_PROMPT_EVENTS - head
+        omitted = len(events) - EXEC_TRACE_PROMPT_EVENTS
+        events = events[:head] + [None] + events[-tail:]
+    lines = []
+    for event in events:
+        if event is None:
+            lines.append(f"…（省略 {omitted} 步）")
+            continue
+        line_no = event["line"]
+        text = source_lines[line_no - 1].strip() if 0 < line_no <= len(source_lines) else ""
+        entry = f"L{line_no}"
+        if event["hit"] > 1:
+            entry += f"(第{event['hit']}次)"
+        entry += f" {text}"
+        if "branch" in event:
+            entry += " → 成立" if event["branch"] else " → 不成立"
+        if event.get("vars"):
+            entry += " | " + ", ".join(f"{name}={value}" for name, value in event["vars"].items())
+        lines.append(entry)
+    if trace.get("dropped"):
+        lines.append(f"（共执行 {trace['steps']} 步，循环中的重复步骤已采样）")
+    if trace.get("truncated"):
+        lines.append("（步数过多，之后未再跟踪）")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1], sys.argv[2]))
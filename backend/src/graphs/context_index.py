@@ -0,0 +1,192 @@
+import os
+import re
+import zlib
+import threading
+import contextvars
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import metrics
+
+# 各智能体的 context 只放与本轮问题相关的历史消息（BM25 检索）；设置 CONTEXT_RETRIEVAL=0 时沿用完整对话
+CONTEXT_RETRIEVAL_ENABLED = os.getenv("CONTEXT_RETRIEVAL", "1") != "0"
+# 按相关性选出的历史消息条数，另外总是保留最近的若干条；历史不超过两者之和时原样使用
+CONTEXT_TOP_K = int(os.getenv("CONTEXT_TOP_K", "6"))
+CONTEXT_RECENT = int(os.getenv("CONTEXT_RECENT", "4"))
+# 每个会话的索引最多保留的消息条数（超出后淘汰最早的），以及同时保留索引的会话数
+CONTEXT_MAX_TURNS = int(os.getenv("CONTEXT_MAX_TURNS", "300"))
+CONTEXT_MAX_SESSIONS = int(os.getenv("CONTEXT_MAX_SESSIONS", "256"))
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+# 字符 n-gram 的长度：中文按单字与相邻两字切分，不需要分词
+NGRAM_SIZES = (1, 2)
+
+# 前端拼接的 context 每条消息以 "user: " / "assistant: " 开头，消息内部可以换行
+_MESSAGE_START = re.compile(r"\n(?=(?:user|assistant): )")
+_WORD = re.compile(r"\w+")
+
+
+def split_turns(context: str) -> List[str]:
+    return [turn for turn in _MESSAGE_START.split(context or "") if turn.strip()]
+
+
+def ngram_ids(text: str) -> np.ndarray:
+    """文本中字符 n-gram 的哈希 id（crc32，跨进程稳定）"""
+    ids = []
+    for word in _WORD.findall(text.lower()):
+        for size in NGRAM_SIZES:
+            for i in range(len(word) - size + 1):
+                ids.append(zlib.crc32(word[i:i + size].encode("utf-8")))
+    return np.array(ids, dtype=np.uint32)
+
+
+class TurnIndex:
+    """一个会话的历史消息索引：每条消息一个稀疏词频向量，随对话增长逐条追加"""
+
+    def __init__(self, max_turns: int = CONTEXT_MAX_TURNS):
+        self.max_turns = max_turns
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self) -> None:
+        self.turns: List[str] = []
+        # 每条消息的 (term id, 词频) 两个数组
+        self._vectors: List[tuple] = []
+        self._lengths: List[int] = []
+        self._df: Dict[int, int] = {}
+        # 已淘汰的消息条数；context 中第 offset + i 条对应 turns[i]
+        self.offset = 0
+        self._postings: Optional[tuple] = None
+
+    def __len__(self) -> int:
+        return len(self.turns)
+
+    def _add(self, text: str) -> None:
+        terms, counts = np.unique(ngram_ids(text), return_counts=True)
+        self.turns.append(text)
+        self._vectors.append((terms, counts.astype(np.float32)))
+        self._lengths.append(int(counts.sum()))
+        for term in terms.tolist():
+            self._df[term] = self._df.get(term, 0) + 1
+
+    def _evict(self) -> None:
+        self.turns.pop(0)
+        terms, _ = self._vectors.pop(0)
+        self._lengths.pop(0)
+        for term in terms.tolist():
+            remaining = self._df[term] - 1
+            if remaining:
+                self._df[term] = remaining
+            else:
+                del self._df[term]
+        self.offset += 1
+
+    def sync(self, turns: List[str]) -> int:
+        """把 context 中新增的消息加入索引，返回新增条数；历史被改写时重建"""
+        total = self.offset + len(self.turns)
+        continues = len(turns) >= total and (not self.turns or turns[total - 1] == self.turns[-1])
+        if not continues:
+            self._reset()
+            total = 0
+        new_turns = turns[total:]
+        for text in new_turns:
+            self._add(text)
+        while len(self.turns) > self.max_turns:
+            self._evict()
+        if new_turns:
+            self._postings = None
+        return len(new_turns)
+
+    def _all_postings(self) -> tuple:
+        if self._postings is None:
+            docs = np.concatenate([np.full(len(terms), i, dtype=np.int32) for i, (terms, _) in enumerate(self._vectors)])
+            terms = np.concatenate([terms for terms, _ in self._vectors])
+            tfs = np.concatenate([tfs for _, tfs in self._vectors])
+            self._postings = (docs, terms, tfs)
+        return self._postings
+
+    def scores(self, query: str) -> np.ndarray:
+        """各条消息相对 query 的 BM25 分数"""
+        n = len(self.turns)
+        query_terms = np.unique(ngram_ids(query))
+        if n == 0 or len(query_terms) == 0:
+            return np.zeros(n, dtype=np.float32)
+        docs, terms, tfs = self._all_postings()
+        mask = np.isin(terms, query_terms)
+        docs, terms, tfs = docs[mask], terms[mask], tfs[mask]
+        df = np.array([self._df[term] for term in terms.tolist()], dtype=np.float32)
+        idf = np.log(1 + (n - df + 0.5) / (df + 0.5))
+        lengths = np.array(self._lengths, dtype=np.float32)
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[docs] / max(lengths.mean(), 1.0))
+        weights = idf * tfs * (BM25_K1 + 1) / (tfs + norm)
+        return np.bincount(docs, weights=weights, minlength=n)
+
+    def select(self, query: str, top_k: int = CONTEXT_TOP_K, recent: int = CONTEXT_RECENT) -> List[int]:
+        """最相关的 top_k 条加上最近 recent 条，按时间顺序返回下标"""
+        n = len(self.turns)
+        chosen = set(range(max(n - recent, 0), n))
+        candidates = self.scores(query)[:max(n - recent, 0)]
+        for i in np.argsort(-candidates, kind="stable")[:top_k].tolist():
+            if candidates[i] > 0:
+                chosen.add(i)
+        return sorted(chosen)
+
+
+class ContextIndex:
+    """按会话保存 TurnIndex，超出 CONTEXT_MAX_SESSIONS 时淘汰最久未用的会话"""
+
+    def __init__(self, max_sessions: int = CONTEXT_MAX_SESSIONS):
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, TurnIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session: Optional[str]) -> TurnIndex:
+        if session is None:
+            # 没有会话标识（如离线回放）时临时建索引，不保留
+            return TurnIndex()
+        with self._lock:
+            index = self._sessions.get(session)
+            if index is None:
+                index = self._sessions[session] = TurnIndex()
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            else:
+                self._sessions.move_to_end(session)
+            return index
+
+
+context_index = ContextIndex()
+_session: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("context_session", default=None)
+
+
+def bind_session(session: Optional[str]) -> None:
+    """把本轮的会话绑定到当前上下文，之后启动的 graph 节点都会继承它"""
+    _session.set(session)
+
+
+def relevant_context(context: str, *query: str) -> str:
+    """从完整对话中挑出与 query 相关的消息（以及最近几条），拼回 context 的格式"""
+    if not CONTEXT_RETRIEVAL_ENABLED or not context:
+        return context
+    turns = split_turns(context)
+    if len(turns) <= CONTEXT_TOP_K + CONTEXT_RECENT:
+        return context
+    index = context_index.get(_session.get())
+    with index.lock:
+        index.sync(turns)
+        chosen = index.select("\n".join(q for q in query if q))
+        selected = [(index.offset + i, index.turns[i]) for i in chosen]
+    lines = []
+    previous = -1
+    for position, text in selected:
+        if position - previous > 1:
+            lines.append(f"（省略 {position - previous - 1} 条与当前问题关系不大的消息）")
+        lines.append(text)
+        previous = position
+    result = "\n".join(lines)
+    metrics.incr("context_retrieval_calls")
+    metrics.incr("context_chars_saved", len(context) - len(result))
+    return result
@@ -0,0 +1,168 @@
+import os
+import ast
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+# 学生代码 -> Mermaid 流程图的缓存条数（按代码的 sha256 查找）
+FLOWCHART_CACHE_SIZE = int(os.getenv("FLOWCHART_CACHE_SIZE", "512"))
+# 单个节点文字的最大长度，超出部分用省略号代替
+MAX_LABEL_CHARS = 40
+
+# 核心知识点图（knowledge 阶段起一直展示）
+CONCEPT_DIAGRAM = """graph TD
+    Root[Python双分支结构] --> Concept{核心概念}
+    Concept --> |互斥| Choice[二选一]
+    Concept --> |逻辑| Logic[条件判断]
+    Root --> Syntax{语法规则}
+    Syntax --> KW[if-else关键字]
+    Syntax --> Colon[冒号 :]
+    Syntax --> Indent[缩进]"""
+
+# 迁移应用 summary 阶段展示的全课思维导图
+LESSON_DIAGRAM = CONCEPT_DIAGRAM + """
+    Root --> App{应用场景}
+    App --> Ticket[公园购票]
+    App --> Weather[气象站报警]"""
+
+# 待连接的出边：(起点节点 id, 边上的文字)
+Edge = Tuple[str, str]
+
+
+def _label(text: str) -> str:
+    text = " ".join(text.split())
+    if len(text) > MAX_LABEL_CHARS:
+        text = text[:MAX_LABEL_CHARS - 1] + "…"
+    # 节点文字统一加引号，其中的引号转义为 Mermaid 实体
+    return '"' + text.replace('"', "#quot;") + '"'
+
+
+def _is_call(node: ast.AST, name: str) -> bool:
+    return isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == name
+
+
+def _contains_input(node: ast.AST) -> bool:
+    return any(_is_call(child, "input") for child in ast.walk(node))
+
+
+class _Builder:
+    """把语句序列逐条连成流程图：开始/结束为圆角框，input/print 为平行四边形，条件为菱形"""
+
+    def __init__(self):
+        self.lines = ["graph TD"]
+        self.count = 0
+        # 循环栈：(条件节点 id, break 出边)
+        self.loops: List[Tuple[str, List[Edge]]] = []
+
+    def node(self, shape: str, text: str) -> str:
+        self.count += 1
+        node_id = f"N{self.count}"
+        opening, closing = {
+            "terminal": ("([", "])"),
+            "io": ("[/", "/]"),
+            "process": ("[", "]"),
+            "decision": ("{", "}"),
+        }[shape]
+        self.lines.append(f"    {node_id}{opening}{_label(text)}{closing}")
+        return node_id
+
+    def link(self, pending: List[Edge], target: str) -> None:
+        for source, label in pending:
+            arrow = f" -- {label} --> " if label else " --> "
+            self.lines.append(f"    {source}{arrow}{target}")
+
+    def block(self, statements: List[ast.stmt], pending: List[Edge]) -> List[Edge]:
+        for statement in statements:
+            pending = self.statement(statement, pending)
+        return pending
+
+    def statement(self, statement: ast.stmt, pending: List[Edge]) -> List[Edge]:
+        if isinstance(statement, ast.If):
+            condition = self.node("decision", ast.unparse(statement.test) + "?")
+            self.link(pending, condition)
+            exits = self.block(statement.body, [(condition, "Yes")])
+            if statement.orelse:
+                return exits + self.block(statement.orelse, [(condition, "No")])
+            return exits + [(condition, "No")]
+
+        if isinstance(statement, (ast.While, ast.For)):
+            if isinstance(statement, ast.While):
+                text = ast.unparse(statement.test) + "?"
+            else:
+                text = f"遍历 {ast.unparse(statement.target)} in {ast.unparse(statement.iter)}"
+            condition = self.node("decision", text)
+            self.link(pending, condition)
+            self.loops.append((condition, []))
+            exits = self.block(statement.body, [(condition, "Yes")])
+            _, breaks = self.loops.pop()
+            self.link(exits, condition)
+            # while/for 的 else 分支在循环正常结束（不是 break）时执行
+            return self.block(statement.orelse, [(condition, "No")]) + breaks
+
+        if isinstance(statement, ast.Break) and self.loops:
+            self.loops[-1][1].extend(pending)
+            return []
+        if isinstance(statement, ast.Continue) and self.loops:
+            self.link(pending, self.loops[-1][0])
+            return []
+
+        if isinstance(statement, ast.Expr) and _is_call(statement.value, "print"):
+            text = "输出 " + ", ".join(ast.unparse(arg) for arg in statement.value.args)
+            shape = "io"
+        elif isinstance(statement, (ast.Assign, ast.AnnAssign, ast.AugAssign)) and _contains_input(statement):
+            targets = statement.targets if isinstance(statement, ast.Assign) else [statement.target]
+            text = "输入 " + ", ".join(ast.unparse(target) for target in targets)
+            shape = "io"
+        else:
+            text = ast.unparse(statement).splitlines()[0]
+            shape = "process"
+        node_id = self.node(shape, text)
+        self.link(pending, node_id)
+        return [(node_id, "")]
+
+
+def _build(code: str) -> Optional[str]:
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        return None
+    if not tree.body:
+        return None
+    builder = _Builder()
+    start = builder.node("terminal", "开始")
+    exits = builder.block(tree.body, [(start, "")])
+    builder.link(exits, builder.node("terminal", "结束"))
+    return "\n".join(builder.lines)
+
+
+class FlowchartCache:
+    """按代码 sha256 缓存生成结果（含无法解析时的 None），最近最少使用的先淘汰"""
+
+    def __init__(self, max_entries: int = FLOWCHART_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Optional[str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, code: str) -> Optional[str]:
+        key = hashlib.sha256(code.encode("utf-8")).hexdigest()
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        chart = _build(code)
+        with self._lock:
+            self._entries[key] = chart
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return chart
+
+
+_cache = FlowchartCache()
+
+
+def code_to_mermaid(code: Optional[str]) -> Optional[str]:
+    """学生代码的 Mermaid 流程图；代码为空或有语法错误时返回 None"""
+    if not code or not code.strip():
+        return None
+    return _cache.get(code)
@@ -0,0 +1,96 @@
+from typing import Iterable, Optional, Set
+
+
+class JsonFieldWatcher:
+    """逐段读取模型流式输出的 JSON，判断何时可以提前结束生成。
+
+    只跟踪最外层对象的字段：对象已闭合，或 required 中的字段都已完整收到时，feed 返回
+    本段文本中可以截断的位置。截断在字段之间时 needs_close 为 True，调用方在截断后补一个
+    "}" 即得到合法的 JSON。对象之前的文字（如 ```json）原样保留。
+    """
+
+    def __init__(self, required: Iterable[str] = ()):
+        self.required: Set[str] = set(required)
+        self.seen: Set[str] = set()
+        self.needs_close = False
+        self.done = False
+        self._started = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        # 最外层对象内的位置：key / key_str / colon / value_start / value_str / value_scalar / value_nested / after
+        self._phase = "key"
+        self._key: list = []
+
+    def _complete(self) -> bool:
+        self.seen.add("".join(self._key))
+        self._phase = "after"
+        return bool(self.required) and self.required <= self.seen
+
+    def feed(self, text: str) -> Optional[int]:
+        """返回 text 中可以截断的位置（不含该位置的字符）；还需要继续生成时返回 None"""
+        if self.done:
+            return 0
+        for i, ch in enumerate(text):
+            cut = self._step(ch, i)
+            if cut is not None:
+                self.done = True
+                return cut
+        return None
+
+    def _step(self, ch: str, i: int) -> Optional[int]:
+        if not self._started:
+            if ch == "{":
+                self._started = True
+                self._depth = 1
+            return None
+
+        top = self._depth == 1
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif ch == "\\":
+                self._escape = True
+            elif ch == '"':
+                self._in_string = False
+                if top and self._phase == "key_str":
+                    self._phase = "colon"
+                elif top and self._phase == "value_str" and self._complete():
+                    self.needs_close = True
+                    return i + 1
+                return None
+            if top and self._phase == "key_str":
+                self._key.append(ch)
+            return None
+
+        if top and self._phase == "value_scalar" and (ch in ",}" or ch.isspace()):
+            if self._complete():
+                self.needs_close = True
+                return i
+
+        if ch == '"':
+            self._in_string = True
+            if top and self._phase == "key":
+                self._phase = "key_str"
+                self._key = []
+            elif top and self._phase == "value_start":
+                self._phase = "value_str"
+        elif ch == ":" and top and self._phase == "colon":
+            self._phase = "value_start"
+        elif ch in "{[":
+            if top and self._phase == "value_start":
+                self._phase = "value_nested"
+            self._depth += 1
+        elif ch in "}]":
+            self._depth -= 1
+            if self._depth == 0:
+                # 最外层对象闭合
+                return i + 1
+            if self._depth == 1 and self._phase == "value_nested" and self._complete():
+                self.needs_close = True
+                return i + 1
+        elif ch == "," and top:
+            self._phase = "key"
+        elif top and self._phase == "value_start" and not ch.isspace():
+            self._phase = "value_scalar"
+        return None
@@ -0,0 +1,625 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, List, Tuple, Iterator, AsyncIterator, Optional
+
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.callbacks.manager import dispatch_custom_event, adispatch_custom_event
+
+import metrics
+import token_ledger
+from graphs.response_cache import response_cache, RESPONSE_CACHE_ENABLED
+from graphs.json_watch import JsonFieldWatcher
+from graphs.output_stats import output_stats
+
+# 是否开启相同 prompt 的请求合并（single-flight），默认开启
+COALESCE_ENABLED = os.getenv("LLM_COALESCE", "1") != "0"
+
+# 声明了必需字段的调用，在 JSON 对象闭合或必需字段都已收到时提前关闭上游生成；设置 LLM_EARLY_STOP=0 关闭
+EARLY_STOP_ENABLED = os.getenv("LLM_EARLY_STOP", "1") != "0"
+# 提前结束时上游不会返回 usage，按字符数估算输入 token
+CHARS_PER_TOKEN = 1.5
+
+# 合并请求的跟随者或命中预热缓存时派发的自定义事件名，chat_stream 据此转发给前端
+COALESCED_START_EVENT = "llm_coalesced_start"
+COALESCED_TOKEN_EVENT = "llm_coalesced_token"
+
+# 模型客户端 metadata 中记录配置级参数（模型、temperature、top_p、配置的 max_tokens）的键
+CONFIG_PARAMS_METADATA = "config_params"
+
+
+class GenerationCancelled(Exception):
+    """学生断开连接或发送了新消息，本轮生成被取消"""
+
+
+class LeaderAbandoned(Exception):
+    """合并请求的领导者中途被取消，跟随者没能拿到完整结果"""
+
+
+# 当前轮次的取消信号。用 threading.Event 是因为同步节点运行在线程池里
+_cancel_event: contextvars.ContextVar[Optional[threading.Event]] = contextvars.ContextVar("llm_cancel_event", default=None)
+
+
+def bind_cancel_event(event: threading.Event) -> None:
+    """把本轮的取消信号绑定到当前上下文，之后启动的 graph 节点都会继承它"""
+    _cancel_event.set(event)
+
+
+# 当前轮次的 LLM 调用记录（原始输出、首 token 与总耗时），写入日志供离线回放使用
+_call_recorder: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar("llm_call_recorder", default=None)
+
+
+def bind_call_recorder(calls: list) -> None:
+    """之后本上下文中每次 stream_llm / astream_llm 完成时，向 calls 追加一条调用记录"""
+    _call_recorder.set(calls)
+
+
+class _CallRecord:
+    """统计一次调用的耗时与输出，结束时写入当前绑定的记录列表"""
+
+    def __init__(self, agent: str):
+        self.calls = _call_recorder.get()
+        self.agent = agent
+        self.started = time.perf_counter()
+        self.first_token_ms = None
+        self.parts: List[str] = []
+        self.chunks = 0
+        self.usage = None
+
+    def add(self, chunk) -> None:
+        if self.calls is None:
+            return
+        if self.first_token_ms is None:
+            self.first_token_ms = round((time.perf_counter() - self.started) * 1000, 1)
+        self.chunks += 1
+        if chunk.content:
+            self.parts.append(chunk.content)
+        if getattr(chunk, "usage_metadata", None):
+            self.usage = chunk.usage_metadata
+
+    def finish(self) -> None:
+        if self.calls is None:
+            return
+        self.calls.append({
+            "agent": self.agent,
+            "text": "".join(self.parts),
+            "first_token_ms": self.first_token_ms,
+            "latency_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "chunks": self.chunks,
+            "input_tokens": self.usage.get("input_tokens") if self.usage else None,
+            "output_tokens": self.usage.get("output_tokens") if self.usage else None,
+            "cached_tokens": _cached_tokens(self.usage) if self.usage else None,
+        })
+
+
+def _cached_tokens(usage: dict) -> int:
+    """usage_metadata 中命中模型服务前缀缓存的输入 token 数（OpenAI 兼容接口的 prompt_tokens_details.cached_tokens）"""
+    return (usage.get("input_token_details") or {}).get("cache_read") or 0
+
+
+def _record_usage(agent: str, usage: dict) -> None:
+    """按智能体累计输入 token 与其中命中前缀缓存的部分，二者之比即前缀缓存命中率"""
+    metrics.incr(f"llm_prompt_tokens_{agent}", usage.get("input_tokens") or 0)
+    metrics.incr(f"llm_cached_tokens_{agent}", _cached_tokens(usage))
+    metrics.incr(f"llm_output_tokens_{agent}", usage.get("output_tokens") or 0)
+    token_ledger.record(usage)
+
+
+def _early_stop(agent: str, chunk, cut: int, close: bool, messages: List[BaseMessage], chunks: int, started: float):
+    """截断触发提前结束的 chunk，附上估算的 usage，并按该智能体完整生成的平均长度估算节省量"""
+    with _stats_lock:
+        count, total = _completion_stats.get(agent, (0, 0))
+    elapsed = time.perf_counter() - started
+    saved = max(total / count - chunks, 0) if count else 0
+    metrics.incr("llm_early_stops")
+    metrics.incr(f"llm_early_stops_{agent}")
+    metrics.incr("llm_early_stop_tokens_saved_est", saved)
+    metrics.incr("llm_early_stop_seconds_saved_est", saved * elapsed / chunks if chunks else 0)
+    prompt_chars = sum(len(m.content) if isinstance(m.content, str) else 0 for m in messages)
+    usage = {
+        "input_tokens": int(prompt_chars / CHARS_PER_TOKEN),
+        "output_tokens": chunks,
+        "total_tokens": int(prompt_chars / CHARS_PER_TOKEN) + chunks,
+    }
+    _record_usage(agent, usage)
+    return AIMessageChunk(
+        content=chunk.content[:cut] + ("}" if close else ""),
+        id=chunk.id,
+        usage_metadata=usage,
+    )
+
+
+def _cancelled() -> bool:
+    event = _cancel_event.get()
+    return event is not None and event.is_set()
+
+
+# 各智能体已完成生成的 (次数, chunk 总数)，用于估算取消生成节省的 token
+_completion_stats: Dict[str, List[int]] = {}
+_stats_lock = threading.Lock()
+
+
+def _record_completion(agent: str, chunks: int) -> None:
+    with _stats_lock:
+        stats = _completion_stats.setdefault(agent, [0, 0])
+        stats[0] += 1
+        stats[1] += chunks
+
+
+def _record_cancel(agent: str, chunks: int) -> None:
+    with _stats_lock:
+        count, total = _completion_stats.get(agent, (0, 0))
+    expected = total / count if count else chunks
+    metrics.incr("llm_generations_cancelled")
+    metrics.incr("llm_cancelled_tokens_generated", chunks)
+    metrics.incr("llm_cancelled_tokens_saved_est", max(expected - chunks, 0))
+    print(f"DEBUG: {agent} generation cancelled after {chunks} chunks")
+
+
+class _Flight:
+    """一次正在进行中的 LLM 生成，领导者写入 chunk，跟随者按顺序读取"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._chunks: List = []
+        self._done = False
+        self._error: Optional[BaseException] = None
+        self.followers = 0
+
+    @property
+    def has_followers(self) -> bool:
+        return self.followers > 0
+
+    def publish(self, chunk) -> None:
+        with self._cond:
+            self._chunks.append(chunk)
+            self._cond.notify_all()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        with self._cond:
+            self._done = True
+            self._error = error
+            self._cond.notify_all()
+
+    def _wait(self, index: int) -> Tuple[List, bool]:
+        """阻塞直到有 index 之后的新 chunk 或生成结束"""
+        with self._cond:
+            while index >= len(self._chunks) and not self._done:
+                self._cond.wait()
+            return self._chunks[index:], self._done
+
+    def subscribe(self) -> Iterator:
+        index = 0
+        while True:
+            new_chunks, done = self._wait(index)
+            index += len(new_chunks)
+            yield from new_chunks
+            if done and not new_chunks:
+                break
+        if self._error is not None:
+            raise self._error
+
+    async def asubscribe(self) -> AsyncIterator:
+        index = 0
+        while True:
+            new_chunks, done = await asyncio.to_thread(self._wait, index)
+            index += len(new_chunks)
+            for chunk in new_chunks:
+                yield chunk
+            if done and not new_chunks:
+                break
+        if self._error is not None:
+            raise self._error
+
+
+class SingleFlight:
+    """按 key 合并进行中的相同请求：第一个请求成为领导者，其余请求订阅其输出"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: Dict[str, _Flight] = {}
+
+    def join(self, key: str) -> Tuple[_Flight, bool]:
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.followers += 1
+                return flight, False
+            flight = _Flight()
+            self._flights[key] = flight
+            return flight, True
+
+    def unfollow(self, flight: _Flight) -> None:
+        """跟随者结束订阅（完成、被取消或被新消息取代）"""
+        with self._lock:
+            flight.followers -= 1
+
+    def leave(self, key: str, flight: _Flight) -> None:
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+
+_single_flight = SingleFlight()
+
+
+class WarmupRun:
+    """课前预热：记录本次预热覆盖到的 prompt，以及每个 prompt 的变体数量"""
+
+    def __init__(self, variants: int):
+        self.variants = variants
+        self.covered: List[dict] = []
+
+    def record(self, agent: str, key: str, existing: int, generated: int) -> None:
+        self.covered.append({
+            "agent": agent,
+            "key": key,
+            "existing_variants": existing,
+            "generated_variants": generated,
+        })
+
+
+_warmup_run: contextvars.ContextVar[Optional[WarmupRun]] = contextvars.ContextVar("warmup_run", default=None)
+
+
+@contextmanager
+def warmup_session(variants: int):
+    """在该上下文中运行 graph 时，每个 prompt 都会被补齐到 variants 条缓存回复"""
+    run = WarmupRun(variants)
+    token = _warmup_run.set(run)
+    try:
+        yield run
+    finally:
+        _warmup_run.reset(token)
+
+
+def _config_params(llm) -> dict:
+    """模型客户端对应的配置级参数。node._get_llm 把它放在 metadata 中：max_tokens 随输出统计收紧，
+    这一按次调整不改变缓存 key（缓存只存自然结束的回复）；超出预算时的模型与上限已计入其中"""
+    params = (getattr(llm, "metadata", None) or {}).get(CONFIG_PARAMS_METADATA)
+    if params is not None:
+        return params
+    return {
+        "model": getattr(llm, "model_name", None),
+        "temperature": getattr(llm, "temperature", None),
+        "top_p": getattr(llm, "top_p", None),
+        "max_tokens": getattr(llm, "max_tokens", None),
+    }
+
+
+def prompt_key(llm, messages: List[BaseMessage], agent: str) -> str:
+    """同一智能体、同一配置的模型参数、同一渲染后 prompt 视为相同请求"""
+    params = _config_params(llm)
+    payload = json.dumps(
+        [
+            agent,
+            params.get("model"),
+            params.get("temperature"),
+            params.get("top_p"),
+            params.get("max_tokens"),
+            [(m.type, m.content) for m in messages],
+        ],
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def flight_key(llm, key: str, required: Optional[List[str]] = None) -> str:
+    """请求合并的 key：在缓存 key 之外再区分本次实际的模型、max_tokens、生成时限与提前结束字段，
+    跟随者拿到的输出与自己单独生成时受同样的截断"""
+    payload = json.dumps(
+        [
+            key,
+            getattr(llm, "model_name", None),
+            getattr(llm, "max_tokens", None),
+            getattr(llm, "request_timeout", None),
+            sorted(required) if EARLY_STOP_ENABLED and required else None,
+        ],
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _dispatch(name: str, data: dict) -> None:
+    # 只有在 graph 节点内运行时才有父 run，其余场景（如对照组）忽略
+    try:
+        dispatch_custom_event(name, data)
+    except RuntimeError:
+        pass
+
+
+async def _adispatch(name: str, data: dict) -> None:
+    try:
+        await adispatch_custom_event(name, data)
+    except RuntimeError:
+        pass
+
+
+def _warm(llm, messages: List[BaseMessage], agent: str, key: str, run: WarmupRun) -> str:
+    existing = response_cache.count(key)
+    for _ in range(existing, run.variants):
+        response_cache.add(key, agent, llm.invoke(messages).content)
+    run.record(agent, key, existing, max(run.variants - existing, 0))
+    return response_cache.get(key)
+
+
+async def _awarm(llm, messages: List[BaseMessage], agent: str, key: str, run: WarmupRun) -> str:
+    existing = response_cache.count(key)
+    for _ in range(existing, run.variants):
+        response_cache.add(key, agent, (await llm.ainvoke(messages)).content)
+    run.record(agent, key, existing, max(run.variants - existing, 0))
+    return response_cache.get(key)
+
+
+def _cached_response(key: str) -> Optional[str]:
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    cached = response_cache.get(key)
+    if cached is not None:
+        metrics.incr("response_cache_hits")
+    return cached
+
+
+def _watcher(required: Optional[List[str]]) -> Optional[JsonFieldWatcher]:
+    return JsonFieldWatcher(required) if required is not None and EARLY_STOP_ENABLED else None
+
+
+def _deadline(llm) -> Optional[float]:
+    """模型客户端上设置的超时（秒）同时作为整次生成的时限"""
+    timeout = getattr(llm, "request_timeout", None)
+    return float(timeout) if isinstance(timeout, (int, float)) else None
+
+
+def _record_output(agent: str, sub_stage: Optional[str], tokens: int, started: float) -> None:
+    output_stats.record(agent, sub_stage, tokens, time.perf_counter() - started)
+
+
+def _past_deadline(agent: str, deadline: Optional[float], started: float) -> bool:
+    if deadline is None or time.perf_counter() - started <= deadline:
+        return False
+    metrics.incr("llm_deadline_stops")
+    print(f"DEBUG: {agent} generation stopped after {deadline:.1f}s deadline")
+    return True
+
+
+def _upstream(llm, messages: List[BaseMessage], agent: str, flight: Optional[_Flight] = None, required: Optional[List[str]] = None, sub_stage: Optional[str] = None) -> Iterator:
+    """向模型发起流式请求。本轮被取消且没有其他学生在等待同一结果时，立即关闭上游连接；
+    需要的 JSON 字段都已收到，或超过生成时限时也提前关闭（后者与达到 max_tokens 一样只保留已生成的部分）"""
+    stream = llm.stream(messages)
+    watcher = _watcher(required)
+    deadline = _deadline(llm)
+    started = time.perf_counter()
+    chunks = 0
+    output_tokens = None
+    truncated = False
+    try:
+        for chunk in stream:
+            chunks += 1
+            # 只统计真正发往上游的请求；合并请求的跟随者与缓存命中不计入
+            if getattr(chunk, "usage_metadata", None):
+                _record_usage(agent, chunk.usage_metadata)
+                output_tokens = chunk.usage_metadata.get("output_tokens")
+            truncated = truncated or (getattr(chunk, "response_metadata", None) or {}).get("finish_reason") == "length"
+            cut = watcher.feed(chunk.content) if watcher is not None and isinstance(chunk.content, str) else None
+            if cut is not None:
+                chunk = _early_stop(agent, chunk, cut, watcher.needs_close, messages, chunks, started)
+            if flight is not None:
+                flight.publish(chunk)
+            if _cancelled() and (flight is None or not flight.has_followers):
+                _record_cancel(agent, chunks)
+                raise GenerationCancelled(agent)
+            yield chunk
+            if cut is not None or _past_deadline(agent, deadline, started):
+                # 必需字段收齐或超时截断的输出比完整输出短，计入统计会把上限压到恰好截断 JSON 的位置；
+                # 只有对象自然闭合时才计入
+                if cut is not None and not watcher.needs_close:
+                    _record_output(agent, sub_stage, chunks, started)
+                return
+    finally:
+        stream.close()
+    _record_completion(agent, chunks)
+    # 达到 max_tokens 被截断的输出同样不计入
+    if not truncated:
+        _record_output(agent, sub_stage, output_tokens or chunks, started)
+
+
+async def _aupstream(llm, messages: List[BaseMessage], agent: str, flight: Optional[_Flight] = None, required: Optional[List[str]] = None, sub_stage: Optional[str] = None) -> AsyncIterator:
+    stream = llm.astream(messages)
+    watcher = _watcher(required)
+    deadline = _deadline(llm)
+    started = time.perf_counter()
+    chunks = 0
+    output_tokens = None
+    truncated = False
+    try:
+        async for chunk in stream:
+            chunks += 1
+            # 只统计真正发往上游的请求；合并请求的跟随者与缓存命中不计入
+            if getattr(chunk, "usage_metadata", None):
+                _record_usage(agent, chunk.usage_metadata)
+                output_tokens = chunk.usage_metadata.get("output_tokens")
+            truncated = truncated or (getattr(chunk, "response_metadata", None) or {}).get("finish_reason") == "length"
+            cut = watcher.feed(chunk.content) if watcher is not None and isinstance(chunk.content, str) else None
+            if cut is not None:
+                chunk = _early_stop(agent, chunk, cut, watcher.needs_close, messages, chunks, started)
+            if flight is not None:
+                flight.publish(chunk)
+            if _cancelled() and (flight is None or not flight.has_followers):
+                _record_cancel(agent, chunks)
+                raise GenerationCancelled(agent)
+            yield chunk
+            if cut is not None or _past_deadline(agent, deadline, started):
+                # 必需字段收齐或超时截断的输出比完整输出短，计入统计会把上限压到恰好截断 JSON 的位置；
+                # 只有对象自然闭合时才计入
+                if cut is not None and not watcher.needs_close:
+                    _record_output(agent, sub_stage, chunks, started)
+                return
+    except (asyncio.CancelledError, GeneratorExit):
+        # 任务被取消时异常会在 await 处抛出，关闭 stream 即关闭到模型服务的 HTTP 连接
+        _record_cancel(agent, chunks)
+        raise
+    finally:
+        await stream.aclose()
+    _record_completion(agent, chunks)
+    # 达到 max_tokens 被截断的输出同样不计入
+    if not truncated:
+        _record_output(agent, sub_stage, output_tokens or chunks, started)
+
+
+def _leader_error(e: BaseException) -> Exception:
+    # 领导者自身被取消不应让跟随者误以为是它们自己被取消
+    if isinstance(e, GenerationCancelled) or not isinstance(e, Exception):
+        return LeaderAbandoned()
+    return e
+
+
+def stream_llm(llm, messages: List[BaseMessage], agent: str, required: Optional[List[str]] = None, sub_stage: Optional[str] = None) -> Iterator:
+    """流式调用 LLM：优先使用预热缓存；相同 prompt 正在生成时订阅其 token 而不是重复请求。
+
+    required 不为 None 时输出按 JSON 对象处理：对象闭合或 required 中的字段都已收到即结束生成。
+    """
+    record = _CallRecord(agent)
+    for chunk in _stream_llm(llm, messages, agent, required, sub_stage):
+        record.add(chunk)
+        yield chunk
+    record.finish()
+
+
+def _stream_llm(llm, messages: List[BaseMessage], agent: str, required: Optional[List[str]] = None, sub_stage: Optional[str] = None) -> Iterator:
+    key = prompt_key(llm, messages, agent)
+    run = _warmup_run.get()
+    cached = _warm(llm, messages, agent, key, run) if run else _cached_response(key)
+    if cached is not None:
+        _dispatch(COALESCED_START_EVENT, {"agent": agent})
+        _dispatch(COALESCED_TOKEN_EVENT, {"content": cached})
+        yield AIMessageChunk(content=cached)
+        return
+
+    if not COALESCE_ENABLED:
+        yield from _upstream(llm, messages, agent, required=required, sub_stage=sub_stage)
+        return
+
+    key = flight_key(llm, key, required)
+    flight, is_leader = _single_flight.join(key)
+    if not is_leader:
+        metrics.incr("llm_coalesce_followers")
+        print(f"DEBUG: {agent} joined in-flight generation {key[:12]}")
+        _dispatch(COALESCED_START_EVENT, {"agent": agent})
+        received = 0
+        abandoned = False
+        try:
+            for chunk in flight.subscribe():
+                if _cancelled():
+                    raise GenerationCancelled(agent)
+                received += 1
+                _dispatch(COALESCED_TOKEN_EVENT, {"content": chunk.content})
+                yield chunk
+        except LeaderAbandoned:
+            if received:
+                raise
+            abandoned = True
+        finally:
+            # 离开后领导者才能在自己被取消时关闭上游
+            _single_flight.unfollow(flight)
+        if abandoned:
+            # 还没收到任何内容，自己重新发起生成
+            yield from _stream_llm(llm, messages, agent, required, sub_stage)
+        return
+
+    metrics.incr("llm_coalesce_leaders")
+    try:
+        yield from _upstream(llm, messages, agent, flight, required, sub_stage)
+        flight.finish()
+    except BaseException as e:
+        flight.finish(error=_leader_error(e))
+        raise
+    finally:
+        _single_flight.leave(key, flight)
+
+
+async def astream_llm(llm, messages: List[BaseMessage], agent: str, required: Optional[List[str]] = None, sub_stage: Optional[str] = None) -> AsyncIterator:
+    """stream_llm 的异步版本"""
+    record = _CallRecord(agent)
+    async for chunk in _astream_llm(llm, messages, agent, required, sub_stage):
+        record.add(chunk)
+        yield chunk
+    record.finish()
+
+
+async def _astream_llm(llm, messages: List[BaseMessage], agent: str, required: Optional[List[str]] = None, sub_stage: Optional[str] = None) -> AsyncIterator:
+    key = prompt_key(llm, messages, agent)
+    run = _warmup_run.get()
+    cached = await _awarm(llm, messages, agent, key, run) if run else _cached_response(key)
+    if cached is not None:
+        await _adispatch(COALESCED_START_EVENT, {"agent": agent})
+        await _adispatch(COALESCED_TOKEN_EVENT, {"content": cached})
+        yield AIMessageChunk(content=cached)
+        return
+
+    if not COALESCE_ENABLED:
+        async for chunk in _aupstream(llm, messages, agent, required=required, sub_stage=sub_stage):
+            yield chunk
+        return
+
+    key = flight_key(llm, key, required)
+    flight, is_leader = _single_flight.join(key)
+    if not is_leader:
+        metrics.incr("llm_coalesce_followers")
+        print(f"DEBUG: {agent} joined in-flight generation {key[:12]}")
+        await _adispatch(COALESCED_START_EVENT, {"agent": agent})
+        received = 0
+        abandoned = False
+        try:
+            async for chunk in flight.asubscribe():
+                if _cancelled():
+                    raise GenerationCancelled(agent)
+                received += 1
+                await _adispatch(COALESCED_TOKEN_EVENT, {"content": chunk.content})
+                yield chunk
+        except LeaderAbandoned:
+            if received:
+                raise
+            abandoned = True
+        finally:
+            _single_flight.unfollow(flight)
+        if abandoned:
+            async for chunk in _astream_llm(llm, messages, agent, required, sub_stage):
+                yield chunk
+        return
+
+    metrics.incr("llm_coalesce_leaders")
+    try:
+        async for chunk in _aupstream(llm, messages, agent, flight, required, sub_stage):
+            yield chunk
+        flight.finish()
+    except BaseException as e:
+        flight.finish(error=_leader_error(e))
+        raise
+    finally:
+        _single_flight.leave(key, flight)
+
+
+def _merge_chunks(response, chunk):
+    return chunk if response is None else response + chunk
+
+
+def invoke_llm(llm, messages: List[BaseMessage], agent: str, required: Optional[List[str]] = None, sub_stage: Optional[str] = None):
+    """等价于 llm.invoke，但经过请求合并"""
+    response = None
+    for chunk in stream_llm(llm, messages, agent, required, sub_stage):
+        response = _merge_chunks(response, chunk)
+    return response if response is not None else AIMessage(content="")
+
+
+async def ainvoke_llm(llm, messages: List[BaseMessage], agent: str, required: Optional[List[str]] = None, sub_stage: Optional[str] = None):
+    """等价于 llm.ainvoke，但经过请求合并"""
+    response = None
+    async for chunk in astream_llm(llm, messages, agent, required, sub_stage):
+        response = _merge_chunks(response, chunk)
+    return response if response is not None else AIMessage(content="")
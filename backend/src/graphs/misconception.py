@@ -0,0 +1,193 @@
+import os
+import re
+import json
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from graphs.context_index import ngram_ids
+
+_BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+# 学生输入的常见误区识别：规则优先，其次是由对话日志训练的 n-gram 模型；设置 MISCONCEPTION=0 关闭
+MISCONCEPTION_ENABLED = os.getenv("MISCONCEPTION", "1") != "0"
+# 模型文件由 `python misconceptions.py train` 生成，不存在时只使用规则
+MISCONCEPTION_MODEL_PATH = os.getenv("MISCONCEPTION_MODEL_PATH", os.path.join(_BASE_DIR, "config", "misconception_model.npz"))
+# 审核过的固定回复与给模型的提示
+MISCONCEPTION_RESPONSES_PATH = os.path.join(_BASE_DIR, "config", "misconception_responses.json")
+# 模型判断的置信度达到该值才作为提示交给 LLM
+MISCONCEPTION_MIN_CONFIDENCE = float(os.getenv("MISCONCEPTION_MIN_CONFIDENCE", "0.8"))
+# 规则命中且配置了固定回复时直接使用固定回复，不调用 LLM；设置 MISCONCEPTION_CANNED=0 时只传提示
+MISCONCEPTION_CANNED = os.getenv("MISCONCEPTION_CANNED", "1") != "0"
+
+NONE = "none"
+LABELS = [NONE, "reversed_condition", "comparison_operator", "boundary_120", "missing_colon", "indentation"]
+# 哈希桶数：特征为字符 1/2-gram 的 crc32 对其取模
+MODEL_DIM = 1 << 16
+
+_NUM_120 = r"120\s*(?:cm|厘米)?"
+# 按顺序匹配，先命中的生效（如“大于等于120半价”算作条件写反）
+RULES: List[Tuple[str, re.Pattern]] = [
+    ("reversed_condition", re.compile(
+        rf"(?:大于|超过|高于|>=?|以上)\s*{_NUM_120}[^，。,.\n]{{0,10}}(?:半价|5\s*元|五元|儿童票)"
+        rf"|(?:小于|低于|不到|<=?|以下)\s*{_NUM_120}[^，。,.\n]{{0,10}}(?:全价|10\s*元|十元|成人票)"
+    )),
+    # 本课规则是“小于 120cm 半价”，正好 120cm 买全价；只有把 120 划进半价一边（<= 120 半价）才算用错了比较符，
+    # “>= 120 全价”是正确的写法
+    ("comparison_operator", re.compile(
+        rf"(?:<=|=<|小于等于|小于或等于|不大于|不超过)\s*{_NUM_120}\s*:?[^，。,.]{{0,20}}?(?:半价|5\s*元|五元|儿童票)"
+    )),
+    ("boundary_120", re.compile(rf"(?:正好|刚好|恰好|(?<![于或])等于|整)\s*{_NUM_120}|{_NUM_120}\s*(?:正好|刚好|恰好|整|算哪|算不算|的话算)")),
+    ("missing_colon", re.compile(
+        r"expected ':'"
+        r"|^\s*(?:if|elif|while)\s+[A-Za-z_][\w.()\[\]]*\s*(?:<=|>=|==|!=|<|>)\s*[\w.'\"]+\s*$",
+        re.M,
+    )),
+    ("indentation", re.compile(
+        r"indentationerror|expected an indented block|unexpected indent|unindent does not match"
+        r"|^([ \t]*)(?:if|elif|else|while|for)\b[^\n]*:[ \t]*\n\1(?![ \t])\S",
+        re.M,
+    )),
+]
+
+
+# 解释器报错的原文：学生贴出的是运行结果
+CODE_EVIDENCE = re.compile(r"syntaxerror|indentationerror|expected ':'|expected an indented block|unexpected indent", re.I)
+
+
+class Misconception:
+    """一次识别结果；source 为 rule 或 model，code 表示学生输入的是代码（或报错）而不是一句回答"""
+
+    def __init__(self, label: str, confidence: float, source: str, code: bool = False):
+        self.label = label
+        self.confidence = confidence
+        self.source = source
+        self.code = code
+
+
+def looks_like_code(text: str) -> bool:
+    """多行输入或带有解释器报错；单独一句 "else" 可能只是在回答“用哪个关键字”"""
+    lines = [line for line in (text or "").splitlines() if line.strip()]
+    return len(lines) > 1 or bool(CODE_EVIDENCE.search(text or ""))
+
+
+def match_rules(text: str) -> Optional[str]:
+    lowered = (text or "").lower()
+    for label, pattern in RULES:
+        if pattern.search(lowered):
+            return label
+    return None
+
+
+class NgramModel:
+    """多项式朴素贝叶斯，特征为字符 n-gram 的哈希桶计数"""
+
+    def __init__(self, labels: List[str], log_prior: np.ndarray, log_likelihood: np.ndarray):
+        self.labels = labels
+        self.log_prior = log_prior
+        self.log_likelihood = log_likelihood
+
+    @classmethod
+    def train(cls, texts: List[str], labels: List[str], dim: int = MODEL_DIM, alpha: float = 1.0) -> "NgramModel":
+        names = [label for label in LABELS if label in set(labels)]
+        index = {label: i for i, label in enumerate(names)}
+        counts = np.zeros((len(names), dim), dtype=np.float64)
+        docs = np.zeros(len(names), dtype=np.float64)
+        for text, label in zip(texts, labels):
+            np.add.at(counts[index[label]], ngram_ids(text) % dim, 1)
+            docs[index[label]] += 1
+        log_prior = np.log((docs + 1) / (docs.sum() + len(names)))
+        log_likelihood = np.log((counts + alpha) / (counts.sum(axis=1, keepdims=True) + alpha * dim))
+        return cls(names, log_prior.astype(np.float32), log_likelihood.astype(np.float32))
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        """返回 (标签, 置信度)"""
+        ids = ngram_ids(text) % self.log_likelihood.shape[1]
+        scores = self.log_prior + self.log_likelihood[:, ids].sum(axis=1)
+        probs = np.exp(scores - scores.max())
+        probs /= probs.sum()
+        best = int(probs.argmax())
+        return self.labels[best], float(probs[best])
+
+    def save(self, path: str) -> None:
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez_compressed(tmp_path, labels=np.array(self.labels), log_prior=self.log_prior, log_likelihood=self.log_likelihood)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "NgramModel":
+        with np.load(path) as data:
+            return cls([str(label) for label in data["labels"]], data["log_prior"], data["log_likelihood"])
+
+
+class MisconceptionClassifier:
+    """规则 + 模型；模型与固定回复在第一次使用时加载"""
+
+    def __init__(self, model_path: str = MISCONCEPTION_MODEL_PATH, responses_path: str = MISCONCEPTION_RESPONSES_PATH):
+        self.model_path = model_path
+        self.responses_path = responses_path
+        self._model: Optional[NgramModel] = None
+        self._responses: Optional[Dict[str, dict]] = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self) -> None:
+        with self._lock:
+            if self._loaded:
+                return
+            try:
+                self._model = NgramModel.load(self.model_path)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"WARNING: Failed to load misconception model: {e}")
+            with open(self.responses_path, "r", encoding="utf-8") as fd:
+                self._responses = json.load(fd)
+            self._loaded = True
+
+    @property
+    def model(self) -> Optional[NgramModel]:
+        self._load()
+        return self._model
+
+    def responses(self, label: str) -> dict:
+        self._load()
+        return self._responses.get(label, {})
+
+    def classify(self, text: str) -> Optional[Misconception]:
+        if not text or not text.strip():
+            return None
+        label = match_rules(text)
+        if label is not None:
+            return Misconception(label, 1.0, "rule", looks_like_code(text))
+        if self.model is None:
+            return None
+        label, confidence = self.model.predict(text)
+        if label == NONE or confidence < MISCONCEPTION_MIN_CONFIDENCE:
+            return None
+        return Misconception(label, confidence, "model", looks_like_code(text))
+
+
+classifier = MisconceptionClassifier()
+
+
+def classify(text: str) -> Optional[Misconception]:
+    if not MISCONCEPTION_ENABLED:
+        return None
+    return classifier.classify(text)
+
+
+def hint(result: Optional[Misconception]) -> str:
+    """写入提示词的一行误区提示；没有识别出误区时为空"""
+    if result is None:
+        return ""
+    return classifier.responses(result.label).get("hint", "")
+
+
+def canned_response(result: Optional[Misconception], agent: str, stage: str) -> Optional[str]:
+    """规则命中、学生输入的是代码，且该智能体在该阶段有审核过的回复时返回固定回复；
+    其余情况只把误区作为提示交给模型"""
+    if result is None or result.source != "rule" or not result.code or not MISCONCEPTION_CANNED:
+        return None
+    return classifier.responses(result.label).get("canned", {}).get(agent, {}).get(stage)
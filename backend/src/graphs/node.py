@@ -1,12 +1,10 @@
 import os
 import json
 import re
-import requests
 from typing import Dict, List, Union, Optional
 from jinja2 import Template
 from langchain_core.messages import SystemMessage, HumanMessage
 from langchain_core.runnables import RunnableConfig
-from langchain_openai import ChatOpenAI
 from dotenv import load_dotenv
 
 # 加载环境变量
@@ -28,9 +26,69 @@ from graphs.state import (
     MergeNodeInput,
     MergeNodeOutput,
 )
+from graphs.llm_stream import invoke_llm, ainvoke_llm, CONFIG_PARAMS_METADATA
+import token_ledger
+import metrics
+from graphs.output_stats import limits as output_limits
+from graphs.flowchart import CONCEPT_DIAGRAM, LESSON_DIAGRAM, code_to_mermaid
+from graphs.context_index import relevant_context
+from graphs.misconception import canned_response, classify as classify_misconception, hint as misconception_hint
 
 # LLM 实例缓存，避免重复初始化
 _llm_cache = {}
+# 设置后所有智能体都使用该模型实例（离线回放时替换为录制的回复）
+_llm_override = None
+
+def set_llm_override(llm) -> None:
+    """替换所有智能体使用的模型；传入 None 恢复按配置创建"""
+    global _llm_override
+    _llm_override = llm
+
+# 配置与模板缓存：配置文件只读一次，Jinja2 模板只编译一次
+CONFIG_BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+_cfg_cache = {}
+_template_cache = {}
+
+def load_cfg(llm_cfg: str) -> dict:
+    """读取智能体配置文件（相对 backend 目录的路径），结果缓存在进程内"""
+    cfg = _cfg_cache.get(llm_cfg)
+    if cfg is None:
+        cfg_file = os.path.join(CONFIG_BASE_DIR, llm_cfg)
+        with open(cfg_file, "r", encoding="utf-8") as fd:
+            cfg = json.load(fd)
+        _cfg_cache[llm_cfg] = cfg
+    return cfg
+
+def get_template(llm_cfg: str, field: str) -> Template:
+    """获取配置中某个提示词字段（sp/up）编译后的 Jinja2 模板"""
+    key = (llm_cfg, field)
+    template = _template_cache.get(key)
+    if template is None:
+        template = Template(load_cfg(llm_cfg).get(field, ""))
+        _template_cache[key] = template
+    return template
+
+# 提示词布局：系统提示词原样使用（不渲染任何变量），其后接本课任务材料，二者构成逐字节稳定的前缀，
+# 可以命中模型服务的前缀缓存；对话历史、状态、代码、学生输入等易变字段全部放在用户提示词末尾
+LESSON_HEADER = "\n\n# 本课任务\n"
+
+def build_messages(llm_cfg: str, lesson: str = "", fields: Optional[dict] = None) -> List[Union[SystemMessage, HumanMessage]]:
+    """按"稳定前缀 + 易变尾部"组装智能体的消息列表"""
+    system_prompt = load_cfg(llm_cfg).get("sp", "")
+    if lesson:
+        system_prompt += LESSON_HEADER + lesson
+    return [
+        SystemMessage(content=system_prompt),
+        HumanMessage(content=get_template(llm_cfg, "up").render(fields or {}))
+    ]
+
+def required_fields(cfg: dict, sub_stage: Optional[str] = None) -> List[str]:
+    """配置中声明的某个子阶段需要的输出字段（required_fields，按子阶段或 default）。
+
+    这些字段都收到后即结束生成，其余辅助字段不再等待；未声明时等到 JSON 对象闭合为止。
+    """
+    declared = cfg.get("required_fields") or {}
+    return declared.get(sub_stage) or declared.get("default") or []
 
 def _generate_image(prompt: str) -> Optional[str]:
     """使用 SiliconFlow 的 Kolors 模型生成图片"""
@@ -57,6 +115,7 @@ def _generate_image(prompt: str) -> Optional[str]:
     }
     
     try:
+        import requests
         response = requests.post(api_base, json=payload, headers=headers, timeout=30)
         response.raise_for_status()
         data = response.json()
@@ -69,24 +128,48 @@ def _generate_image(prompt: str) -> Optional[str]:
         
     return None
 
-def _get_llm(cfg_config: dict):
-    """根据配置初始化 LLM，强制使用环境变量中的模型"""
+def _get_llm(cfg_config: dict, agent: Optional[str] = None, sub_stage: Optional[str] = None):
+    """根据配置初始化 LLM，强制使用环境变量中的模型。
+
+    传入 agent / sub_stage 时，max_tokens 与超时按该子阶段实际输出长度与耗时的统计收紧。
+    """
+    if _llm_override is not None:
+        return _llm_override
     # 强制从环境变量读取模型，如果环境变量没设，才看配置文件，最后保底
     model = os.getenv("LLM_MODEL") or cfg_config.get("model") or "Qwen/Qwen3-8B"
     
     temp = cfg_config.get("temperature", 0.7)
-    max_tokens = cfg_config.get("max_completion_tokens", 4000)
-    
-    cache_key = f"{model}_{temp}_{max_tokens}"
+    top_p = cfg_config.get("top_p")
+    configured_max_tokens = cfg_config.get("max_completion_tokens", 4000)
+    # 响应缓存按配置级参数区分请求，不受下面按输出统计收紧的 max_tokens 影响
+    config_params = {"model": model, "temperature": temp, "top_p": top_p, "max_tokens": configured_max_tokens}
+    max_tokens, timeout = output_limits(agent, sub_stage, configured_max_tokens, cfg_config.get("timeout"))
+    
+    # 当前学生或班级超出 token 预算时换用便宜的模型、缩短输出；这些请求不与正常请求共用缓存与合并
+    limits = token_ledger.current_limits()
+    if limits is not None:
+        model = limits.model or model
+        max_tokens = min(max_tokens, limits.max_tokens)
+        config_params = {**config_params, "model": model, "max_tokens": min(configured_max_tokens, limits.max_tokens)}
+    
+    cache_key = f"{model}_{temp}_{top_p}_{max_tokens}_{timeout}_{config_params['model']}_{config_params['max_tokens']}"
     if cache_key in _llm_cache:
         return _llm_cache[cache_key]
     
+    # langchain_openai 导入较慢（约 1.5s），推迟到第一次真正需要模型时，缩短冷启动
+    from langchain_openai import ChatOpenAI
     llm = ChatOpenAI(
         model=model,
         temperature=temp,
+        top_p=top_p,
         max_tokens=max_tokens,
+        # 既是 HTTP 超时，也是 llm_stream 中整次生成的时限
+        timeout=timeout,
         api_key=os.getenv("OPENAI_API_KEY"),
-        base_url=os.getenv("OPENAI_API_BASE")
+        base_url=os.getenv("OPENAI_API_BASE"),
+        # 流式响应的最后一个 chunk 带上 usage（含 cached_tokens），用于统计前缀缓存命中率
+        stream_usage=True,
+        metadata={CONFIG_PARAMS_METADATA: config_params},
     )
     _llm_cache[cache_key] = llm
     return llm
@@ -126,37 +209,22 @@ def agent_a_scenario_node(state: AgentAInput, config: RunnableConfig) -> AgentAO
         return AgentAOutput()
     
     # 读取配置文件
-    base_dir = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
-    cfg_file = os.path.join(base_dir, config["metadata"]["llm_cfg"])
-    with open(cfg_file, "r", encoding="utf-8") as fd:
-        cfg = json.load(fd)
+    cfg = load_cfg(config["metadata"]["llm_cfg"])
     
-    llm = _get_llm(cfg.get("config", {}))
+    llm = _get_llm(cfg.get("config", {}), "agent_a", state.agent_a_sub_stage)
     
-    # 使用 Jinja2 渲染用户提示词
-    up_template = Template(cfg.get("up", ""))
-    user_prompt_content = up_template.render({
+    # turn_count 随用户提示词放在末尾，系统提示词保持不变
+    messages = build_messages(config["metadata"]["llm_cfg"], state.current_task, {
         "stage": state.stage,
         "sub_stage": state.agent_a_sub_stage,
         "user_input": state.user_input,
-        "context": state.context,
-        "current_task": state.current_task,
-        "turn_count": state.agent_a_turn_count
-    })
-    
-    # 将 turn_count 也放入系统提示词中渲染（如果有的话）
-    sp_template = Template(cfg.get("sp", ""))
-    sp_content = sp_template.render({
-        "turn_count": state.agent_a_turn_count
+        "context": relevant_context(state.context, state.user_input, state.current_task),
+        "turn_count": state.agent_a_turn_count,
+        "misconception": misconception_hint(classify_misconception(state.user_input))
     })
-    
-    messages = [
-        SystemMessage(content=sp_content),
-        HumanMessage(content=user_prompt_content)
-    ]
-    
+
     try:
-        response = llm.invoke(messages)
+        response = invoke_llm(llm, messages, "agent_a", required_fields(cfg, state.agent_a_sub_stage), state.agent_a_sub_stage)
     except Exception as e:
         print(f"ERROR: LLM invocation failed: {str(e)}")
         raise e
@@ -194,28 +262,31 @@ def agent_b_logic_node(state: AgentBInput, config: RunnableConfig) -> AgentBOutp
         print(f"DEBUG: agent_b_logic_node early return due to stage: {state.stage}")
         return AgentBOutput()
     
-    base_dir = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
-    cfg_file = os.path.join(base_dir, config["metadata"]["llm_cfg"])
-    with open(cfg_file, "r", encoding="utf-8") as fd:
-        cfg = json.load(fd)
+    cfg = load_cfg(config["metadata"]["llm_cfg"])
+
+    # 常见误区由本地分类器识别：规则命中且有审核过的回复时直接返回，否则作为提示交给模型
+    misconception = classify_misconception(state.user_input)
+    canned = canned_response(misconception, "agent_b", state.stage)
+    if canned:
+        print(f"DEBUG: Agent B serving canned response for misconception {misconception.label}")
+        metrics.incr(f"misconception_canned_{misconception.label}")
+        return AgentBOutput(
+            agent_b_response=canned,
+            agent_b_concept_diagram=CONCEPT_DIAGRAM if state.stage == "knowledge" else "",
+            agent_b_correction_feedback=canned
+        )
     
-    llm = _get_llm(cfg.get("config", {}))
+    llm = _get_llm(cfg.get("config", {}), "agent_b", state.stage)
     
-    up_template = Template(cfg.get("up", ""))
-    user_prompt_content = up_template.render({
+    messages = build_messages(config["metadata"]["llm_cfg"], state.current_task, {
         "stage": state.stage,
         "user_input": state.user_input,
-        "context": state.context,
-        "current_task": state.current_task
+        "context": relevant_context(state.context, state.user_input, state.current_task),
+        "misconception": misconception_hint(misconception)
     })
-    
-    messages = [
-        SystemMessage(content=cfg.get("sp", "")),
-        HumanMessage(content=user_prompt_content)
-    ]
-    
+
     try:
-        response = llm.invoke(messages)
+        response = invoke_llm(llm, messages, "agent_b", required_fields(cfg), state.stage)
     except Exception as e:
         print(f"ERROR: Agent B LLM invocation failed: {str(e)}")
         raise e
@@ -233,14 +304,7 @@ def agent_b_logic_node(state: AgentBInput, config: RunnableConfig) -> AgentBOutp
         
         # 强制使用硬编码的核心知识点图，满足“只体现核心知识点，不体现分支流程也不体现整节课的内容”
         if state.stage == "knowledge":
-            concept_diagram = """graph TD
-    Root[Python双分支结构] --> Concept{核心概念}
-    Concept --> |互斥| Choice[二选一]
-    Concept --> |逻辑| Logic[条件判断]
-    Root --> Syntax{语法规则}
-    Syntax --> KW[if-else关键字]
-    Syntax --> Colon[冒号 :]
-    Syntax --> Indent[缩进]"""
+            concept_diagram = CONCEPT_DIAGRAM
         else:
             concept_diagram = result_json.get("concept_diagram", "")
 
@@ -277,32 +341,23 @@ def agent_c_coding_node(state: AgentCInput, config: RunnableConfig) -> AgentCOut
     if state.stage not in ["logic", "coding"]:
         return AgentCOutput()
     
-    base_dir = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
-    cfg_file = os.path.join(base_dir, config["metadata"]["llm_cfg"])
-    with open(cfg_file, "r", encoding="utf-8") as fd:
-        cfg = json.load(fd)
+    cfg = load_cfg(config["metadata"]["llm_cfg"])
     
-    llm = _get_llm(cfg.get("config", {}))
+    llm = _get_llm(cfg.get("config", {}), "agent_c", state.agent_c_sub_stage)
     
     # 渲染用户提示词，包含子阶段和 POE 状态
-    up_template = Template(cfg.get("up", ""))
-    user_prompt_content = up_template.render({
+    messages = build_messages(config["metadata"]["llm_cfg"], state.current_task, {
         "stage": state.stage,
         "sub_stage": state.agent_c_sub_stage,
         "poe_state": state.agent_c_poe_state,
         "current_code": state.agent_c_current_code,
+        "execution_trace": state.agent_c_execution_trace or "（尚未运行）",
         "user_input": state.user_input,
-        "context": state.context,
-        "current_task": state.current_task
+        "context": relevant_context(state.context, state.user_input, state.current_task)
     })
-    
-    messages = [
-        SystemMessage(content=cfg.get("sp", "")),
-        HumanMessage(content=user_prompt_content)
-    ]
-    
+
     try:
-        response = llm.invoke(messages)
+        response = invoke_llm(llm, messages, "agent_c", required_fields(cfg, state.agent_c_sub_stage), state.agent_c_sub_stage)
     except Exception as e:
         print(f"ERROR: Agent C LLM invocation failed: {str(e)}")
         raise e
@@ -311,13 +366,17 @@ def agent_c_coding_node(state: AgentCInput, config: RunnableConfig) -> AgentCOut
     result_json = _extract_json(response_text)
     
     if result_json and "response" in result_json:
+        # 学生已经写了代码时，流程图直接由代码生成（保证语法正确），模型的流程图只在 flowchart 子阶段使用
+        flowchart_code = result_json.get("flowchart_code", "")
+        if state.agent_c_sub_stage != "flowchart":
+            flowchart_code = code_to_mermaid(state.agent_c_current_code) or flowchart_code
         return AgentCOutput(
             agent_c_response=result_json.get("response", ""),
             agent_c_code_template=result_json.get("code_template", ""),
             agent_c_syntax_errors=result_json.get("syntax_errors", []),
             agent_c_poe_questions=result_json.get("poe_questions", []),
             agent_c_execution_feedback=result_json.get("execution_feedback", ""),
-            agent_c_flowchart_code=result_json.get("flowchart_code", ""),
+            agent_c_flowchart_code=flowchart_code,
             agent_c_sub_stage=result_json.get("sub_stage", state.agent_c_sub_stage),
             agent_c_poe_state=result_json.get("poe_state", state.agent_c_poe_state)
         )
@@ -331,6 +390,7 @@ def agent_c_coding_node(state: AgentCInput, config: RunnableConfig) -> AgentCOut
                 clean_text = match.group(1).replace('\\"', '"').replace('\\n', '\n')
         return AgentCOutput(
             agent_c_response=clean_text,
+            agent_c_flowchart_code=(code_to_mermaid(state.agent_c_current_code) or "") if state.agent_c_sub_stage != "flowchart" else "",
             agent_c_sub_stage=state.agent_c_sub_stage,
             agent_c_poe_state=state.agent_c_poe_state
         )
@@ -340,12 +400,9 @@ def agent_d_assessment_node(state: AgentDInput, config: RunnableConfig) -> Agent
     if state.stage != "assessment":
         return AgentDOutput()
     
-    base_dir = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
-    cfg_file = os.path.join(base_dir, config["metadata"]["llm_cfg"])
-    with open(cfg_file, "r", encoding="utf-8") as fd:
-        cfg = json.load(fd)
+    cfg = load_cfg(config["metadata"]["llm_cfg"])
     
-    llm = _get_llm(cfg.get("config", {}))
+    llm = _get_llm(cfg.get("config", {}), "agent_d", state.agent_d_reflection_sub_stage)
     
     # 优先使用 explicit code (agent_c_current_code), 
     # 如果为空，尝试从 user_input 中提取代码块作为 fallback
@@ -359,22 +416,15 @@ def agent_d_assessment_node(state: AgentDInput, config: RunnableConfig) -> Agent
     print(f"DEBUG: Agent D assessment. Code length: {len(current_code) if current_code else 0}")
     print(f"DEBUG: Agent D current code snippet: {current_code[:50] if current_code else 'None'}...")
     
-    up_template = Template(cfg.get("up", ""))
-    user_prompt_content = up_template.render({
+    messages = build_messages(config["metadata"]["llm_cfg"], state.current_task, {
         "stage": state.stage,
         "sub_stage": state.agent_d_reflection_sub_stage,
         "current_code": current_code,  # Use the resolved current_code
         "user_input": state.user_input,
-        "context": state.context,
-        "current_task": state.current_task
+        "context": relevant_context(state.context, state.user_input, state.current_task)
     })
-    
-    messages = [
-        SystemMessage(content=cfg.get("sp", "")),
-        HumanMessage(content=user_prompt_content)
-    ]
-    
-    response = llm.invoke(messages)
+
+    response = invoke_llm(llm, messages, "agent_d", required_fields(cfg, state.agent_d_reflection_sub_stage), state.agent_d_reflection_sub_stage)
     response_text = _get_text_content(response)
     print(f"DEBUG: Agent D raw response: {response_text[:200]}...")
     
@@ -401,12 +451,7 @@ async def agent_e_transfer_node(state: AgentEInput, config: RunnableConfig) -> A
     if state.stage != "transfer":
         return AgentEOutput()
     
-    base_dir = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
-    cfg_file = os.path.join(base_dir, config["metadata"]["llm_cfg"])
-    with open(cfg_file, "r", encoding="utf-8") as fd:
-        cfg = json.load(fd)
-    
-    llm = _get_llm(cfg.get("config", {}))
+    cfg = load_cfg(config["metadata"]["llm_cfg"])
     
     current_sub_stage = state.agent_e_sub_stage or "intro"
     quiz_index = state.agent_e_quiz_index or 0
@@ -460,24 +505,18 @@ async def agent_e_transfer_node(state: AgentEInput, config: RunnableConfig) -> A
         if verification_msg:
             current_code = (current_code or "") + verification_msg
     
-    up_template = Template(cfg.get("up", ""))
-    user_prompt_content = up_template.render({
+    messages = build_messages(config["metadata"]["llm_cfg"], state.current_task, {
         "stage": state.stage,
         "sub_stage": current_sub_stage,
         "current_quiz": current_quiz_str,
         "user_input": state.user_input,
         "current_code": current_code,
-        "context": state.context,
-        "current_task": state.current_task
+        "context": relevant_context(state.context, state.user_input, state.current_task)
     })
-    
-    messages = [
-        SystemMessage(content=cfg.get("sp", "")),
-        HumanMessage(content=user_prompt_content)
-    ]
-    
+
+    llm = _get_llm(cfg.get("config", {}), "agent_e", current_sub_stage)
     print(f"DEBUG: Agent E invoking LLM. current_sub_stage={current_sub_stage}")
-    response = await llm.ainvoke(messages)
+    response = await ainvoke_llm(llm, messages, "agent_e", required_fields(cfg, current_sub_stage), current_sub_stage)
     response_text = _get_text_content(response)
     print(f"DEBUG: Agent E LLM raw response: {response_text[:200]}...")
     
@@ -579,17 +618,10 @@ def merge_results_node(state: MergeNodeInput, config: RunnableConfig) -> MergeNo
         final_concept_diagram = ""
     # 在 knowledge 及之后的阶段，确保概念图始终存在（防止被覆盖或丢失）
     elif not final_concept_diagram:
-        final_concept_diagram = """graph TD
-    Root[Python双分支结构] --> Concept{核心概念}
-    Concept --> |互斥| Choice[二选一]
-    Concept --> |逻辑| Logic[条件判断]
-    Root --> Syntax{语法规则}
-    Syntax --> KW[if-else关键字]
-    Syntax --> Colon[冒号 :]
-    Syntax --> Indent[缩进]"""
+        final_concept_diagram = CONCEPT_DIAGRAM
         
     if stage == "transfer" and state.agent_e_sub_stage == "summary":
-        final_concept_diagram = "graph TD\n    Root[Python双分支结构] --> Concept{核心概念}\n    Concept --> |互斥| Choice[二选一]\n    Concept --> |逻辑| Logic[条件判断]\n    Root --> Syntax{语法规则}\n    Syntax --> KW[if-else关键字]\n    Syntax --> Colon[冒号 :]\n    Syntax --> Indent[缩进]\n    Root --> App{应用场景}\n    App --> Ticket[公园购票]\n    App --> Weather[气象站报警]"
+        final_concept_diagram = LESSON_DIAGRAM
 
     return MergeNodeOutput(
         active_agent_response=active_response,
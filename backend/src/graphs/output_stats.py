@@ -0,0 +1,138 @@
+import os
+import json
+import math
+import time
+import threading
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+import metrics
+
+# 按 (智能体, 子阶段) 统计实际输出长度与耗时，据此收紧 max_tokens 与生成时限；设置 ADAPTIVE_LIMITS=0 关闭
+ADAPTIVE_LIMITS_ENABLED = os.getenv("ADAPTIVE_LIMITS", "1") != "0"
+# 每个 (智能体, 子阶段) 保留最近多少次调用
+ADAPTIVE_WINDOW = int(os.getenv("ADAPTIVE_WINDOW", "500"))
+# 样本数达到该值后才开始收紧，之前沿用配置中的上限
+ADAPTIVE_MIN_SAMPLES = int(os.getenv("ADAPTIVE_MIN_SAMPLES", "20"))
+ADAPTIVE_PERCENTILE = float(os.getenv("ADAPTIVE_PERCENTILE", "99"))
+# 上限 = 分位数 × 余量，且不低于下限
+ADAPTIVE_HEADROOM = float(os.getenv("ADAPTIVE_HEADROOM", "1.5"))
+ADAPTIVE_MIN_TOKENS = int(os.getenv("ADAPTIVE_MIN_TOKENS", "512"))
+ADAPTIVE_MIN_DEADLINE_SECONDS = float(os.getenv("ADAPTIVE_MIN_DEADLINE_SECONDS", "15"))
+# 统计快照的保存位置与间隔（秒），重启后继续使用
+ADAPTIVE_STATS_PATH = os.getenv("ADAPTIVE_STATS_PATH", "/tmp/mcast_llm_output_stats.json")
+ADAPTIVE_SAVE_SECONDS = float(os.getenv("ADAPTIVE_SAVE_SECONDS", "30"))
+
+# max_tokens 按该粒度向上取整，避免每次得到不同的值而重复创建模型客户端
+TOKENS_ROUNDING = 128
+DEADLINE_ROUNDING = 5
+
+
+def percentile(values, q: float) -> float:
+    """最近邻插值的分位数（q 取 0-100）"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(math.ceil(q / 100 * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class OutputStats:
+    """各 (智能体, 子阶段) 最近若干次生成的输出 token 数与耗时（秒）"""
+
+    def __init__(self, path: str = ADAPTIVE_STATS_PATH, window: int = ADAPTIVE_WINDOW):
+        self.path = path
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples: Optional[Dict[Tuple[str, str], Deque[Tuple[int, float]]]] = None
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    def _load(self) -> Dict[Tuple[str, str], Deque[Tuple[int, float]]]:
+        if self._samples is None:
+            self._samples = {}
+            try:
+                with open(self.path, "r", encoding="utf-8") as fd:
+                    for entry in json.load(fd):
+                        key = (entry["agent"], entry["sub_stage"])
+                        self._samples[key] = deque(
+                            ((int(tokens), float(seconds)) for tokens, seconds in entry["samples"]),
+                            maxlen=self.window,
+                        )
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"WARNING: Failed to load LLM output stats: {e}")
+        return self._samples
+
+    def record(self, agent: str, sub_stage: Optional[str], tokens: int, seconds: float) -> None:
+        if not ADAPTIVE_LIMITS_ENABLED:
+            return
+        with self._lock:
+            samples = self._load().setdefault((agent, sub_stage or ""), deque(maxlen=self.window))
+            samples.append((tokens, round(seconds, 3)))
+            self._dirty = True
+            due = time.monotonic() - self._saved_at >= ADAPTIVE_SAVE_SECONDS
+        if due:
+            self.save()
+
+    def save(self) -> None:
+        """原子地写入快照（先写临时文件再替换）"""
+        with self._lock:
+            if not self._dirty:
+                return
+            payload = [
+                {"agent": agent, "sub_stage": sub_stage, "samples": list(samples)}
+                for (agent, sub_stage), samples in self._load().items()
+            ]
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as fd:
+                json.dump(payload, fd)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"WARNING: Failed to save LLM output stats: {e}")
+
+    def envelope(self, agent: str, sub_stage: Optional[str]) -> Optional[Tuple[int, float]]:
+        """样本足够时返回 (max_tokens, 生成时限秒数)，否则返回 None"""
+        with self._lock:
+            samples = list(self._load().get((agent, sub_stage or ""), ()))
+        if len(samples) < ADAPTIVE_MIN_SAMPLES:
+            return None
+        tokens = percentile([s[0] for s in samples], ADAPTIVE_PERCENTILE) * ADAPTIVE_HEADROOM
+        seconds = percentile([s[1] for s in samples], ADAPTIVE_PERCENTILE) * ADAPTIVE_HEADROOM
+        max_tokens = max(math.ceil(tokens / TOKENS_ROUNDING) * TOKENS_ROUNDING, ADAPTIVE_MIN_TOKENS)
+        deadline = math.ceil(max(seconds, ADAPTIVE_MIN_DEADLINE_SECONDS) / DEADLINE_ROUNDING) * DEADLINE_ROUNDING
+        return max_tokens, deadline
+
+    def summary(self) -> Dict[str, dict]:
+        with self._lock:
+            items = [(key, list(samples)) for key, samples in self._load().items()]
+        result = {}
+        for (agent, sub_stage), samples in items:
+            result[f"{agent}:{sub_stage}"] = {
+                "samples": len(samples),
+                "tokens_p50": percentile([s[0] for s in samples], 50),
+                "tokens_p99": percentile([s[0] for s in samples], 99),
+                "seconds_p50": percentile([s[1] for s in samples], 50),
+                "seconds_p99": percentile([s[1] for s in samples], 99),
+            }
+        return result
+
+
+output_stats = OutputStats()
+
+
+def limits(agent: Optional[str], sub_stage: Optional[str], max_tokens: int, timeout: Optional[float]) -> Tuple[int, Optional[float]]:
+    """在配置的上限之内，按统计收紧 max_tokens 与生成时限"""
+    if not ADAPTIVE_LIMITS_ENABLED or agent is None:
+        return max_tokens, timeout
+    envelope = output_stats.envelope(agent, sub_stage)
+    if envelope is None:
+        return max_tokens, timeout
+    adaptive_tokens, adaptive_seconds = envelope
+    if adaptive_tokens < max_tokens:
+        metrics.incr("adaptive_max_tokens_applied")
+    return min(max_tokens, adaptive_tokens), min(timeout, adaptive_seconds) if timeout else adaptive_seconds
@@ -0,0 +1,104 @@
+import os
+import time
+import sqlite3
+import threading
+import itertools
+from typing import Dict, List, Optional
+
+# 课前预热生成的回复变体缓存（SQLite 持久化，进程内只读镜像）
+# Vercel 上只有 /tmp 可写；多实例部署时可指向共享卷
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "/tmp/mcast_response_cache.sqlite3")
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE", "1") != "0"
+# 多 worker 时其他进程（或 warmup 脚本）可能写入新的变体；至多每隔这么多秒检查一次文件是否有变化
+RESPONSE_CACHE_REFRESH_SECONDS = float(os.getenv("RESPONSE_CACHE_REFRESH_SECONDS", "5"))
+
+
+class ResponseCache:
+    """按 prompt key 存储若干条回复变体，命中时轮流返回"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._variants: Optional[Dict[str, List[str]]] = None
+        self._cursors: Dict[str, itertools.count] = {}
+        self._data_version: Optional[int] = None
+        self._checked_at = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS response_variants ("
+                " key TEXT NOT NULL,"
+                " variant INTEGER NOT NULL,"
+                " agent TEXT,"
+                " content TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " PRIMARY KEY (key, variant))"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def _stale(self) -> bool:
+        """其他连接提交过写入时 data_version 会变化"""
+        now = time.monotonic()
+        if now - self._checked_at < RESPONSE_CACHE_REFRESH_SECONDS:
+            return False
+        self._checked_at = now
+        version = self._connect().execute("PRAGMA data_version").fetchone()[0]
+        changed = version != self._data_version
+        self._data_version = version
+        return changed
+
+    def _load(self) -> Dict[str, List[str]]:
+        # 首次访问时把整个缓存读入内存，之后只在文件被其他进程修改后重新读取
+        if self._variants is None or self._stale():
+            variants: Dict[str, List[str]] = {}
+            rows = self._connect().execute(
+                "SELECT key, content FROM response_variants ORDER BY key, variant"
+            )
+            for key, content in rows:
+                variants.setdefault(key, []).append(content)
+            self._variants = variants
+            self._data_version = self._connect().execute("PRAGMA data_version").fetchone()[0]
+            self._checked_at = time.monotonic()
+        return self._variants
+
+    def count(self, key: str) -> int:
+        with self._lock:
+            return len(self._load().get(key, []))
+
+    def get(self, key: str) -> Optional[str]:
+        """返回 key 的下一条回复变体，没有则返回 None"""
+        with self._lock:
+            variants = self._load().get(key)
+            if not variants:
+                return None
+            cursor = self._cursors.setdefault(key, itertools.count())
+            return variants[next(cursor) % len(variants)]
+
+    def add(self, key: str, agent: str, content: str) -> None:
+        with self._lock:
+            variants = self._load().setdefault(key, [])
+            conn = self._connect()
+            # 编号在写事务内取，多个进程同时预热同一个 key 时不会冲突
+            conn.execute(
+                "INSERT INTO response_variants (key, variant, agent, content, created_at) VALUES"
+                " (?, (SELECT COALESCE(MAX(variant), -1) + 1 FROM response_variants WHERE key = ?), ?, ?, ?)",
+                (key, key, agent, content, time.time()),
+            )
+            conn.commit()
+            variants.append(content)
+
+    def clear(self) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM response_variants")
+            conn.commit()
+            self._variants = {}
+            self._cursors = {}
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_PATH)
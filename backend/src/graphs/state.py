@@ -36,6 +36,7 @@ class GlobalState(BaseModel):
     agent_c_syntax_errors: List[str] = Field(default=[], description="检测到的语法错误列表")
     agent_c_poe_questions: List[str] = Field(default=[], description="预测-观察-解释引导问题")
     agent_c_execution_feedback: str = Field(default="", description="执行反馈")
+    agent_c_execution_trace: str = Field(default="", description="最近一次运行的执行轨迹（精简文本）")
     agent_c_flowchart_code: str = Field(default="", description="Agent C 生成的流程图代码")
     agent_c_sub_stage: str = Field(default="flowchart", description="Agent C 内部子阶段：flowchart/coding/debugging")
     agent_c_poe_state: str = Field(default="none", description="POE 状态：none/predict/observe/explain")
@@ -67,6 +68,7 @@ class GraphInput(BaseModel):
     agent_c_sub_stage: Optional[str] = None
     agent_c_poe_state: Optional[str] = None
     agent_c_current_code: Optional[str] = None
+    agent_c_execution_trace: Optional[str] = None
     agent_d_reflection_sub_stage: Optional[str] = None
     agent_e_sub_stage: Optional[str] = None
     agent_e_quiz_index: Optional[int] = None
@@ -134,6 +136,7 @@ class AgentCInput(BaseModel):
     agent_c_sub_stage: str
     agent_c_poe_state: str
     agent_c_current_code: str
+    agent_c_execution_trace: str = ""
 
 class AgentCOutput(BaseModel):
     agent_c_response: str = ""
@@ -0,0 +1,294 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from pydantic import BaseModel
+
+import metrics
+
+# 客户端超时重试时带上相同的 Idempotency-Key：第一次请求真正执行，并发的重复请求等待同一结果，
+# TTL 内之后的重复请求直接返回保存的响应（不再运行 graph / 解释器，也不重复写日志）
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "600"))
+# memory：进程内；sqlite：多个进程共享同一个文件（Vercel 上只有 /tmp 可写）
+IDEMPOTENCY_STORE = os.getenv("IDEMPOTENCY_STORE", "memory")
+IDEMPOTENCY_DB_PATH = os.getenv("IDEMPOTENCY_DB_PATH", "/tmp/mcast_idempotency.sqlite3")
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+# 执行前先在存储中占位；占位的 worker 异常退出时，这么多秒后其他请求可以重新执行
+IDEMPOTENCY_CLAIM_SECONDS = float(os.getenv("IDEMPOTENCY_CLAIM_SECONDS", "300"))
+# 同一 key 正在另一个 worker 上执行时，隔多少秒查看一次结果
+IDEMPOTENCY_POLL_SECONDS = float(os.getenv("IDEMPOTENCY_POLL_SECONDS", "0.2"))
+
+
+class IdempotencyConflict(Exception):
+    """同一个 Idempotency-Key 被用于内容不同的请求"""
+
+
+def fingerprint(request: BaseModel) -> str:
+    return hashlib.sha256(request.model_dump_json().encode("utf-8")).hexdigest()
+
+
+class MemoryStore:
+    """进程内保存已完成请求的响应，按 TTL 和条数淘汰。
+
+    响应为 None 的条目是占位：该请求正在执行。
+    """
+
+    def __init__(self, max_entries: int = IDEMPOTENCY_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Tuple[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, request_hash, response = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            return request_hash, response
+
+    def put(self, key: str, request_hash: str, response: Any, ttl: float = IDEMPOTENCY_TTL_SECONDS) -> None:
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, request_hash, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def claim(self, key: str, request_hash: str, ttl: float = IDEMPOTENCY_CLAIM_SECONDS) -> Optional[Tuple[str, Any]]:
+        """没有有效条目时写入占位并返回 None（由调用方执行）；否则返回已有的条目"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] >= time.time():
+                return entry[1], entry[2]
+            self._entries[key] = (time.time() + ttl, request_hash, None)
+            self._entries.move_to_end(key)
+            return None
+
+    def release(self, key: str) -> None:
+        """执行失败或被取消：删除占位，重试时重新执行"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is None:
+                del self._entries[key]
+
+
+class SqliteStore:
+    """SQLite 持久化的响应存储，同一台机器上的多个 worker 共享。
+
+    占位行的 response 为空字符串：靠主键上的 INSERT OR IGNORE，多个 worker 中只有一个能占到同一 key。
+    各方法都是阻塞调用，异步代码中放到线程池执行。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS idempotency ("
+                " key TEXT PRIMARY KEY,"
+                " request_hash TEXT NOT NULL,"
+                " response TEXT NOT NULL,"
+                " expires_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_idempotency_expires ON idempotency (expires_at)")
+            self._conn.commit()
+        return self._conn
+
+    def get(self, key: str) -> Optional[Tuple[str, Any]]:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT request_hash, response FROM idempotency WHERE key = ? AND expires_at >= ?",
+                (key, time.time()),
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]) if row[1] else None
+
+    def put(self, key: str, request_hash: str, response: Any, ttl: float = IDEMPOTENCY_TTL_SECONDS) -> None:
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM idempotency WHERE expires_at < ?", (now,))
+            conn.execute(
+                "INSERT OR REPLACE INTO idempotency (key, request_hash, response, expires_at) VALUES (?, ?, ?, ?)",
+                (key, request_hash, json.dumps(response, ensure_ascii=False, default=str), now + ttl),
+            )
+            conn.commit()
+
+    def claim(self, key: str, request_hash: str, ttl: float = IDEMPOTENCY_CLAIM_SECONDS) -> Optional[Tuple[str, Any]]:
+        with self._lock:
+            conn = self._connect()
+            while True:
+                now = time.time()
+                conn.execute("DELETE FROM idempotency WHERE expires_at < ?", (now,))
+                inserted = conn.execute(
+                    "INSERT OR IGNORE INTO idempotency (key, request_hash, response, expires_at) VALUES (?, ?, '', ?)",
+                    (key, request_hash, now + ttl),
+                ).rowcount
+                conn.commit()
+                if inserted:
+                    return None
+                row = conn.execute("SELECT request_hash, response FROM idempotency WHERE key = ?", (key,)).fetchone()
+                # 行为 None：占位恰好被另一个 worker 释放，重新占位
+                if row is not None:
+                    return row[0], json.loads(row[1]) if row[1] else None
+
+    def release(self, key: str) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM idempotency WHERE key = ? AND response = ''", (key,))
+            conn.commit()
+
+
+store = SqliteStore(IDEMPOTENCY_DB_PATH) if IDEMPOTENCY_STORE == "sqlite" else MemoryStore()
+
+# 本进程中正在执行的请求：key -> (请求指纹, 结果 future 或对话流缓冲)。
+# 其他 worker 上正在执行的请求只能从存储中的占位得知，轮询等待其结果
+_inflight: Dict[str, Tuple[str, Any]] = {}
+
+
+def _check(key: str, request_hash: str, expected: str) -> None:
+    if request_hash != expected:
+        metrics.incr("idempotency_conflicts")
+        raise IdempotencyConflict(f"Idempotency-Key {key!r} was already used for a different request")
+
+
+async def _claim(key: str, request_hash: str) -> Optional[Any]:
+    """占到 key 时返回 None；否则等到其他 worker 执行完成，返回保存的响应。
+    对方失败或被取消（占位被删除）时由当前请求占位执行"""
+    joined = False
+    while True:
+        claim = asyncio.ensure_future(asyncio.to_thread(store.claim, key, request_hash))
+        try:
+            entry = await asyncio.shield(claim)
+        except asyncio.CancelledError:
+            # 线程中的占位仍会完成；占到了就释放，免得重试要等占位过期
+            claim.add_done_callback(lambda t: t.cancelled() or t.exception() or t.result() is not None or _release(key))
+            raise
+        if entry is None:
+            return None
+        _check(key, request_hash, entry[0])
+        if entry[1] is not None:
+            metrics.incr("idempotency_replayed")
+            return entry[1]
+        if not joined:
+            joined = True
+            metrics.incr("idempotency_joined_remote")
+        await asyncio.sleep(IDEMPOTENCY_POLL_SECONDS)
+
+
+def _release(key: str) -> None:
+    # 在取消路径上调用，不等待写入完成
+    asyncio.get_running_loop().run_in_executor(None, store.release, key)
+
+
+async def run_once(scope: str, key: str, request_hash: str, compute: Callable[[], Awaitable[dict]]) -> dict:
+    """同一 key 只执行一次 compute；结果必须可以 JSON 序列化。失败或被取消的请求不保存，重试时重新执行"""
+    key = f"{scope}:{key}"
+    joined = await _join(key, request_hash)
+    if joined is not None:
+        return joined
+
+    future = _new_future(key, request_hash)
+    try:
+        stored = await _claim(key, request_hash)
+        if stored is not None:
+            future.set_result(stored)
+            return stored
+        try:
+            result = await compute()
+            await asyncio.to_thread(store.put, key, request_hash, result)
+        except BaseException:
+            _release(key)
+            raise
+        future.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        _inflight.pop(key, None)
+
+
+async def _join(key: str, request_hash: str) -> Optional[Any]:
+    """本进程中同一 key 正在执行时等待其结果；没有时返回 None"""
+    while True:
+        pending = _inflight.get(key)
+        if pending is None:
+            return None
+        _check(key, request_hash, pending[0])
+        metrics.incr("idempotency_joined")
+        future = pending[1]
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise
+            # 第一次请求被取消（客户端断开），由当前请求重新执行
+
+
+def _new_future(key: str, request_hash: str) -> asyncio.Future:
+    future = asyncio.get_running_loop().create_future()
+    # 没有重复请求等待时，避免 "exception was never retrieved" 警告
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    _inflight[key] = (request_hash, future)
+    return future
+
+
+async def stream_once(key: str, request_hash: str, start: Callable[[], Any]) -> Union[Any, List[dict]]:
+    """chat_stream 的幂等处理：返回正在进行的对话流缓冲（从头订阅即可），或已完成轮次保存的事件列表。
+
+    start() 创建新的 StreamBuffer；本轮以 final 结束时保存压缩后的事件，被取消的轮次不保存。
+    同一 key 正在另一个 worker 上执行时，等其完成后返回保存的事件。
+    """
+    key = f"chat_stream:{key}"
+    joined = await _join(key, request_hash)
+    if joined is not None:
+        return joined
+
+    # 本进程中的重复请求等待这个 future：得到对话流缓冲或保存的事件
+    future = _new_future(key, request_hash)
+    try:
+        stored = await _claim(key, request_hash)
+    except asyncio.CancelledError:
+        _inflight.pop(key, None)
+        future.cancel()
+        raise
+    except BaseException as e:
+        _inflight.pop(key, None)
+        future.set_exception(e)
+        raise
+    if stored is not None:
+        _inflight.pop(key, None)
+        future.set_result(stored)
+        return stored
+
+    buffer = start()
+    future.set_result(buffer)
+    loop = asyncio.get_running_loop()
+
+    def finished(_task):
+        _inflight.pop(key, None)
+        events = buffer.condensed()
+        if any(event.get("type") == "final" for event in events):
+            loop.run_in_executor(None, store.put, key, request_hash, events)
+        else:
+            loop.run_in_executor(None, store.release, key)
+
+    buffer.task.add_done_callback(finished)
+    return buffer
@@ -0,0 +1,370 @@
+"""对话日志导出：按会话分组流式导出 CSV / JSONL / Parquet，支持按水位线增量导出。
+
+数据库端使用服务端游标分批读取，每批编码后立即输出，内存占用与总行数无关。
+
+用法（在 backend/src 目录下）:
+    python log_export.py --format parquet --out logs.parquet
+    python log_export.py --format jsonl --out logs.jsonl --watermark-file export.watermark   # 增量导出
+"""
+import io
+import os
+import re
+import csv
+import sys
+import json
+import asyncio
+import argparse
+import datetime
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import select, case, func
+
+from database import engine, ChatLog
+from log_storage import with_content, row_content
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow 为可选依赖，未安装时不支持 parquet 格式
+    pa = None
+    pq = None
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "5000"))
+# 水位线比当前时间提前一段时间，避免漏掉时间戳已生成但尚未提交的日志
+EXPORT_SAFETY_LAG_SECONDS = float(os.getenv("EXPORT_SAFETY_LAG_SECONDS", "60"))
+
+FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "jsonl": "application/x-ndjson; charset=utf-8",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+COLUMNS = (
+    "session_key", "student_id", "user_id", "group_type", "stage",
+    "turn_index", "role", "content", "created_at", "id", "meta",
+)
+
+# 前端点击阶段时发送的消息，据此推断每条日志所处的教学阶段
+STAGE_START = re.compile(r"^请开始(.+)阶段的教学内容$")
+STAGE_NAMES = {
+    "情境体验": "scenario",
+    "新知学习": "knowledge",
+    "算法设计": "logic",
+    "评估反思": "assessment",
+    "迁移应用": "transfer",
+}
+DEFAULT_STAGE = "scenario"
+
+
+def default_watermark() -> datetime.datetime:
+    return datetime.datetime.utcnow() - datetime.timedelta(seconds=EXPORT_SAFETY_LAG_SECONDS)
+
+
+def _session_key(student_id, user_id) -> str:
+    return student_id if student_id else str(user_id)
+
+
+def _stage_of(role: str, content: Optional[str]) -> Optional[str]:
+    if role != "user" or not content:
+        return None
+    match = STAGE_START.match(content)
+    if not match:
+        return None
+    return STAGE_NAMES.get(match.group(1), match.group(1))
+
+
+def _filters(query, group_type: Optional[str], student_id: Optional[str]):
+    if group_type is not None:
+        query = query.where(ChatLog.group_type == group_type)
+    if student_id is not None:
+        query = query.where(ChatLog.student_id == student_id)
+    return query
+
+
+def export_query(since, until, group_type=None, student_id=None):
+    """按会话、时间排序；有 student_id 的会话忽略每轮随机生成的 user_id"""
+    query = with_content(select(
+        ChatLog.id, ChatLog.user_id, ChatLog.student_id, ChatLog.role,
+        ChatLog.content, ChatLog.content_hash, ChatLog.group_type, ChatLog.created_at, ChatLog.meta,
+    )).where(ChatLog.created_at < until)
+    if since is not None:
+        query = query.where(ChatLog.created_at >= since)
+    query = _filters(query, group_type, student_id)
+    return query.order_by(
+        ChatLog.student_id,
+        case((ChatLog.student_id.is_(None), ChatLog.user_id)),
+        ChatLog.created_at,
+        ChatLog.id,
+    )
+
+
+class Sessionizer:
+    """为按会话排序的日志行补充会话键、阶段和轮次序号（每条学生消息开始新的一轮）"""
+
+    def __init__(self, prior: Optional[Dict[str, Tuple[int, str]]] = None):
+        # 增量导出时，水位线之前每个会话已有的 (轮次, 阶段)
+        self.prior = prior or {}
+        self._key = None
+        self._turn = 0
+        self._stage = DEFAULT_STAGE
+
+    def annotate(self, row) -> dict:
+        key = _session_key(row.student_id, row.user_id)
+        if key != self._key:
+            self._key = key
+            self._turn, self._stage = self.prior.get(key, (0, DEFAULT_STAGE))
+        if row.role == "user":
+            self._turn += 1
+            self._stage = _stage_of(row.role, row.content) or self._stage
+        return {
+            "session_key": key,
+            "student_id": row.student_id,
+            "user_id": str(row.user_id) if row.user_id is not None else None,
+            "group_type": row.group_type,
+            "stage": self._stage,
+            "turn_index": self._turn,
+            "role": row.role,
+            "content": row_content(row),
+            "created_at": row.created_at,
+            "id": row.id,
+            "meta": row.meta,
+        }
+
+
+async def load_prior_sessions(conn, since, group_type=None, student_id=None) -> Dict[str, Tuple[int, str]]:
+    """水位线之前各会话的学生消息数与最后所处阶段，使增量导出的轮次与阶段与全量导出一致"""
+    if since is None:
+        return {}
+    prior: Dict[str, Tuple[int, str]] = {}
+    base = select(ChatLog.student_id, ChatLog.user_id).where(ChatLog.role == "user", ChatLog.created_at < since)
+    base = _filters(base, group_type, student_id)
+
+    counts = await conn.execute(
+        base.add_columns(func.count()).group_by(ChatLog.student_id, ChatLog.user_id)
+    )
+    for student, user, n in counts:
+        key = _session_key(student, user)
+        turns, _ = prior.get(key, (0, DEFAULT_STAGE))
+        prior[key] = (turns + n, DEFAULT_STAGE)
+
+    stage_rows = await conn.stream(
+        base.add_columns(ChatLog.content)
+        .where(ChatLog.content.like("请开始%阶段的教学内容"))
+        .order_by(ChatLog.created_at, ChatLog.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    async for student, user, content in stage_rows:
+        key = _session_key(student, user)
+        prior[key] = (prior[key][0], _stage_of("user", content) or prior[key][1])
+    return prior
+
+
+class _Sink(io.RawIOBase):
+    """ParquetWriter 的输出目标：收集写入的字节，每个 row group 之后取走"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _meta_json(meta) -> Optional[str]:
+    return json.dumps(meta, ensure_ascii=False) if meta is not None else None
+
+
+class _CsvEncoder:
+    def __init__(self):
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+
+    def header(self) -> bytes:
+        self._writer.writerow(COLUMNS)
+        return self._take()
+
+    def encode(self, records: List[dict]) -> bytes:
+        for record in records:
+            row = dict(record, meta=_meta_json(record["meta"]))
+            if row["created_at"]:
+                row["created_at"] = row["created_at"].isoformat()
+            self._writer.writerow([row[key] for key in COLUMNS])
+        return self._take()
+
+    def finish(self) -> bytes:
+        return b""
+
+    def _take(self) -> bytes:
+        data = self._buffer.getvalue().encode("utf-8")
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return data
+
+
+class _JsonlEncoder:
+    def header(self) -> bytes:
+        return b""
+
+    def encode(self, records: List[dict]) -> bytes:
+        return "".join(
+            json.dumps(record, ensure_ascii=False, default=lambda v: v.isoformat()) + "\n"
+            for record in records
+        ).encode("utf-8")
+
+    def finish(self) -> bytes:
+        return b""
+
+
+class _ParquetEncoder:
+    """每批写一个 row group"""
+
+    def __init__(self):
+        self.schema = pa.schema([
+            ("session_key", pa.string()),
+            ("student_id", pa.string()),
+            ("user_id", pa.string()),
+            ("group_type", pa.string()),
+            ("stage", pa.string()),
+            ("turn_index", pa.int32()),
+            ("role", pa.string()),
+            ("content", pa.string()),
+            ("created_at", pa.timestamp("us")),
+            ("id", pa.int64()),
+            ("meta", pa.string()),  # JSON 文本
+        ])
+        self._sink = _Sink()
+        self._writer = pq.ParquetWriter(self._sink, self.schema, compression="zstd")
+
+    def header(self) -> bytes:
+        return self._sink.drain()
+
+    def encode(self, records: List[dict]) -> bytes:
+        records = [dict(record, meta=_meta_json(record["meta"])) for record in records]
+        self._writer.write_table(pa.Table.from_pylist(records, schema=self.schema))
+        return self._sink.drain()
+
+    def finish(self) -> bytes:
+        self._writer.close()
+        return self._sink.drain()
+
+
+def make_encoder(fmt: str):
+    if fmt == "csv":
+        return _CsvEncoder()
+    if fmt == "jsonl":
+        return _JsonlEncoder()
+    if fmt == "parquet":
+        if pa is None:
+            raise ValueError("Parquet export requires pyarrow (pip install pyarrow)")
+        return _ParquetEncoder()
+    raise ValueError(f"Unsupported export format: {fmt}")
+
+
+async def annotate_batches(batches: AsyncIterator[list], prior=None) -> AsyncIterator[List[dict]]:
+    """日志行批次 -> 带会话键、阶段、轮次的记录批次"""
+    sessionizer = Sessionizer(prior)
+    async for rows in batches:
+        yield [sessionizer.annotate(row) for row in rows]
+
+
+async def encode_records(batches: AsyncIterator[List[dict]], fmt: str) -> AsyncIterator[bytes]:
+    """记录批次 -> 编码后的字节块"""
+    encoder = make_encoder(fmt)
+    header = encoder.header()
+    if header:
+        yield header
+    async for records in batches:
+        data = encoder.encode(records)
+        if data:
+            yield data
+    tail = encoder.finish()
+    if tail:
+        yield tail
+
+
+async def encode_batches(batches: AsyncIterator[list], fmt: str, prior=None) -> AsyncIterator[bytes]:
+    """日志行批次 -> 编码后的字节块"""
+    async for chunk in encode_records(annotate_batches(batches, prior), fmt):
+        yield chunk
+
+
+async def iter_records(
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+    group_type: Optional[str] = None,
+    student_id: Optional[str] = None,
+) -> AsyncIterator[List[dict]]:
+    """按会话顺序分批读取 [since, until) 内的日志记录（导出与离线回放共用）"""
+    until = until or default_watermark()
+    async with engine.connect() as conn:
+        prior = await load_prior_sessions(conn, since, group_type, student_id)
+        result = await conn.stream(
+            export_query(since, until, group_type, student_id).execution_options(yield_per=EXPORT_BATCH_SIZE)
+        )
+        async for records in annotate_batches(result.partitions(), prior):
+            yield records
+
+
+async def export_logs(
+    fmt: str,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+    group_type: Optional[str] = None,
+    student_id: Optional[str] = None,
+) -> AsyncIterator[bytes]:
+    """导出 [since, until) 内的日志；until 即下一次增量导出的水位线"""
+    make_encoder(fmt)  # 在开始读取数据库之前校验格式
+    async for chunk in encode_records(iter_records(since, until, group_type, student_id), fmt):
+        yield chunk
+
+
+async def run_export(fmt: str, out: str, since=None, until=None, group_type=None, student_id=None) -> int:
+    written = 0
+    with open(out, "wb") as fd:
+        async for chunk in export_logs(fmt, since, until, group_type, student_id):
+            fd.write(chunk)
+            written += len(chunk)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="M-CAST 对话日志导出")
+    parser.add_argument("--format", choices=sorted(FORMATS), default="csv")
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--since", type=datetime.datetime.fromisoformat, default=None, help="只导出该时间（UTC）之后的日志")
+    parser.add_argument("--until", type=datetime.datetime.fromisoformat, default=None)
+    parser.add_argument("--group", default=None)
+    parser.add_argument("--student-id", default=None)
+    parser.add_argument("--watermark-file", default=None, help="读取上次导出的水位线作为 --since，完成后写入新的水位线")
+    args = parser.parse_args()
+
+    since = args.since
+    if args.watermark_file and since is None and os.path.exists(args.watermark_file):
+        with open(args.watermark_file, "r", encoding="utf-8") as fd:
+            since = datetime.datetime.fromisoformat(fd.read().strip())
+    until = args.until or default_watermark()
+
+    written = asyncio.run(run_export(args.format, args.out, since, until, args.group, args.student_id))
+    if args.watermark_file:
+        with open(args.watermark_file, "w", encoding="utf-8") as fd:
+            fd.write(until.isoformat())
+    print(f"Exported {written} bytes to {args.out} ({since.isoformat() if since else 'beginning'} -> {until.isoformat()})")
+
+
+if __name__ == "__main__":
+    main()
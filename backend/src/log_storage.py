@@ -0,0 +1,325 @@
+"""对话日志存储：正文去重/压缩、按月分区与保留期归档。
+
+- 超过 LOG_CONTENT_MIN_BYTES 的正文按 sha256 存入 chatlog_content（相同的智能体回复只存一份，
+  可压缩时用 zlib 压缩），chatlog 中只保留 content_hash。
+- Postgres 上 chatlog 可按 created_at 做月分区，提前创建后续几个月的分区；另有默认分区兜底。
+  改为分区表需要运维手动执行一次 --partition：它会改名原表、回填空的 created_at、重建主键，
+  并在挂接分区时持有 ACCESS EXCLUSIVE 锁扫描全表，期间写日志会被阻塞，请在停课/低峰时执行。
+  启动时的 init_db 不做这一步，只在表已分区时补建月分区。
+- 超过保留期（LOG_RETENTION_MONTHS）的分区先导出归档，再从库中卸载删除。
+
+用法（在 backend/src 目录下）:
+    python log_storage.py --partition                # 一次性：把 chatlog 改为按月分区
+    python log_storage.py --retention-months 12 --archive-dir /data/chatlog_archive
+"""
+import os
+import re
+import sys
+import gzip
+import zlib
+import asyncio
+import hashlib
+import argparse
+import datetime
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import text, delete, exists, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from database import engine, ChatLog, ChatLogContent
+
+LOG_CONTENT_STORE = os.getenv("LOG_CONTENT_STORE", "1") != "0"
+LOG_CONTENT_MIN_BYTES = int(os.getenv("LOG_CONTENT_MIN_BYTES", "512"))
+LOG_COMPRESS_LEVEL = int(os.getenv("LOG_COMPRESS_LEVEL", "6"))
+LOG_PARTITION_MONTHS_AHEAD = int(os.getenv("LOG_PARTITION_MONTHS_AHEAD", "3"))
+# 0 表示永久保留
+LOG_RETENTION_MONTHS = int(os.getenv("LOG_RETENTION_MONTHS", "0"))
+LOG_ARCHIVE_DIR = os.getenv("LOG_ARCHIVE_DIR", "/tmp/mcast_log_archive")
+
+TABLE = ChatLog.__tablename__
+LEGACY_PARTITION = f"{TABLE}_legacy"
+DEFAULT_PARTITION = f"{TABLE}_default"
+
+# 导出时解压过的正文（重复回复很多，避免反复解压）
+_decoded: "OrderedDict[str, str]" = OrderedDict()
+_DECODED_MAX = 2048
+
+
+def encode_content(content: str) -> Tuple[str, str, bytes, int]:
+    """返回 (content_hash, encoding, data, size)"""
+    raw = content.encode("utf-8")
+    digest = hashlib.sha256(raw).hexdigest()
+    compressed = zlib.compress(raw, LOG_COMPRESS_LEVEL)
+    if len(compressed) < len(raw):
+        return digest, "zlib", compressed, len(raw)
+    return digest, "raw", raw, len(raw)
+
+
+def decode_content(content_hash: Optional[str], encoding: str, data: bytes) -> str:
+    if content_hash in _decoded:
+        _decoded.move_to_end(content_hash)
+        return _decoded[content_hash]
+    raw = zlib.decompress(data) if encoding == "zlib" else data
+    content = raw.decode("utf-8")
+    if content_hash:
+        _decoded[content_hash] = content
+        if len(_decoded) > _DECODED_MAX:
+            _decoded.popitem(last=False)
+    return content
+
+
+async def prepare_content(session, content: Optional[str]) -> dict:
+    """写日志前处理正文：长内容写入去重表（已存在则跳过），返回 ChatLog 的 content 字段"""
+    if not LOG_CONTENT_STORE or content is None or len(content.encode("utf-8")) < LOG_CONTENT_MIN_BYTES:
+        return {"content": content}
+    digest, encoding, data, size = encode_content(content)
+    dialect = session.bind.dialect.name
+    if dialect == "postgresql":
+        insert = postgresql.insert(ChatLogContent)
+    elif dialect == "sqlite":
+        insert = sqlite.insert(ChatLogContent)
+    else:
+        return {"content": content}
+    await session.execute(
+        insert.values(content_hash=digest, encoding=encoding, data=data, size=size)
+        .on_conflict_do_nothing(index_elements=["content_hash"])
+    )
+    return {"content": None, "content_hash": digest}
+
+
+def with_content(query):
+    """为日志查询附加去重表中的正文列，配合 row_content 读取"""
+    return query.add_columns(
+        ChatLogContent.encoding.label("content_encoding"),
+        ChatLogContent.data.label("content_data"),
+    ).outerjoin(ChatLogContent, ChatLogContent.content_hash == ChatLog.content_hash)
+
+
+def row_content(row) -> Optional[str]:
+    if row.content_data is not None:
+        return decode_content(row.content_hash, row.content_encoding, row.content_data)
+    return row.content
+
+
+# ---- 月分区（仅 Postgres） ----
+
+def _month_start(value: datetime.datetime) -> datetime.datetime:
+    return datetime.datetime(value.year, value.month, 1)
+
+
+def _add_months(value: datetime.datetime, months: int) -> datetime.datetime:
+    index = value.year * 12 + value.month - 1 + months
+    return datetime.datetime(index // 12, index % 12 + 1, 1)
+
+
+def _partition_name(month: datetime.datetime) -> str:
+    return f"{TABLE}_y{month:%Y}m{month:%m}"
+
+
+BOUND = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+
+def _parse_bound(value: str) -> Optional[datetime.datetime]:
+    if value == "MINVALUE":
+        return None
+    return datetime.datetime.fromisoformat(value.strip("'"))
+
+
+def is_partitioned(sync_conn) -> bool:
+    return bool(sync_conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table)"
+    ), {"table": TABLE}).scalar())
+
+
+def list_partitions(sync_conn) -> List[Tuple[str, Optional[datetime.datetime], Optional[datetime.datetime]]]:
+    """返回 (分区名, 下界, 上界)；默认分区的上下界为 (None, None)，下界为 MINVALUE 时为 None"""
+    rows = sync_conn.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(:table) ORDER BY c.relname"
+    ), {"table": TABLE})
+    partitions = []
+    for name, bound in rows:
+        match = BOUND.search(bound or "")
+        if match:
+            partitions.append((name, _parse_bound(match.group(1)), _parse_bound(match.group(2))))
+        else:
+            partitions.append((name, None, None))
+    return partitions
+
+
+def convert_to_partitioned(sync_conn) -> None:
+    """把现有的 chatlog 改为按月分区的父表，原表整体挂为第一个分区（到下个月初为止），数据不搬动"""
+    if is_partitioned(sync_conn):
+        return
+    boundary = _add_months(_month_start(datetime.datetime.utcnow()), 1)
+    print(f"DEBUG: Converting {TABLE} to a partitioned table (legacy partition until {boundary:%Y-%m-%d})")
+
+    # 原表及其索引、主键改名，让出名字给新的父表
+    for index in inspect_indexes(sync_conn):
+        sync_conn.execute(text(f'ALTER INDEX "{index}" RENAME TO "{index.replace(TABLE, LEGACY_PARTITION, 1)}"'))
+    sync_conn.execute(text(f"ALTER TABLE {TABLE} RENAME TO {LEGACY_PARTITION}"))
+    sync_conn.execute(text(
+        f"UPDATE {LEGACY_PARTITION} SET created_at = timezone('utc', now()) WHERE created_at IS NULL"
+    ))
+    # 分区的主键须与父表一致，换成 (id, created_at)（会重建一次主键索引）
+    sync_conn.execute(text(
+        f"ALTER TABLE {LEGACY_PARTITION} DROP CONSTRAINT {TABLE}_pkey, "
+        f"ADD CONSTRAINT {LEGACY_PARTITION}_pkey PRIMARY KEY (id, created_at)"
+    ))
+
+    # 分区键必须包含在主键中；id 继续使用原来的序列
+    sync_conn.execute(text(
+        f"CREATE TABLE {TABLE} (LIKE {LEGACY_PARTITION} INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)"
+    ))
+    sync_conn.execute(text(f"ALTER TABLE {TABLE} ADD PRIMARY KEY (id, created_at)"))
+    sync_conn.execute(text(f"ALTER SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id"))
+    sync_conn.execute(text(
+        f"ALTER TABLE {TABLE} ATTACH PARTITION {LEGACY_PARTITION} FOR VALUES FROM (MINVALUE) TO ('{boundary:%Y-%m-%d}')"
+    ))
+    # 父表上建索引时，分区上定义相同的已有索引会被直接挂接，不会重建
+    for index in ChatLog.__table__.indexes:
+        index.create(sync_conn)
+    sync_conn.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT"))
+
+
+def inspect_indexes(sync_conn) -> List[str]:
+    return list(sync_conn.execute(text(
+        "SELECT indexname FROM pg_indexes WHERE tablename = :table AND indexname <> :pkey"
+    ), {"table": TABLE, "pkey": f"{TABLE}_pkey"}).scalars())
+
+
+def _create_partition(sync_conn, name: str, lower: datetime.datetime, upper: datetime.datetime) -> None:
+    """新建月分区；默认分区中已有落在该月的数据时（分区没有及时创建），先把这些行移出再挂回"""
+    params = {"lower": lower, "upper": upper}
+    stranded = sync_conn.execute(text(
+        f"SELECT 1 FROM {DEFAULT_PARTITION} WHERE created_at >= :lower AND created_at < :upper LIMIT 1"
+    ), params).scalar()
+    bounds = f"FOR VALUES FROM ('{lower:%Y-%m-%d}') TO ('{upper:%Y-%m-%d}')"
+    if not stranded:
+        sync_conn.execute(text(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {TABLE} {bounds}"))
+        return
+    print(f"DEBUG: Moving rows for {name} out of {DEFAULT_PARTITION}")
+    sync_conn.execute(text(f"ALTER TABLE {TABLE} DETACH PARTITION {DEFAULT_PARTITION}"))
+    sync_conn.execute(text(f"CREATE TABLE {name} PARTITION OF {TABLE} {bounds}"))
+    sync_conn.execute(text(
+        f"INSERT INTO {TABLE} SELECT * FROM {DEFAULT_PARTITION} WHERE created_at >= :lower AND created_at < :upper"
+    ), params)
+    sync_conn.execute(text(
+        f"DELETE FROM {DEFAULT_PARTITION} WHERE created_at >= :lower AND created_at < :upper"
+    ), params)
+    sync_conn.execute(text(f"ALTER TABLE {TABLE} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"))
+
+
+def ensure_partitions(sync_conn, months_ahead: int = LOG_PARTITION_MONTHS_AHEAD) -> List[str]:
+    """创建本月及之后 months_ahead 个月中尚不存在的月分区，返回新建的分区名"""
+    if not is_partitioned(sync_conn):
+        return []
+    existing = [(lower, upper) for _, lower, upper in list_partitions(sync_conn) if upper is not None]
+    created = []
+    month = _month_start(datetime.datetime.utcnow())
+    for _ in range(months_ahead + 1):
+        following = _add_months(month, 1)
+        overlaps = any((lower is None or lower < following) and month < upper for lower, upper in existing)
+        if not overlaps:
+            name = _partition_name(month)
+            _create_partition(sync_conn, name, month, following)
+            existing.append((month, following))
+            created.append(name)
+        month = following
+    if created:
+        print(f"DEBUG: Created log partitions: {created}")
+    return created
+
+
+# ---- 保留期归档 ----
+
+async def _archive(path: str, fmt: str, since, until) -> int:
+    from log_export import export_logs
+    written = 0
+    opener = gzip.open if fmt != "parquet" else open
+    with opener(path, "wb") as fd:
+        async for chunk in export_logs(fmt, since, until):
+            fd.write(chunk)
+            written += len(chunk)
+    return written
+
+
+async def apply_retention(
+    retention_months: int = LOG_RETENTION_MONTHS,
+    archive_dir: str = LOG_ARCHIVE_DIR,
+    fmt: Optional[str] = None,
+) -> dict:
+    """归档并删除早于保留期的日志：已分区时整个分区卸载删除，否则按行删除"""
+    from log_export import pa
+    fmt = fmt or ("parquet" if pa is not None else "jsonl")
+    report = {"retention_months": retention_months, "archived": [], "dropped": [], "orphaned_contents": 0}
+    if retention_months <= 0:
+        return report
+
+    cutoff = _add_months(_month_start(datetime.datetime.utcnow()), -retention_months)
+    report["cutoff"] = cutoff.isoformat()
+    os.makedirs(archive_dir, exist_ok=True)
+    suffix = fmt if fmt == "parquet" else f"{fmt}.gz"
+
+    partitioned = False
+    if engine.dialect.name == "postgresql":
+        async with engine.connect() as conn:
+            partitioned = await conn.run_sync(is_partitioned)
+    if partitioned:
+        async with engine.connect() as conn:
+            partitions = await conn.run_sync(list_partitions)
+        expired = [(name, lower, upper) for name, lower, upper in partitions if upper is not None and upper <= cutoff]
+        for name, lower, upper in expired:
+            path = os.path.join(archive_dir, f"{name}.{suffix}")
+            size = await _archive(path, fmt, lower, upper)
+            report["archived"].append({"partition": name, "path": path, "bytes": size})
+            async with engine.begin() as conn:
+                await conn.execute(text(f"ALTER TABLE {TABLE} DETACH PARTITION {name}"))
+                await conn.execute(text(f"DROP TABLE {name}"))
+            report["dropped"].append(name)
+    else:
+        path = os.path.join(archive_dir, f"{TABLE}_before_{cutoff:%Y%m}.{suffix}")
+        size = await _archive(path, fmt, None, cutoff)
+        report["archived"].append({"path": path, "bytes": size})
+        async with engine.begin() as conn:
+            result = await conn.execute(delete(ChatLog).where(ChatLog.created_at < cutoff))
+            report["deleted_rows"] = result.rowcount
+
+    # 不再被任何日志引用的正文
+    async with engine.begin() as conn:
+        result = await conn.execute(delete(ChatLogContent).where(
+            ~exists(select(ChatLog.id).where(ChatLog.content_hash == ChatLogContent.content_hash))
+        ))
+        report["orphaned_contents"] = result.rowcount
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="M-CAST 日志分区维护与保留期归档")
+    parser.add_argument("--retention-months", type=int, default=LOG_RETENTION_MONTHS, help="0 表示只维护分区，不删除")
+    parser.add_argument("--archive-dir", default=LOG_ARCHIVE_DIR)
+    parser.add_argument("--format", choices=["csv", "jsonl", "parquet"], default=None)
+    parser.add_argument("--partition", action="store_true", help="把现有 chatlog 改为按月分区（仅 Postgres，执行期间阻塞写日志）")
+    args = parser.parse_args()
+
+    async def run():
+        async with engine.begin() as conn:
+            if conn.dialect.name == "postgresql":
+                if args.partition:
+                    await conn.run_sync(convert_to_partitioned)
+                await conn.run_sync(ensure_partitions)
+            elif args.partition:
+                print("WARNING: --partition only applies to PostgreSQL, skipped.")
+        return await apply_retention(args.retention_months, args.archive_dir, args.format)
+
+    report = asyncio.run(run())
+    for item in report["archived"]:
+        print(f"Archived {item.get('partition', TABLE)} -> {item['path']} ({item['bytes']} bytes)")
+    print(f"Dropped partitions: {report['dropped']}, orphaned contents removed: {report['orphaned_contents']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import json
+import base64
+import datetime
+from typing import Optional, Tuple
+
+from sqlalchemy import select, tuple_
+
+from database import ChatLog
+from log_storage import with_content, row_content
+
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(created_at: datetime.datetime, log_id: int) -> str:
+    raw = json.dumps([created_at.isoformat(), log_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime.datetime, int]:
+    try:
+        created_at, log_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.datetime.fromisoformat(created_at), int(log_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def build_logs_query(
+    student_id: Optional[str] = None,
+    group_type: Optional[str] = None,
+    role: Optional[str] = None,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+    cursor: Optional[str] = None,
+    limit: int = 100,
+    descending: bool = False,
+):
+    """按 (created_at, id) 做 keyset 分页的查询。
+
+    翻页只需比较上一页最后一行的 (created_at, id)，不用 OFFSET，任意深度的页都能
+    沿 (student_id, created_at) / (group_type, created_at) 索引直接定位。
+    多取一行用于判断是否还有下一页。
+    """
+    query = with_content(select(*ChatLog.__table__.c))
+    if student_id is not None:
+        query = query.where(ChatLog.student_id == student_id)
+    if group_type is not None:
+        query = query.where(ChatLog.group_type == group_type)
+    if role is not None:
+        query = query.where(ChatLog.role == role)
+    if since is not None:
+        query = query.where(ChatLog.created_at >= since)
+    if until is not None:
+        query = query.where(ChatLog.created_at < until)
+
+    key = tuple_(ChatLog.created_at, ChatLog.id)
+    if cursor:
+        after = decode_cursor(cursor)
+        query = query.where(key < after if descending else key > after)
+
+    if descending:
+        query = query.order_by(ChatLog.created_at.desc(), ChatLog.id.desc())
+    else:
+        query = query.order_by(ChatLog.created_at, ChatLog.id)
+    return query.limit(min(limit, MAX_PAGE_SIZE) + 1)
+
+
+def page_from_rows(rows: list, limit: int) -> dict:
+    """把多取了一行的结果切成一页，并生成下一页的游标"""
+    limit = min(limit, MAX_PAGE_SIZE)
+    page = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit and page:
+        next_cursor = encode_cursor(page[-1].created_at, page[-1].id)
+    items = [
+        {column.name: getattr(row, column.name) for column in ChatLog.__table__.c} | {"content": row_content(row)}
+        for row in page
+    ]
+    return {"items": items, "next_cursor": next_cursor}
+
+
+async def fetch_logs(session, limit: int = 100, **filters) -> dict:
+    result = await session.execute(build_logs_query(limit=limit, **filters))
+    return page_from_rows(list(result), limit)
@@ -1,8 +1,6 @@
 import uvicorn
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Header, Depends, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
 from typing import List, Optional, Dict, Any
 import os
 import sys
@@ -15,13 +13,38 @@ import tempfile
 import json
 import asyncio
 import re
+import ast
 from dotenv import load_dotenv
 import uuid
-from database import init_db, AsyncSessionLocal, log_message
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import SystemMessage, HumanMessage
-
-from graphs.graph import main_graph
+import datetime
+from schemas import (
+    ChatRequest,
+    ChatResponse,
+    CodeExecutionRequest,
+    CodeExecutionResponse,
+    SyntaxCheckRequest,
+    SyntaxCheckResponse,
+    FlowchartRequest,
+    FlowchartResponse,
+    ChatLogPage,
+    graph_inputs,
+    final_state,
+    session_key,
+    request_meta,
+    response_meta,
+)
+from state_diff import state_differ
+from sse import sse_response, coalesce_tokens
+from turns import start_turn, end_turn, watch_disconnect
+from stream_buffer import open_stream, find_stream, parse_last_event_id
+import idempotency
+import metrics
+import exec_trace
+import token_ledger
+import profiler
+from dashboard import dashboard
+from shared_state import shared_state
+from static_files import StaticSite
 
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -32,6 +55,106 @@ load_dotenv() # 兜底加载当前目录下的 .env
 
 app = FastAPI(title="M-CAST Agent API")
 
+# 管理接口（课前预热等）使用的令牌，未设置时管理接口全部禁用
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN or x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+def require_admin_stream(x_admin_token: Optional[str] = Header(None), admin_token: Optional[str] = Query(None)):
+    """SSE 管理接口：浏览器的 EventSource 不能设置请求头，也接受查询参数 ?admin_token=...
+    （查询参数会出现在访问日志中，能用 fetch 流式读取时优先用请求头）"""
+    require_admin(x_admin_token or admin_token)
+
+def profile_requested(x_profile: Optional[str], x_admin_token: Optional[str]) -> bool:
+    """管理员带 X-Profile: 1 时对本次请求采样（见 profiler.py）"""
+    return x_profile == "1" and bool(ADMIN_TOKEN) and x_admin_token == ADMIN_TOKEN
+
+async def run_profiled(endpoint: str, response: Response, run):
+    """采样 run() 的整个过程，结果 id 放在响应头 X-Profile-Id"""
+    profile = profiler.begin(endpoint)
+    response.headers["X-Profile-Id"] = profile.id
+    try:
+        return await run()
+    finally:
+        profile.finish()
+
+# Serverless 冷启动优化：LangChain/LangGraph、langchain_openai、SQLAlchemy+asyncpg 的导入
+# 占冷启动的大半，改为第一次使用时再导入；启动后在后台线程中预加载，/api/health 不受影响。
+# 设置 PRELOAD_ENGINE=0 可关闭预加载（完全按需导入）
+PRELOAD_ENGINE = os.getenv("PRELOAD_ENGINE", "1") != "0"
+
+# 日志中附带回放所需的 meta（请求子阶段字段、LLM 原始输出与耗时），设置 LOG_TURN_META=0 关闭
+LOG_TURN_META = os.getenv("LOG_TURN_META", "1") != "0"
+
+# /api/chat_stream 的事件缓存在服务端，断线重连可凭 Last-Event-ID 续传；设置 SSE_RESUME=0 关闭
+# （关闭后忽略 Last-Event-ID；带 Idempotency-Key 的重试仍会订阅同一轮或重放保存的结果）
+SSE_RESUME = os.getenv("SSE_RESUME", "1") != "0"
+
+# 相同代码与输入的运行结果缓存多少秒（存于 shared_state，多个 worker 共用）；默认 0 不缓存，每次都真正运行
+EXECUTE_CACHE_SECONDS = float(os.getenv("EXECUTE_CACHE_SECONDS", "0"))
+# 结果可能因进程而异的内置函数（对象地址、字符串哈希、读写文件、动态执行）；用到它们、导入模块、
+# 使用集合（字符串集合的遍历顺序随哈希种子变化）或访问双下划线属性的代码不缓存
+NONDETERMINISTIC_BUILTINS = {
+    "id", "hash", "__import__", "open", "eval", "exec", "compile",
+    "globals", "locals", "vars", "set", "frozenset", "breakpoint",
+}
+
+# 对照组的系统提示词，保持固定以命中前缀缓存
+CONTROL_SYSTEM_PROMPT = """你是一个友好的 Python 编程助手。
+你的任务是回答学生的问题，帮助他们学习 Python 编程。
+保持语气亲切、鼓励。"""
+
+_graph_future = None
+# 后台任务（初始化、写日志）的引用，防止任务在完成前被回收
+_background_tasks = set()
+
+def _load_engine():
+    """导入并编译 graph（以及模型客户端），在线程中执行以免阻塞事件循环"""
+    from graphs.graph import main_graph
+    import langchain_openai  # noqa: F401
+    return main_graph
+
+async def get_main_graph():
+    """返回编译好的 graph；首次调用时导入，之后复用同一个实例"""
+    global _graph_future
+    if _graph_future is None:
+        _graph_future = asyncio.ensure_future(asyncio.to_thread(_load_engine))
+    try:
+        return await asyncio.shield(_graph_future)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        _graph_future = None
+        raise
+
+def _database():
+    """数据库模块（SQLAlchemy + asyncpg）首次写日志时才导入"""
+    import database
+    return database
+
+async def _log(*args, **kwargs):
+    if not LOG_TURN_META:
+        kwargs.pop("meta", None)
+    db = _database()
+    async with db.AsyncSessionLocal() as session:
+        await db.log_message(session, *args, **kwargs)
+
+async def _init_backend():
+    """启动后的后台初始化：预加载 graph，校验/创建数据库表结构"""
+    try:
+        if PRELOAD_ENGINE:
+            await get_main_graph()
+            print("DEBUG: Graph preloaded")
+        db = await asyncio.to_thread(_database)
+        if await db.ensure_db():
+            print("DEBUG: Database initialized successfully")
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        print(f"ERROR: Background initialization failed: {e}")
+
 @app.on_event("startup")
 async def startup_event():
     print("DEBUG: Startup event triggered")
@@ -55,91 +178,47 @@ async def startup_event():
         else:
              print("DEBUG: Config dir NOT found!")
              
-        await init_db()
-        print("DEBUG: Database initialized successfully")
+        # 不等待初始化完成，启动后立即可以响应请求
+        task = asyncio.create_task(_init_backend())
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
     except Exception as e:
         import traceback
         traceback.print_exc()
         print(f"ERROR: Startup failed: {e}")
         # We don't raise here to allow the app to start and show logs/health check
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    # 尚未写入数据库的 token 用量、尚未保存的输出长度统计
+    await token_ledger.ledger.flush()
+    from graphs.output_stats import output_stats
+    output_stats.save()
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Stream-Id"],
 )
 
 
 @app.get("/api/test_db")
 async def test_db():
     try:
-        async with AsyncSessionLocal() as session:
-            # Try to insert a test log
-            test_id = str(uuid.uuid4())
-            await log_message(session, uuid.uuid4(), "system", f"DB Connection Test {test_id}", group_type="test", student_id="TEST_SYS")
-            return {"status": "success", "message": "Database connection and write successful", "test_id": test_id}
+        # Try to insert a test log
+        test_id = str(uuid.uuid4())
+        await _log(uuid.uuid4(), "system", f"DB Connection Test {test_id}", group_type="test", student_id="TEST_SYS")
+        return {"status": "success", "message": "Database connection and write successful", "test_id": test_id}
     except Exception as e:
         import traceback
         error_trace = traceback.format_exc()
         print(f"DB Test Error: {e}")
         return {"status": "error", "message": str(e), "trace": error_trace, "env_db_url_set": bool(os.getenv("DATABASE_URL"))}
 
-class ChatRequest(BaseModel):
-    user_id: Optional[uuid.UUID] = None
-    student_id: Optional[str] = None  # Added student_id
-    stage: str
-    user_input: str
-    context: Optional[str] = ""
-    current_task: Optional[str] = ""
-    agent_a_sub_stage: Optional[str] = "presentation"
-    agent_a_turn_count: Optional[int] = 0
-    agent_c_sub_stage: Optional[str] = "flowchart"
-    agent_c_poe_state: Optional[str] = "none"
-    agent_c_current_code: Optional[str] = None
-    agent_d_reflection_sub_stage: Optional[str] = "recall"
-    agent_e_sub_stage: Optional[str] = "intro"
-    agent_e_quiz_index: Optional[int] = 0
-    group: Optional[str] = "experimental"
-
-class ChatResponse(BaseModel):
-    active_agent_response: str
-    stage: str
-    suggestions: List[str]
-    agent_a_sub_stage: Optional[str] = None
-    agent_a_turn_count: Optional[int] = None
-    agent_a_scenario_text: Optional[str] = None
-    agent_c_sub_stage: Optional[str] = None
-    agent_c_poe_state: Optional[str] = None
-    agent_c_current_code: Optional[str] = None
-    agent_c_flowchart_code: Optional[str] = None
-    agent_d_reflection_sub_stage: Optional[str] = None
-    agent_d_evaluation_scores: Optional[Dict[str, int]] = None
-    agent_b_flowchart_code: Optional[str] = None
-    agent_b_concept_diagram: Optional[str] = None
-    agent_c_code_template: Optional[str] = None
-    agent_e_transfer_tasks: Optional[List[str]] = None
-    agent_e_sub_stage: Optional[str] = None
-    agent_e_quiz_index: Optional[int] = None
-
-class CodeExecutionRequest(BaseModel):
-    code: str
-    inputs: List[str] = []
-
-class CodeExecutionResponse(BaseModel):
-    output: str
-    error: Optional[str] = None
-
-class SyntaxCheckRequest(BaseModel):
-    code: str
-
-class SyntaxCheckResponse(BaseModel):
-    is_valid: bool
-    errors: List[str] = []
-
-@app.post("/api/check_syntax", response_model=SyntaxCheckResponse)
-async def check_syntax(request: SyntaxCheckRequest):
+def run_syntax_check(request: SyntaxCheckRequest) -> SyntaxCheckResponse:
     try:
         import ast
         ast.parse(request.code)
@@ -152,345 +231,727 @@ async def check_syntax(request: SyntaxCheckRequest):
     except Exception as e:
         return SyntaxCheckResponse(is_valid=False, errors=[str(e)])
 
-@app.post("/api/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+@app.post("/api/check_syntax", response_model=SyntaxCheckResponse)
+async def check_syntax(request: SyntaxCheckRequest):
+    return run_syntax_check(request)
+
+@app.post("/api/flowchart", response_model=FlowchartResponse)
+async def flowchart(request: FlowchartRequest):
+    """由学生代码直接生成 Mermaid 流程图（不调用模型）"""
+    from graphs.flowchart import code_to_mermaid
+    return FlowchartResponse(flowchart=code_to_mermaid(request.code))
+
+@app.post("/api/chat", response_model=ChatResponse, response_model_exclude_unset=True)
+async def chat(
+    request: ChatRequest,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None),
+    x_profile: Optional[str] = Header(None),
+    x_admin_token: Optional[str] = Header(None),
+):
     # ... (保持原有的 chat 接口不变，供兼容使用)
+    if profile_requested(x_profile, x_admin_token):
+        return await run_profiled("chat", response, lambda: _chat_once(request, idempotency_key))
+    return await _chat_once(request, idempotency_key)
+
+async def _chat_once(request: ChatRequest, idempotency_key: Optional[str]) -> ChatResponse:
+    if idempotency_key:
+        try:
+            result = await idempotency.run_once(
+                "chat", idempotency_key, idempotency.fingerprint(request),
+                lambda: _chat(request),
+            )
+        except idempotency.IdempotencyConflict as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        return ChatResponse(**result)
+    return ChatResponse(**await _chat(request))
+
+async def _chat(request: ChatRequest) -> dict:
     try:
         current_user_id = request.user_id or uuid.uuid4()
         
         # Log user input
-        async with AsyncSessionLocal() as session:
-            await log_message(session, current_user_id, "user", request.user_input)
-
-        inputs = {
-            "stage": request.stage,
-            "user_input": request.user_input,
-            "context": request.context,
-            "current_task": request.current_task,
-            "agent_a_sub_stage": request.agent_a_sub_stage,
-            "agent_a_turn_count": request.agent_a_turn_count,
-            "agent_c_sub_stage": request.agent_c_sub_stage,
-            "agent_c_poe_state": request.agent_c_poe_state,
-            "agent_c_current_code": request.agent_c_current_code or "",
-            "agent_d_reflection_sub_stage": request.agent_d_reflection_sub_stage,
-            "agent_e_sub_stage": request.agent_e_sub_stage,
-            "agent_e_quiz_index": request.agent_e_quiz_index
-        }
-        result = await main_graph.ainvoke(inputs)
+        await _log(current_user_id, "user", request.user_input, meta=request_meta(request))
+
+        inputs = graph_inputs(request)
+        main_graph = await get_main_graph()
+        from graphs.llm_stream import bind_call_recorder
+        from graphs.context_index import bind_session
+        calls = []
+        bind_call_recorder(calls)
+        token_ledger.bind_owner(request.student_id, request.group, request.lesson_id)
+        bind_session(session_key(request))
+        try:
+            result = await main_graph.ainvoke(inputs, config=profiler.graph_config())
+        finally:
+            token_ledger.ledger.maybe_flush()
         
         agent_response_content = result.get("active_agent_response", "")
         
         # Log agent response
         try:
             print(f"DEBUG: Attempting to log agent response (Experimental Group).")
-            async with AsyncSessionLocal() as session:
-                await log_message(session, current_user_id, "agent", agent_response_content)
+            await _log(current_user_id, "agent", agent_response_content, meta=response_meta(result, calls))
             print("DEBUG: Agent response logged successfully.")
         except Exception as e:
             print(f"Error logging agent response: {e}")
 
-        return ChatResponse(
-            active_agent_response=agent_response_content,
-            stage=result.get("stage", request.stage),
-            suggestions=result.get("suggestions", []),
-            agent_a_sub_stage=result.get("agent_a_sub_stage"),
-            agent_a_turn_count=result.get("agent_a_turn_count"),
-            agent_a_scenario_text=result.get("agent_a_scenario_text"),
-            agent_c_sub_stage=result.get("agent_c_sub_stage"),
-            agent_c_poe_state=result.get("agent_c_poe_state"),
-            agent_c_current_code=result.get("agent_c_current_code"),
-            agent_c_flowchart_code=result.get("agent_c_flowchart_code"),
-            agent_d_reflection_sub_stage=result.get("agent_d_reflection_sub_stage"),
-            agent_d_evaluation_scores=result.get("agent_d_evaluation_scores"),
-            agent_b_flowchart_code=result.get("agent_b_flowchart_code"),
-            agent_b_concept_diagram=result.get("agent_b_concept_diagram"),
-            agent_c_code_template=result.get("agent_c_code_template"),
-            agent_e_transfer_tasks=result.get("agent_e_transfer_tasks"),
-            agent_e_sub_stage=result.get("agent_e_sub_stage"),
-            agent_e_quiz_index=result.get("agent_e_quiz_index")
-        )
+        state = final_state(result, request)
+        dashboard.record(request.student_id, request.group, request.lesson_id, state)
+        return ChatResponse(**state_differ.diff(session_key(request), state, request.state_version)).model_dump(exclude_unset=True)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/chat_stream")
-@app.post("/chat_stream")
-async def chat_stream(request: ChatRequest):
-    print(f"Received request: group={request.group}, stage={request.stage}")
-    async def event_generator():
+def _log_in_background(*args, **kwargs):
+    async def write():
         try:
-            current_user_id = request.user_id or uuid.uuid4()
+            await _log(*args, **kwargs)
+        except Exception as e:
+            print(f"Error logging in background: {e}")
+    task = asyncio.create_task(write())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def chat_events(request: ChatRequest, is_disconnected=None, turn=None):
+    """一轮对话的事件流（token / final / error 字典），由传输层负责编码。
+
+    客户端断开（is_disconnected 返回 True、生成器被关闭）或同一学生发来新消息时，
+    取消 graph 运行与模型生成，并在日志中记录一条 cancelled 记录。
+    turn 由调用方登记时（可续传的 SSE），由调用方决定何时取消。
+    """
+    current_user_id = request.user_id or uuid.uuid4()
+    turn = turn or start_turn(session_key(request))
+    queue: asyncio.Queue = asyncio.Queue()
+
+    # graph 在独立任务中运行，取消本轮只会取消这个任务，不影响传输层
+    async def produce():
+        try:
+            await get_main_graph()
+            from graphs.llm_stream import bind_cancel_event
+            bind_cancel_event(turn.cancel_event)
+            async for event in _chat_turn_events(request, current_user_id):
+                await queue.put(event)
+        except Exception as e:
+            # graph 加载失败
+            await queue.put({"type": "error", "content": str(e)})
+        finally:
+            queue.put_nowait(None)
+
+    turn.task = asyncio.create_task(produce())
+    watcher = asyncio.create_task(watch_disconnect(turn, is_disconnected)) if is_disconnected else None
+    partial = []
+    try:
+        while (event := await queue.get()) is not None:
+            if event["type"] == "token":
+                partial.append(event["content"])
+            yield event
+    except (asyncio.CancelledError, GeneratorExit):
+        turn.cancel("closed")
+        raise
+    finally:
+        if turn.cancelled:
+            print(f"DEBUG: Turn cancelled ({turn.cancel_reason}) for student_id={request.student_id}")
+            _log_in_background(current_user_id, "cancelled", "".join(partial), group_type=request.group, student_id=request.student_id)
+        turn.task.cancel()
+        if watcher is not None:
+            watcher.cancel()
+        end_turn(turn)
+
+async def _chat_turn_events(request: ChatRequest, current_user_id: uuid.UUID):
+    main_graph = await get_main_graph()
+    from langchain_openai import ChatOpenAI
+    from langchain_core.messages import SystemMessage, HumanMessage
+    from graphs.llm_stream import astream_llm, bind_call_recorder, COALESCED_START_EVENT, COALESCED_TOKEN_EVENT
+    from graphs.context_index import bind_session
+    # 本轮各次 LLM 调用的记录，随智能体回复写入日志
+    calls = []
+    bind_call_recorder(calls)
+    # 本轮各次调用的 token 记到该学生名下，超出预算时换用便宜的模型
+    token_ledger.bind_owner(request.student_id, request.group, request.lesson_id)
+    # 各智能体按本轮问题从该会话的历史消息索引中挑选 context
+    bind_session(session_key(request))
+    try:
+        # Log user input with group_type and student_id
+        try:
+            print(f"DEBUG: Attempting to log user input. UserID={current_user_id}, Group={request.group}, StudentID={request.student_id}")
+            await _log(current_user_id, "user", request.user_input, group_type=request.group, student_id=request.student_id, meta=request_meta(request))
+            print("DEBUG: User input logged successfully.")
+        except Exception as e:
+            print(f"Error logging user input: {e}")
+
+        # === Control Group Logic ===
+        if request.group == "control":
+            limits = token_ledger.current_limits()
+            llm = ChatOpenAI(
+                model=(limits and limits.model) or os.getenv("LLM_MODEL", "Qwen/Qwen2.5-72B-Instruct"),
+                temperature=0.7,
+                max_tokens=limits.max_tokens if limits else None,
+                api_key=os.getenv("OPENAI_API_KEY"),
+                base_url=os.getenv("OPENAI_API_BASE"),
+                stream_usage=True
+            )
+            
+            # Construct messages with context：系统提示词不含变量，学习阶段随学生输入放在末尾
+            messages = [SystemMessage(content=CONTROL_SYSTEM_PROMPT)]
+            if request.context:
+                messages.append(HumanMessage(content=f"Previous conversation:\n{request.context}"))
+            messages.append(HumanMessage(content=f"当前学习阶段：{request.stage}\n\n{request.user_input}"))
+
+            accumulated_content = ""
+            async for chunk in astream_llm(llm, messages, "control"):
+                content = chunk.content
+                if content:
+                    accumulated_content += content
+                    yield {"type": "token", "content": content}
             
-            # Log user input with group_type and student_id
+            # Log agent response
             try:
-                print(f"DEBUG: Attempting to log user input. UserID={current_user_id}, Group={request.group}, StudentID={request.student_id}")
-                async with AsyncSessionLocal() as session:
-                    await log_message(session, current_user_id, "user", request.user_input, group_type=request.group, student_id=request.student_id)
-                print("DEBUG: User input logged successfully.")
+                print(f"DEBUG: Attempting to log agent response (Control Group).")
+                await _log(current_user_id, "agent", accumulated_content, group_type=request.group, student_id=request.student_id, meta=response_meta({"stage": request.stage}, calls))
+                print("DEBUG: Agent response logged successfully.")
             except Exception as e:
-                print(f"Error logging user input: {e}")
-
-            # === Control Group Logic ===
-            if request.group == "control":
-                llm = ChatOpenAI(
-                    model=os.getenv("LLM_MODEL", "Qwen/Qwen2.5-72B-Instruct"),
-                    temperature=0.7,
-                    api_key=os.getenv("OPENAI_API_KEY"),
-                    base_url=os.getenv("OPENAI_API_BASE")
-                )
-                
-                system_prompt = f"""你是一个友好的 Python 编程助手。
-你的任务是回答学生的问题，帮助他们学习 Python 编程。
-当前学习阶段：{request.stage}。保持语气亲切、鼓励。"""
-                
-                # Construct messages with context
-                messages = [SystemMessage(content=system_prompt)]
-                if request.context:
-                    messages.append(HumanMessage(content=f"Previous conversation:\n{request.context}"))
-                messages.append(HumanMessage(content=request.user_input))
-
-                accumulated_content = ""
-                async for chunk in llm.astream(messages):
-                    content = chunk.content
-                    if content:
-                        accumulated_content += content
-                        yield f"data: {json.dumps({'type': 'token', 'content': content})}\n\n"
-                
-                # Log agent response
-                try:
-                    print(f"DEBUG: Attempting to log agent response (Control Group).")
-                    async with AsyncSessionLocal() as session:
-                        await log_message(session, current_user_id, "agent", accumulated_content, group_type=request.group, student_id=request.student_id)
-                    print("DEBUG: Agent response logged successfully.")
-                except Exception as e:
-                    print(f"Error logging agent response: {e}")
+                print(f"Error logging agent response: {e}")
 
-                final_data = {
-                    "type": "final",
-                    "active_agent_response": accumulated_content,
-                    "stage": request.stage,
-                    "suggestions": []
-                }
-                yield f"data: {json.dumps(final_data)}\n\n"
-                yield "data: [DONE]\n\n"
-                return
-
-            inputs = {
+            final_data = {
+                "type": "final",
+                "active_agent_response": accumulated_content,
                 "stage": request.stage,
-                "user_input": request.user_input,
-                "context": request.context,
-                "current_task": request.current_task,
-                "agent_a_sub_stage": request.agent_a_sub_stage,
-                "agent_a_turn_count": request.agent_a_turn_count,
-                "agent_c_sub_stage": request.agent_c_sub_stage,
-                "agent_c_poe_state": request.agent_c_poe_state,
-                "agent_c_current_code": request.agent_c_current_code or "",
-                "agent_d_reflection_sub_stage": request.agent_d_reflection_sub_stage,
-                "agent_e_sub_stage": request.agent_e_sub_stage,
-                "agent_e_quiz_index": request.agent_e_quiz_index
+                "suggestions": []
             }
-
-            full_text = ""
-            response_started = False
-            response_completed = False
-            # 记录当前正在处理的消息 ID，防止多个 LLM 调用混淆
-            current_run_id = None
-
-            async for event in main_graph.astream_events(inputs, version="v2"):
-                kind = event["event"]
-                
-                # 过滤掉非 chat_model 事件的 token，防止 graph 本身的输出干扰
-                if kind == "on_chat_model_start":
-                    # 新的 LLM 调用开始，重置解析状态
-                    full_text = ""
-                    response_started = False
-                    response_completed = False
-                    current_run_id = event["run_id"]
-
-                elif kind == "on_chat_model_stream":
-                    # 严格检查 run_id，只处理当前活跃的 LLM
-                    if event["run_id"] != current_run_id or response_completed:
-                        continue
-
+            dashboard.record(request.student_id, request.group, request.lesson_id, final_data)
+            yield final_data
+            return
+
+        inputs = graph_inputs(request)
+
+        full_text = ""
+        response_started = False
+        response_completed = False
+        # 记录当前正在处理的消息 ID，防止多个 LLM 调用混淆
+        current_run_id = None
+
+        async for event in main_graph.astream_events(inputs, version="v2", config=profiler.graph_config()):
+            kind = event["event"]
+            # 合并请求的跟随者和预热缓存命中不会触发 chat_model 事件，而是通过自定义事件转发 token
+            custom_name = event["name"] if kind == "on_custom_event" else None
+            
+            # 过滤掉非 chat_model 事件的 token，防止 graph 本身的输出干扰
+            if kind == "on_chat_model_start" or custom_name == COALESCED_START_EVENT:
+                # 新的 LLM 调用开始，重置解析状态
+                full_text = ""
+                response_started = False
+                response_completed = False
+                current_run_id = event["run_id"]
+
+            elif kind == "on_chat_model_stream" or custom_name == COALESCED_TOKEN_EVENT:
+                # 严格检查 run_id，只处理当前活跃的 LLM
+                if event["run_id"] != current_run_id or response_completed:
+                    continue
+
+                if custom_name:
+                    content = event["data"]["content"]
+                else:
                     content = event["data"]["chunk"].content
-                    if not content:
-                        continue
-                        
-                    full_text += content
+                if not content:
+                    continue
                     
-                    if not response_started:
-                        # 更加鲁棒的正则，寻找 "response": "
-                        # 考虑到流式输出，可能 "response": " 分散在多个 chunk 中
-                        match = re.search(r'"response"\s*:\s*"', full_text)
-                        if match:
-                            response_started = True
-                            # 提取匹配位置之后的内容
-                            start_idx = match.end()
-                            initial_content = full_text[start_idx:]
-                            
-                            # 检查这部分内容是否已经包含了结束引号
-                            # 必须是非转义的引号
-                            quote_match = re.search(r'(?<!\\)"', initial_content)
-                            if quote_match:
-                                end_idx = quote_match.start()
-                                yield f"data: {json.dumps({'type': 'token', 'content': initial_content[:end_idx]})}\n\n"
-                                response_started = False
-                                response_completed = True
-                            else:
-                                if initial_content:
-                                    # 优化：直接发送整个块，不再逐字发送，提高前端显示速度
-                                    yield f"data: {json.dumps({'type': 'token', 'content': initial_content})}\n\n"
-                    else:
-                        # 已经在响应内容中了，寻找结束引号
-                        # 我们只需要发送当前 chunk 的内容，直到遇到非转义的引号
-                        if '"' in content:
-                            # 寻找非转义引号
-                            quote_match = re.search(r'(?<!\\)"', content)
-                            if quote_match:
-                                end_idx = quote_match.start()
-                                yield f"data: {json.dumps({'type': 'token', 'content': content[:end_idx]})}\n\n"
-                                response_started = False
-                                response_completed = True
-                            else:
-                                yield f"data: {json.dumps({'type': 'token', 'content': content})}\n\n"
+                full_text += content
+                
+                if not response_started:
+                    # 更加鲁棒的正则，寻找 "response": "
+                    # 考虑到流式输出，可能 "response": " 分散在多个 chunk 中
+                    match = re.search(r'"response"\s*:\s*"', full_text)
+                    if match:
+                        response_started = True
+                        # 提取匹配位置之后的内容
+                        start_idx = match.end()
+                        initial_content = full_text[start_idx:]
+                        
+                        # 检查这部分内容是否已经包含了结束引号
+                        # 必须是非转义的引号
+                        quote_match = re.search(r'(?<!\\)"', initial_content)
+                        if quote_match:
+                            end_idx = quote_match.start()
+                            yield {"type": "token", "content": initial_content[:end_idx]}
+                            response_started = False
+                            response_completed = True
                         else:
-                            yield f"data: {json.dumps({'type': 'token', 'content': content})}\n\n"
-
-                # 显式忽略所有其他事件中的数据发送到前端 token 逻辑
-                # 只有 final 消息包含完整的结构化数据
-                elif kind == "on_chain_end" and event["name"] == "LangGraph":
-                    output = event["data"]["output"]
-                    print(f"DEBUG: LangGraph finished. Output keys: {list(output.keys())}")
-                    agent_response = output.get("active_agent_response", "")
-                    print(f"DEBUG: active_agent_response: {agent_response[:50]}...")
-                    
-                    # Log agent response
-                    try:
-                        async with AsyncSessionLocal() as session:
-                            await log_message(session, current_user_id, "agent", agent_response, group_type=request.group, student_id=request.student_id)
-                    except Exception as e:
-                        print(f"Error logging agent response: {e}")
-
-                    # 这里的 output 是 GlobalState 的字典形式
-                    final_data = {
-                        "type": "final",
-                        "active_agent_response": agent_response,
-                        "stage": output.get("stage", request.stage),
-                        "suggestions": output.get("suggestions", []),
-                        "agent_a_sub_stage": output.get("agent_a_sub_stage"),
-                        "agent_a_turn_count": output.get("agent_a_turn_count"),
-                        "agent_a_scenario_text": output.get("agent_a_scenario_text"),
-                        "agent_c_sub_stage": output.get("agent_c_sub_stage"),
-                        "agent_c_poe_state": output.get("agent_c_poe_state"),
-                        "agent_c_current_code": output.get("agent_c_current_code"),
-                        "agent_c_flowchart_code": output.get("agent_c_flowchart_code"),
-                        "agent_d_reflection_sub_stage": output.get("agent_d_reflection_sub_stage"),
-                        "agent_d_evaluation_scores": output.get("agent_d_evaluation_scores"),
-                        "agent_b_flowchart_code": output.get("agent_b_flowchart_code"),
-                        "agent_b_concept_diagram": output.get("agent_b_concept_diagram"),
-                        "agent_c_code_template": output.get("agent_c_code_template"),
-                        "agent_e_transfer_tasks": output.get("agent_e_transfer_tasks"),
-                        "agent_e_sub_stage": output.get("agent_e_sub_stage"),
-                        "agent_e_quiz_index": output.get("agent_e_quiz_index")
-                    }
-                    yield f"data: {json.dumps(final_data)}\n\n"
+                            if initial_content:
+                                # 优化：直接发送整个块，不再逐字发送，提高前端显示速度
+                                yield {"type": "token", "content": initial_content}
+                else:
+                    # 已经在响应内容中了，寻找结束引号
+                    # 我们只需要发送当前 chunk 的内容，直到遇到非转义的引号
+                    if '"' in content:
+                        # 寻找非转义引号
+                        quote_match = re.search(r'(?<!\\)"', content)
+                        if quote_match:
+                            end_idx = quote_match.start()
+                            yield {"type": "token", "content": content[:end_idx]}
+                            response_started = False
+                            response_completed = True
+                        else:
+                            yield {"type": "token", "content": content}
+                    else:
+                        yield {"type": "token", "content": content}
+
+            # 显式忽略所有其他事件中的数据发送到前端 token 逻辑
+            # 只有 final 消息包含完整的结构化数据
+            elif kind == "on_chain_end" and event["name"] == "LangGraph":
+                output = event["data"]["output"]
+                print(f"DEBUG: LangGraph finished. Output keys: {list(output.keys())}")
+                agent_response = output.get("active_agent_response", "")
+                print(f"DEBUG: active_agent_response: {agent_response[:50]}...")
+                
+                # Log agent response
+                try:
+                    await _log(current_user_id, "agent", agent_response, group_type=request.group, student_id=request.student_id, meta=response_meta(output, calls))
+                except Exception as e:
+                    print(f"Error logging agent response: {e}")
 
-        except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'content': str(e)})}\n\n"
-        finally:
-            yield "data: [DONE]\n\n"
+                # 这里的 output 是 GlobalState 的字典形式，只下发与上一轮相比变化的字段
+                state = final_state(output, request)
+                dashboard.record(request.student_id, request.group, request.lesson_id, state)
+                final_data = {"type": "final", **state_differ.diff(session_key(request), state, request.state_version)}
+                yield final_data
 
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+    except Exception as e:
+        yield {"type": "error", "content": str(e)}
+    finally:
+        token_ledger.ledger.maybe_flush()
+
+def stream_owner(request: ChatRequest, http_request: Request) -> str:
+    """续传缓冲的归属：学生会话；匿名请求用 Idempotency-Key，没有时用客户端地址"""
+    key = session_key(request)
+    if key:
+        return f"session:{key}"
+    idempotency_key = http_request.headers.get("idempotency-key")
+    if idempotency_key:
+        return f"idempotency:{idempotency_key}"
+    return f"client:{http_request.client.host if http_request.client else ''}"
+
+async def _replay_events(events: List[dict]):
+    for event in events:
+        yield event
 
-@app.post("/api/execute", response_model=CodeExecutionResponse)
-async def execute_code(request: CodeExecutionRequest):
+@app.post("/api/chat_stream")
+@app.post("/chat_stream")
+async def chat_stream(request: ChatRequest, http_request: Request):
+    """SSE 对话流。每帧带 id（"<stream_id>:<seq>"），响应头 X-Stream-Id 为本轮的流 id。
+
+    断线后用同样的请求体重新 POST，并带上 Last-Event-ID 头，即从断点续传（本轮已结束时
+    直接补发剩余内容与 final），不会再次调用 main_graph；流已过期时按新的一轮处理。
+    带 Idempotency-Key 头的重复请求会订阅同一轮的事件流，或重放已保存的结果。
+    所有连接断开超过 SSE_RESUME_GRACE_SECONDS 仍未重连，才取消本轮生成。
+    """
+    print(f"Received request: group={request.group}, stage={request.stage}")
+    accept_encoding = http_request.headers.get("accept-encoding")
+    profile_headers = {}
+
+    def profiled(events):
+        # 管理员要求采样时，从本轮开始到事件流结束的整个过程都被记录
+        if not profile_requested(http_request.headers.get("x-profile"), http_request.headers.get("x-admin-token")):
+            return events
+        profile = profiler.begin("chat_stream")
+        profile_headers["X-Profile-Id"] = profile.id
+        return profiler.profiled(events, profile)
+
+    if not SSE_RESUME and not http_request.headers.get("idempotency-key"):
+        events = profiled(chat_events(request, is_disconnected=http_request.is_disconnected))
+        return sse_response(events, accept_encoding, headers=profile_headers)
+
+    owner = stream_owner(request, http_request)
+
+    def start():
+        turn = start_turn(session_key(request))
+        return open_stream(turn, profiled(coalesce_tokens(chat_events(request, turn=turn))), owner)
+
+    resume = parse_last_event_id(http_request.headers.get("last-event-id")) if SSE_RESUME else None
+    buffer = find_stream(resume[0], owner) if resume else None
+    after = 0
+    if buffer is not None:
+        print(f"DEBUG: Resuming stream {buffer.stream_id} after event {resume[1]}")
+        metrics.incr("sse_resumed")
+        after = resume[1]
+    else:
+        if resume:
+            metrics.incr("sse_resume_missed")
+        idempotency_key = http_request.headers.get("idempotency-key")
+        if idempotency_key:
+            try:
+                buffer = await idempotency.stream_once(idempotency_key, idempotency.fingerprint(request), start)
+            except idempotency.IdempotencyConflict as e:
+                raise HTTPException(status_code=422, detail=str(e))
+            if isinstance(buffer, list):
+                # 本轮早已完成且缓冲已过期：直接重放保存的内容与 final
+                return sse_response(_replay_events(buffer), accept_encoding)
+        else:
+            buffer = start()
+    return sse_response(
+        buffer.subscribe(after, http_request.is_disconnected),
+        accept_encoding,
+        numbered=True,
+        headers={"X-Stream-Id": buffer.stream_id, **profile_headers},
+    )
+
+def cacheable_code(code: str) -> bool:
+    """代码的输出是否只取决于代码与输入（保守判断，不确定时不缓存）"""
     try:
-        # 调试信息：打印环境信息
-        print(f"DEBUG: Executing code with {sys.executable}")
-        
-        # 创建临时文件保存代码
-        # 显式指定目录为 /tmp (Vercel 可写目录)
-        temp_dir = "/tmp"
-        if not os.path.exists(temp_dir):
-            os.makedirs(temp_dir, exist_ok=True)
-            
-        with tempfile.NamedTemporaryFile(suffix=".py", delete=False, mode="w", dir=temp_dir) as f:
-            f.write(request.code)
-            temp_file_path = f.name
-
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        return False
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Import, ast.ImportFrom, ast.Set, ast.SetComp)):
+            return False
+        if isinstance(node, ast.Name) and node.id in NONDETERMINISTIC_BUILTINS:
+            return False
+        if isinstance(node, ast.Attribute) and node.attr.startswith("__"):
+            return False
+    return True
+
+def run_code(request: CodeExecutionRequest) -> CodeExecutionResponse:
+    """运行学生代码（阻塞调用，异步场景下放到线程池执行）；
+    同一段代码与输入在 EXECUTE_CACHE_SECONDS 内直接返回缓存的结果，超时与内部错误不缓存"""
+    key = None
+    if EXECUTE_CACHE_SECONDS > 0 and cacheable_code(request.code):
+        key = idempotency.fingerprint(request)
         try:
-            # 准备标准输入数据
-            input_data = "\n".join(request.inputs) + "\n" if request.inputs else None
-
-            # 运行 Python 代码
-            # 尝试使用当前 sys.executable，如果失败则回退到 "python3"
-            cmd = [sys.executable, temp_file_path]
-            
-            print(f"DEBUG: Running command: {cmd}")
-            
-            process = subprocess.run(
-                cmd,
-                input=input_data, # 注入标准输入
-                capture_output=True,
-                text=True,
-                timeout=5  # 设置 5 秒超时
-            )
-            
-            output = process.stdout
-            error = process.stderr
-            
-            print(f"DEBUG: Execution result - ReturnCode: {process.returncode}")
-            if error:
-                print(f"DEBUG: Execution error: {error}")
-            
-            return CodeExecutionResponse(
-                output=output,
-                error=error if process.returncode != 0 else None
-            )
-        finally:
-            # 删除临时文件
-            if os.path.exists(temp_file_path):
-                os.remove(temp_file_path)
-                
+            cached = shared_state.cache_get("execute", key)
+        except Exception as e:
+            print(f"WARNING: Execute cache unavailable: {e}")
+            cached, key = None, None
+        if cached is not None:
+            metrics.incr("execute_cache_hits")
+            return CodeExecutionResponse(**cached)
+    try:
+        response = _run_subprocess(request)
     except subprocess.TimeoutExpired:
         return CodeExecutionResponse(output="", error="错误：代码运行超时（限时 5 秒）。")
     except Exception as e:
         import traceback
         traceback.print_exc()
         return CodeExecutionResponse(output="", error=f"执行出错：{str(e)}")
+    if key is not None:
+        try:
+            shared_state.cache_set("execute", key, response.model_dump(), EXECUTE_CACHE_SECONDS)
+        except Exception as e:
+            print(f"WARNING: Failed to cache execution result: {e}")
+    return response
+
+def _run_subprocess(request: CodeExecutionRequest) -> CodeExecutionResponse:
+    # 调试信息：打印环境信息
+    print(f"DEBUG: Executing code with {sys.executable}")
+    
+    # 创建临时文件保存代码
+    # 显式指定目录为 /tmp (Vercel 可写目录)
+    temp_dir = "/tmp"
+    if not os.path.exists(temp_dir):
+        os.makedirs(temp_dir, exist_ok=True)
+        
+    with tempfile.NamedTemporaryFile(suffix=".py", delete=False, mode="w", dir=temp_dir) as f:
+        f.write(request.code)
+        temp_file_path = f.name
+
+    try:
+        # 准备标准输入数据
+        input_data = "\n".join(request.inputs) + "\n" if request.inputs else None
+
+        # 运行 Python 代码
+        # 尝试使用当前 sys.executable，如果失败则回退到 "python3"
+        cmd = [sys.executable, temp_file_path]
+        trace_path = None
+        if request.trace:
+            # 由 exec_trace 在子进程中运行学生代码，并把执行轨迹写到单独的文件
+            trace_path = temp_file_path + ".trace.json"
+            cmd = [sys.executable, exec_trace.__file__, temp_file_path, trace_path]
+        
+        print(f"DEBUG: Running command: {cmd}")
+        
+        process = subprocess.run(
+            cmd,
+            input=input_data, # 注入标准输入
+            capture_output=True,
+            text=True,
+            timeout=5  # 设置 5 秒超时
+        )
+        
+        output = process.stdout
+        error = process.stderr
+        
+        print(f"DEBUG: Execution result - ReturnCode: {process.returncode}")
+        if error:
+            print(f"DEBUG: Execution error: {error}")
+        
+        trace = exec_trace.load_trace(trace_path) if trace_path else None
+        if trace is not None:
+            metrics.incr("execute_traced")
+        return CodeExecutionResponse(
+            output=output,
+            error=error if process.returncode != 0 else None,
+            trace=trace
+        )
+    finally:
+        # 删除临时文件
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+        if request.trace and os.path.exists(temp_file_path + ".trace.json"):
+            os.remove(temp_file_path + ".trace.json")
+
+@app.post("/api/execute", response_model=CodeExecutionResponse)
+async def execute_code(
+    request: CodeExecutionRequest,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None),
+    x_profile: Optional[str] = Header(None),
+    x_admin_token: Optional[str] = Header(None),
+):
+    if profile_requested(x_profile, x_admin_token):
+        return await run_profiled("execute", response, lambda: _execute_once(request, idempotency_key))
+    return await _execute_once(request, idempotency_key)
+
+async def _execute_once(request: CodeExecutionRequest, idempotency_key: Optional[str]) -> CodeExecutionResponse:
+    if not idempotency_key:
+        return await asyncio.to_thread(run_code, request)
+
+    async def compute():
+        return (await asyncio.to_thread(run_code, request)).model_dump()
+    try:
+        result = await idempotency.run_once("execute", idempotency_key, idempotency.fingerprint(request), compute)
+    except idempotency.IdempotencyConflict as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return CodeExecutionResponse(**result)
+
+@app.websocket("/ws/chat")
+@app.websocket("/api/ws/chat")
+async def chat_socket(websocket: WebSocket):
+    """学生的持久连接：对话、代码运行、语法检查复用同一个 WebSocket。
+
+    客户端消息（JSON）:
+      {"type": "hello", "user_id": ..., "student_id": ..., "group": ...}   设置本连接的默认字段
+      {"type": "chat", "id": ..., "request": {ChatRequest 字段}}            新的一轮对话，会取消仍在生成的上一轮
+      {"type": "cancel", "id": ...}                                         取消指定轮次
+      {"type": "execute", "id": ..., "code": ..., "inputs": [...], "trace": false}
+      {"type": "check_syntax", "id": ..., "code": ...}
+    服务端消息都带有对应的 id，type 为 token/final/error/done/cancelled/execute_result/syntax_result；
+    无法解析的消息回复 error，连接保持。
+    目前只有服务端：前端仍走 /api/chat_stream (SSE) 与 /api/execute，尚未接入这个连接。
+    """
+    await websocket.accept()
+    send_lock = asyncio.Lock()
+    defaults: Dict[str, Any] = {}
+    tasks = set()
+    chat_turn = {"id": None, "task": None}
+
+    async def send(message: dict):
+        async with send_lock:
+            await websocket.send_text(json.dumps(message, ensure_ascii=False))
+
+    def spawn(coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return task
+
+    async def run_chat(turn_id, request: ChatRequest):
+        try:
+            async for event in coalesce_tokens(chat_events(request)):
+                await send({"id": turn_id, **event})
+            await send({"id": turn_id, "type": "done"})
+        except asyncio.CancelledError:
+            try:
+                await send({"id": turn_id, "type": "cancelled"})
+            except Exception:
+                pass
+            raise
+
+    async def run_execute(msg_id, request: CodeExecutionRequest):
+        result = await asyncio.to_thread(run_code, request)
+        await send({"id": msg_id, "type": "execute_result", **result.model_dump()})
+
+    def cancel_chat():
+        if chat_turn["task"] is not None and not chat_turn["task"].done():
+            chat_turn["task"].cancel()
+
+    try:
+        while True:
+            text = await websocket.receive_text()
+            msg_id = None
+            try:
+                message = json.loads(text)
+                msg_id = message.get("id")
+                kind = message.get("type")
+                if kind == "hello":
+                    defaults = {k: message[k] for k in ("user_id", "student_id", "group") if message.get(k) is not None}
+                    await send({"type": "ready"})
+                elif kind == "chat":
+                    request = ChatRequest(**{**defaults, **message.get("request", {})})
+                    cancel_chat()
+                    chat_turn["id"] = msg_id
+                    chat_turn["task"] = spawn(run_chat(msg_id, request))
+                elif kind == "cancel":
+                    if msg_id is None or msg_id == chat_turn["id"]:
+                        cancel_chat()
+                elif kind == "execute":
+                    spawn(run_execute(msg_id, CodeExecutionRequest(code=message.get("code", ""), inputs=message.get("inputs", []), trace=bool(message.get("trace")))))
+                elif kind == "check_syntax":
+                    result = run_syntax_check(SyntaxCheckRequest(code=message.get("code", "")))
+                    await send({"id": msg_id, "type": "syntax_result", **result.model_dump()})
+                else:
+                    await send({"id": msg_id, "type": "error", "content": f"Unknown message type: {kind}"})
+            except (ValueError, TypeError, AttributeError) as e:
+                # 非 JSON、不是对象或字段类型不对（pydantic 的 ValidationError 也是 ValueError）
+                await send({"id": msg_id, "type": "error", "content": f"Invalid message: {e}"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        for task in list(tasks):
+            task.cancel()
 
 @app.get("/api/health")
 async def health():
     return {"status": "ok"}
 
+@app.get("/api/metrics")
+async def get_metrics():
+    # 多 worker 时需要读写共享的 SQLite 计数器
+    return await asyncio.to_thread(metrics.snapshot)
+
+@app.post("/api/admin/warmup", dependencies=[Depends(require_admin)])
+async def admin_warmup(variants: int = 3, reset: bool = False):
+    from warmup import run_warmup
+    return await run_warmup(variants=variants, reset=reset)
+
+@app.get("/api/admin/profiles", dependencies=[Depends(require_admin)])
+async def list_profiles():
+    """最近保存的请求采样结果（最新的在前）"""
+    return {"profiles": profiler.store.list()}
+
+@app.get("/api/admin/profiles/{profile_id}", dependencies=[Depends(require_admin)])
+async def get_profile(profile_id: str):
+    """按响应头 X-Profile-Id 取回一次请求的节点时间线与折叠调用栈"""
+    result = profiler.store.get(profile_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return result
+
+@app.get("/api/logs", response_model=ChatLogPage, dependencies=[Depends(require_admin)])
+async def get_logs(
+    student_id: Optional[str] = None,
+    group: Optional[str] = None,
+    role: Optional[str] = None,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+):
+    """按学生 / 分组 / 角色 / 时间范围查询对话日志，用返回的 next_cursor 翻页"""
+    from logs import fetch_logs
+    db = _database()
+    try:
+        async with db.AsyncSessionLocal() as session:
+            return await fetch_logs(
+                session,
+                limit=limit,
+                student_id=student_id,
+                group_type=group,
+                role=role,
+                since=since,
+                until=until,
+                cursor=cursor,
+                descending=order == "desc",
+            )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/logs/export", dependencies=[Depends(require_admin)])
+async def export_logs_endpoint(
+    format: str = Query("csv", pattern="^(csv|jsonl|parquet)$"),
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+    group: Optional[str] = None,
+    student_id: Optional[str] = None,
+):
+    """流式导出对话日志（按会话分组、带阶段与轮次）。
+
+    响应头 X-Export-Watermark 为本次导出的截止时间，下次传入 since 即可增量导出。
+    """
+    from log_export import FORMATS, export_logs, make_encoder, default_watermark
+    try:
+        make_encoder(format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    until = until or default_watermark()
+    headers = {
+        "X-Export-Watermark": until.isoformat(),
+        "Content-Disposition": f'attachment; filename="chatlog_{until:%Y%m%dT%H%M%S}.{format}"',
+    }
+    return StreamingResponse(
+        export_logs(format, since, until, group, student_id),
+        media_type=FORMATS[format],
+        headers=headers,
+    )
+
+@app.get("/api/token_usage", dependencies=[Depends(require_admin)])
+async def token_usage_report(
+    by: str = Query("student", pattern="^(student|group|lesson)$"),
+    lesson: Optional[str] = None,
+    group: Optional[str] = None,
+    student_id: Optional[str] = None,
+):
+    """按学生 / 分组 / 课汇总 token 用量，budget 为已超出的预算级别（soft / hard）"""
+    rows = await token_ledger.report(by=by, lesson=lesson, group=group, student_id=student_id)
+    return {"by": by, "budgets": token_ledger.budgets(), "rows": rows}
+
+@app.get("/api/teacher/stream", dependencies=[Depends(require_admin_stream)])
+async def teacher_stream(http_request: Request, lesson: Optional[str] = None):
+    """教师看板（SSE）：先推送全班快照，之后每个 tick 推送变化的聚合项与学生状态"""
+    return StreamingResponse(
+        dashboard.stream(lesson, http_request.is_disconnected),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # Serve static files if they exist (Production/Docker)
 # In Docker: /app/src/main.py -> static is at /app/static -> ../static
 static_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "static")
 
 if os.path.exists(static_dir):
-    # Mount assets directory if it exists
-    assets_dir = os.path.join(static_dir, "assets")
-    if os.path.exists(assets_dir):
-        app.mount("/assets", StaticFiles(directory=assets_dir), name="assets")
+    static_site = StaticSite(static_dir)
 
     @app.get("/")
-    async def serve_index():
-        return FileResponse(os.path.join(static_dir, "index.html"))
+    async def serve_index(request: Request):
+        return static_site.respond("index.html", request.headers)
 
     @app.get("/{full_path:path}")
-    async def serve_frontend(full_path: str):
+    async def serve_frontend(full_path: str, request: Request):
         if full_path.startswith("api"):
             raise HTTPException(status_code=404)
-        
-        file_path = os.path.join(static_dir, full_path)
-        if os.path.exists(file_path) and os.path.isfile(file_path):
-            return FileResponse(file_path)
-        
-        # SPA fallback
-        return FileResponse(os.path.join(static_dir, "index.html"))
+        # 构建产物在启动时已建立索引；不存在的路径返回 index.html（SPA 前端路由）
+        return static_site.respond(full_path, request.headers)
 else:
     @app.get("/")
     async def root():
         return {"message": "Hello! LogicLoom is running! (Backend Only Mode)"}
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # WORKERS>1 时启动多个 worker 进程（建议值见 backend/bench/workers.py 的测量结果）。
+    # 计数器、执行结果缓存、幂等记录与教师看板经 SQLite（WAL）在进程间共享；
+    # LLM 客户端与配置仍是每个进程一份。
+    # uvicorn 的多 worker 共用一个端口，无法按会话路由，因此这种模式下：
+    # - 关闭 SSE 续传（SSE_RESUME=0）：断线重试靠 Idempotency-Key，落到别的 worker 时等原来那一轮
+    #   结束后重放保存的结果；原 worker 上的连接断开即取消生成（SSE_RESUME_GRACE_SECONDS=0），
+    #   重试不必等宽限期结束再重新生成
+    # - 关闭状态增量（STATE_DIFF=0），每轮下发完整状态
+    # - 新消息取消同一会话上一轮生成只在同一个 worker 内有效，不跨 worker
+    workers = int(os.getenv("WORKERS", "1"))
+    port = int(os.getenv("PORT", "8000"))
+    if workers > 1:
+        os.environ.setdefault("SHARED_STATE", "1")
+        os.environ.setdefault("IDEMPOTENCY_STORE", "sqlite")
+        os.environ.setdefault("SSE_RESUME", "0")
+        os.environ.setdefault("SSE_RESUME_GRACE_SECONDS", "0")
+        os.environ.setdefault("STATE_DIFF", "0")
+        uvicorn.run("main:app", host="0.0.0.0", port=port, workers=workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=port)
@@ -0,0 +1,65 @@
+import os
+import time
+import atexit
+import threading
+from collections import defaultdict
+from typing import Dict, Optional
+
+# 进程内计数器：各模块通过 incr() 累加，/api/metrics 读取快照
+_lock = threading.Lock()
+_counters: Dict[str, float] = defaultdict(float)
+
+# 多 worker 部署（SHARED_STATE=1）时，各进程的增量每隔这么多秒合并到共享的 SQLite 计数器中
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "1"))
+_shared = os.getenv("SHARED_STATE", "0") != "0"
+_flusher: Optional[threading.Thread] = None
+
+
+def incr(name: str, value: float = 1) -> None:
+    """累加计数器；多 worker 时由后台线程定期合并，不在调用方（通常是事件循环）上写 SQLite"""
+    global _flusher
+    with _lock:
+        _counters[name] += value
+        start = _shared and _flusher is None
+        if start:
+            _flusher = threading.Thread(target=_flush_loop, name="metrics-flusher", daemon=True)
+    if start:
+        _flusher.start()
+
+
+def _flush_loop() -> None:
+    while True:
+        time.sleep(METRICS_FLUSH_SECONDS)
+        flush()
+
+
+def flush() -> None:
+    """把本进程尚未合并的增量写入共享计数器"""
+    if not _shared:
+        return
+    from shared_state import shared_state
+    with _lock:
+        if not _counters:
+            return
+        pending = dict(_counters)
+        _counters.clear()
+    try:
+        shared_state.add_counters(pending)
+    except Exception as e:
+        print(f"WARNING: Failed to flush shared metrics: {e}")
+        with _lock:
+            for name, value in pending.items():
+                _counters[name] += value
+
+
+def snapshot() -> Dict[str, float]:
+    """返回所有计数器的当前值（多 worker 时为所有进程之和）"""
+    if _shared:
+        from shared_state import shared_state
+        flush()
+        return shared_state.counters()
+    with _lock:
+        return dict(_counters)
+
+
+atexit.register(flush)
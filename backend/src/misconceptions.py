@@ -0,0 +1,152 @@
+"""误区分类器的训练与评估：用人工标注的学生消息训练 n-gram 模型，报告准确率与延迟。
+
+标注文件为 JSONL，每行 {"text": ..., "label": ...}，可从 log_export 导出的日志中挑选学生消息标注。
+不用规则结果充当标签：那样模型只会学到规则本身（包括规则的误判），覆盖不到规则以外的说法。
+
+用法（在 backend/src 目录下）:
+    python misconceptions.py train --labels gold.jsonl --report report.json   # 训练并保存模型
+    python misconceptions.py eval --labels gold.jsonl                         # 评估当前的规则 + 模型
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from collections import Counter
+from typing import Callable, Dict, List, Tuple
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from graphs.misconception import (
+    LABELS,
+    NONE,
+    MISCONCEPTION_MODEL_PATH,
+    MisconceptionClassifier,
+    NgramModel,
+    match_rules,
+)
+
+
+def load_labels(path: str) -> Dict[str, str]:
+    labelled = {}
+    with open(path, "r", encoding="utf-8") as fd:
+        for line in fd:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if item["label"] not in LABELS:
+                raise ValueError(f"Unknown label {item['label']!r}, expected one of {LABELS}")
+            labelled[item["text"]] = item["label"]
+    return labelled
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+def evaluate(predict: Callable[[str], str], dataset: List[Tuple[str, str]]) -> dict:
+    """准确率、各标签的精确率/召回率，以及单次预测的延迟（微秒）"""
+    predicted, latencies = [], []
+    if dataset:
+        # 第一次调用会加载模型文件，不计入延迟
+        predict(dataset[0][0])
+    for text, _ in dataset:
+        started = time.perf_counter()
+        predicted.append(predict(text))
+        latencies.append((time.perf_counter() - started) * 1e6)
+    correct = sum(p == label for p, (_, label) in zip(predicted, dataset))
+    per_label = {}
+    for label in LABELS:
+        tp = sum(p == label and gold == label for p, (_, gold) in zip(predicted, dataset))
+        n_predicted = sum(p == label for p in predicted)
+        support = sum(gold == label for _, gold in dataset)
+        if support or n_predicted:
+            per_label[label] = {
+                "support": support,
+                "precision": round(tp / n_predicted, 3) if n_predicted else 0.0,
+                "recall": round(tp / support, 3) if support else 0.0,
+            }
+    return {
+        "samples": len(dataset),
+        "accuracy": round(correct / len(dataset), 3) if dataset else 0.0,
+        "labels": per_label,
+        "latency_us": {
+            "p50": round(_percentile(latencies, 0.5), 1),
+            "p99": round(_percentile(latencies, 0.99), 1),
+            "max": round(max(latencies), 1) if latencies else 0.0,
+        },
+    }
+
+
+def classifier_predict(classifier: MisconceptionClassifier) -> Callable[[str], str]:
+    def predict(text: str) -> str:
+        result = classifier.classify(text)
+        return result.label if result else NONE
+    return predict
+
+
+def train(dataset: List[Tuple[str, str]], out: str, holdout: float, seed: int) -> dict:
+    """先在留出集上评估，再用全部数据训练并保存模型"""
+    shuffled = list(dataset)
+    random.Random(seed).shuffle(shuffled)
+    cut = int(len(shuffled) * (1 - holdout))
+    train_set, test_set = shuffled[:cut], shuffled[cut:]
+    report = {"samples": len(dataset), "distribution": dict(Counter(label for _, label in dataset))}
+    if train_set and test_set:
+        model = NgramModel.train([t for t, _ in train_set], [l for _, l in train_set])
+        report["holdout_model"] = evaluate(lambda text: model.predict(text)[0], test_set)
+        report["holdout_rules"] = evaluate(lambda text: match_rules(text) or NONE, test_set)
+    model = NgramModel.train([t for t, _ in dataset], [l for _, l in dataset])
+    model.save(out)
+    report["model_path"] = out
+    return report
+
+
+def print_report(report: dict) -> None:
+    for name, result in report.items():
+        if not isinstance(result, dict) or "accuracy" not in result:
+            continue
+        latency = result["latency_us"]
+        print(f"  {name:<16} n={result['samples']:<6} accuracy {result['accuracy']:.3f}  "
+              f"latency p50 {latency['p50']:.1f}us p99 {latency['p99']:.1f}us")
+        for label, stats in result["labels"].items():
+            print(f"    {label:<22} support {stats['support']:>5}  precision {stats['precision']:.3f}  recall {stats['recall']:.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="M-CAST 误区分类器训练与评估")
+    parser.add_argument("command", choices=["train", "eval"])
+    parser.add_argument("--labels", required=True, help="人工标注的 JSONL 文件")
+    parser.add_argument("--model", default=MISCONCEPTION_MODEL_PATH, help="模型文件路径")
+    parser.add_argument("--holdout", type=float, default=0.2, help="train 时用于评估的留出比例")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report", default=None, help="把报告写入 JSON 文件")
+    args = parser.parse_args()
+
+    dataset = list(load_labels(args.labels).items())
+    if not dataset:
+        print(f"No labelled messages in {args.labels}")
+        sys.exit(1)
+    if args.command == "train":
+        report = train(dataset, args.model, args.holdout, args.seed)
+        print(f"Trained on {report['samples']} messages {report['distribution']}, saved to {report['model_path']}")
+    else:
+        classifier = MisconceptionClassifier(model_path=args.model)
+        report = {
+            "classifier": evaluate(classifier_predict(classifier), dataset),
+            "rules": evaluate(lambda text: match_rules(text) or NONE, dataset),
+            "model_loaded": classifier.model is not None,
+        }
+        print(f"Evaluated {len(dataset)} labelled messages (model {'loaded' if report['model_loaded'] else 'missing'})")
+    print_report(report)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as fd:
+            json.dump(report, fd, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import threading
+import contextvars
+from collections import Counter
+from typing import AsyncIterator, Dict, List, Optional
+
+import metrics
+
+# 单个请求的采样分析：管理员在 /api/chat、/api/chat_stream、/api/execute 请求上带 X-Profile: 1
+# （以及 X-Admin-Token）时，请求期间定时采样各线程的调用栈，并记录 LangGraph 各节点与模型调用的时间线。
+# 结果写入磁盘上的环形目录，按响应头 X-Profile-Id 经 /api/admin/profiles/{id} 取回；不带该请求头时没有任何额外开销
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/mcast_profiles")
+# 最多保留多少份结果，超出时删除最旧的
+PROFILE_RING_SIZE = int(os.getenv("PROFILE_RING_SIZE", "50"))
+# 采样间隔（毫秒）
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+# 每份结果最多保存的调用栈条数（按采样次数从多到少）
+PROFILE_MAX_STACKS = int(os.getenv("PROFILE_MAX_STACKS", "300"))
+MAX_STACK_DEPTH = 64
+
+# 空闲的线程池线程、没有任务可运行的事件循环：在 IDLE_WAITS 中等待且由 IDLE_CALLERS 调用，不计入调用栈。
+# 请求自身的等待（如等待运行学生代码的子进程）仍会计入
+IDLE_WAITS = {"threading.py:wait", "queue.py:get", "selectors.py:select"}
+IDLE_CALLERS = {"thread.py:_worker", "base_events.py:_run_once"}
+
+PROFILE_ID = re.compile(r"^[0-9a-f]{32}$")
+
+_current: contextvars.ContextVar[Optional["Profile"]] = contextvars.ContextVar("request_profile", default=None)
+
+
+def _frame_name(frame) -> str:
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+
+def _idle(frame) -> bool:
+    if _frame_name(frame) not in IDLE_WAITS:
+        return False
+    for _ in range(3):
+        frame = frame.f_back
+        if frame is None:
+            return False
+        if _frame_name(frame) in IDLE_CALLERS:
+            return True
+    return False
+
+
+class Sampler(threading.Thread):
+    """后台线程，每隔 interval 秒取一次所有线程的调用栈，按折叠栈（flamegraph 格式）计数。
+
+    事件循环线程上同时运行的其他请求也会被采到，忙时的结果需结合时间线阅读"""
+
+    def __init__(self, interval: float):
+        super().__init__(name="request-profiler", daemon=True)
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.idle = 0
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        own = threading.get_ident()
+        names = {}
+        while not self._stop_event.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                self.samples += 1
+                if _idle(frame):
+                    self.idle += 1
+                    continue
+                if ident not in names:
+                    names.update((thread.ident, thread.name) for thread in threading.enumerate())
+                stack = []
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    stack.append(f"{_frame_name(frame)}:{frame.f_lineno}" if not stack else _frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+
+
+class Profile:
+    """一次请求的采样结果与时间线（毫秒，相对请求开始）"""
+
+    def __init__(self, endpoint: str):
+        self.id = uuid.uuid4().hex
+        self.endpoint = endpoint
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.timeline: List[dict] = []
+        self._open: Dict[uuid.UUID, dict] = {}
+        self._sampler = Sampler(PROFILE_INTERVAL_MS / 1000)
+        self._sampler.start()
+        self._finished = False
+
+    def elapsed_ms(self) -> float:
+        return round((time.perf_counter() - self._started) * 1000, 1)
+
+    def span_start(self, run_id: uuid.UUID, kind: str, name: str, node: Optional[str]) -> None:
+        span = {"kind": kind, "name": name, "node": node, "start_ms": self.elapsed_ms(), "end_ms": None}
+        self._open[run_id] = span
+        self.timeline.append(span)
+
+    def span_end(self, run_id: uuid.UUID, error: Optional[BaseException] = None) -> None:
+        span = self._open.pop(run_id, None)
+        if span is None:
+            return
+        span["end_ms"] = self.elapsed_ms()
+        if error is not None:
+            span["error"] = repr(error)
+
+    def finish(self, **extra) -> None:
+        """停止采样并写入环形目录；重复调用只生效一次"""
+        if self._finished:
+            return
+        self._finished = True
+        self._sampler.stop()
+        duration_ms = self.elapsed_ms()
+        stacks = self._sampler.stacks.most_common(PROFILE_MAX_STACKS)
+        result = {
+            "id": self.id,
+            "endpoint": self.endpoint,
+            "started_at": self.started_at,
+            "duration_ms": duration_ms,
+            "interval_ms": PROFILE_INTERVAL_MS,
+            "samples": self._sampler.samples,
+            "idle_samples": self._sampler.idle,
+            "timeline": self.timeline,
+            # 折叠栈："线程;外层函数;...;栈顶函数:行号" -> 采样次数，可直接交给 flamegraph / speedscope
+            "stacks": dict(stacks),
+            **extra,
+        }
+        try:
+            store.write(result)
+            metrics.incr("profiles_captured")
+        except OSError as e:
+            print(f"WARNING: Failed to save profile {self.id}: {e}")
+
+
+class ProfileStore:
+    """磁盘上的环形目录：每份结果一个 JSON 文件，超过 size 份时删除最旧的"""
+
+    def __init__(self, directory: str = PROFILE_DIR, size: int = PROFILE_RING_SIZE):
+        self.directory = directory
+        self.size = size
+        self._lock = threading.Lock()
+
+    def _entries(self) -> List[os.DirEntry]:
+        try:
+            entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".json")]
+        except FileNotFoundError:
+            return []
+        return sorted(entries, key=lambda entry: entry.stat().st_mtime)
+
+    def write(self, result: dict) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{result['id']}.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as fd:
+            json.dump(result, fd, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+        with self._lock:
+            entries = self._entries()
+            for entry in entries[:max(len(entries) - self.size, 0)]:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def get(self, profile_id: str) -> Optional[dict]:
+        if not PROFILE_ID.match(profile_id):
+            return None
+        try:
+            with open(os.path.join(self.directory, f"{profile_id}.json"), "r", encoding="utf-8") as fd:
+                return json.load(fd)
+        except FileNotFoundError:
+            return None
+
+    def list(self) -> List[dict]:
+        """最新的在前，只返回摘要"""
+        summaries = []
+        for entry in reversed(self._entries()):
+            summaries.append({"id": entry.name[:-5], "saved_at": entry.stat().st_mtime, "bytes": entry.stat().st_size})
+        return summaries
+
+
+store = ProfileStore()
+
+
+def begin(endpoint: str) -> Profile:
+    """开始采样，并把结果绑定到当前上下文（之后启动的 graph 运行会记录节点时间线）"""
+    profile = Profile(endpoint)
+    _current.set(profile)
+    return profile
+
+
+def graph_config() -> Optional[dict]:
+    """当前请求在采样时，main_graph 运行用的 config（带记录时间线的回调）；否则为 None"""
+    profile = _current.get()
+    if profile is None:
+        return None
+    return {"callbacks": [_timeline_handler(profile)]}
+
+
+async def profiled(events: AsyncIterator, profile: Profile) -> AsyncIterator:
+    """事件流结束（或客户端断开）时结束采样"""
+    try:
+        async for event in events:
+            yield event
+    finally:
+        profile.finish()
+
+
+def _timeline_handler(profile: Profile):
+    # langchain_core 按需导入，保持冷启动
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    class TimelineHandler(BaseCallbackHandler):
+        """记录 LangGraph 节点与其中模型调用的起止时间"""
+
+        run_inline = True
+
+        def on_chain_start(self, serialized, inputs, *, run_id, metadata=None, **kwargs):
+            node = (metadata or {}).get("langgraph_node")
+            if node is not None and kwargs.get("name") == node:
+                profile.span_start(run_id, "node", node, node)
+
+        def on_chain_end(self, outputs, *, run_id, **kwargs):
+            profile.span_end(run_id)
+
+        def on_chain_error(self, error, *, run_id, **kwargs):
+            profile.span_end(run_id, error)
+
+        def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+            name = kwargs.get("name") or (serialized or {}).get("name") or "chat_model"
+            profile.span_start(run_id, "llm", name, (metadata or {}).get("langgraph_node"))
+
+        def on_llm_end(self, response, *, run_id, **kwargs):
+            profile.span_end(run_id)
+
+        def on_llm_error(self, error, *, run_id, **kwargs):
+            profile.span_end(run_id, error)
+
+    return TimelineHandler()
@@ -0,0 +1,475 @@
+"""对话日志离线回放：从日志还原每个学生的对话轮次，用录制的模型回复（cassette）重放 main_graph，
+统计各节点耗时、token 数以及回放结果与日志不一致的轮次。
+
+cassette 模式按日志 meta 中记录的原始输出、首 token 时间和总耗时逐块返回模型回复；
+没有 meta 的旧日志用记录的回复正文合成 {"response": ...}，耗时按 --ttft / --chars-per-second 模拟。
+修改 graphs/node.py 或 config 后重新回放并与基线报告对比，即可离线发现吞吐回退。
+
+用法（在 backend/src 目录下）:
+    python replay.py --out baseline.json                               # 从数据库读取日志
+    python replay.py --source logs.jsonl --baseline baseline.json     # 读取 log_export 导出的 JSONL 并与基线对比
+    python replay.py --speed 0 --concurrency 8                         # 不模拟模型耗时，只测 graph 自身开销
+"""
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import argparse
+import datetime
+import contextvars
+import statistics
+import traceback
+from collections import defaultdict
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+# 回放时每一轮都要真正走到 cassette：关闭预热缓存与请求合并（须在导入 graphs 之前设置）
+os.environ["RESPONSE_CACHE"] = "0"
+os.environ["LLM_COALESCE"] = "0"
+os.environ["ADAPTIVE_LIMITS"] = "0"
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from schemas import ChatRequest, REQUEST_STATE_FIELDS, graph_inputs
+from graphs.graph import main_graph
+from graphs.node import set_llm_override
+from graphs.llm_stream import bind_call_recorder
+
+# 没有录制耗时的旧日志使用的模拟参数
+DEFAULT_TTFT_MS = 800.0
+DEFAULT_CHARS_PER_SECOND = 60.0
+# 没有 usage 时按字符数估算 token
+CHARS_PER_TOKEN = 1.5
+CHUNK_CHARS = 4
+
+NODES = [name for name in main_graph.nodes if not name.startswith("__")]
+
+
+def _estimate_tokens(chars: int) -> int:
+    return math.ceil(chars / CHARS_PER_TOKEN)
+
+
+class Turn:
+    """日志中的一轮：一条学生消息及其后的智能体回复"""
+
+    def __init__(self, record: dict, context: str):
+        meta = record.get("meta") or {}
+        self.session_key = record["session_key"]
+        self.turn_index = record["turn_index"]
+        self.group_type = record["group_type"]
+        self.user_input = record["content"] or ""
+        self.stage = meta.get("stage") or record["stage"]
+        # 旧日志没有记录子阶段字段，回放时沿用上一轮回放的输出
+        self.fields = {field: meta[field] for field in REQUEST_STATE_FIELDS if field in meta}
+        self.context = context
+        self.response: Optional[str] = None
+        self.logged_state: Optional[dict] = None
+        self.calls: List[dict] = []
+        self.cancelled = False
+
+    def attach(self, record: dict) -> None:
+        if record["role"] == "cancelled":
+            self.cancelled = True
+            return
+        meta = record.get("meta") or {}
+        self.response = record["content"] or ""
+        self.logged_state = meta.get("state")
+        self.calls = meta.get("llm_calls") or []
+
+    def request(self, carried: dict) -> ChatRequest:
+        fields = {**carried, **self.fields}
+        return ChatRequest(stage=self.stage, user_input=self.user_input, context=self.context, group=self.group_type, **fields)
+
+
+def build_turns(records: List[dict]) -> List[Turn]:
+    """一个会话的日志记录（按时间排序）-> 轮次列表；context 按前端的格式由之前的消息拼出"""
+    turns: List[Turn] = []
+    history: List[str] = []
+    for record in records:
+        if record["role"] == "user":
+            turns.append(Turn(record, "\n".join(history)))
+            history.append(f"user: {record['content'] or ''}")
+        elif record["role"] in ("agent", "cancelled") and turns:
+            turns[-1].attach(record)
+            if record["role"] == "agent":
+                history.append(f"assistant: {record['content'] or ''}")
+    return turns
+
+
+def _group_sessions(records) -> Dict[str, List[dict]]:
+    sessions: Dict[str, List[dict]] = defaultdict(list)
+    for record in records:
+        sessions[record["session_key"]].append(record)
+    return sessions
+
+
+async def load_sessions_db(since=None, until=None, group_type=None, student_id=None) -> Dict[str, List[Turn]]:
+    from log_export import iter_records
+    records = []
+    # 回放不需要导出水位线的安全间隔，默认读到当前时间
+    until = until or datetime.datetime.utcnow()
+    async for batch in iter_records(since, until, group_type, student_id):
+        records.extend(batch)
+    return {key: build_turns(rows) for key, rows in _group_sessions(records).items()}
+
+
+def load_sessions_jsonl(path: str) -> Dict[str, List[Turn]]:
+    """读取 log_export --format jsonl 的导出文件（已按会话、时间排序）"""
+    with open(path, "r", encoding="utf-8") as fd:
+        records = [json.loads(line) for line in fd if line.strip()]
+    return {key: build_turns(rows) for key, rows in _group_sessions(records).items()}
+
+
+class Tape:
+    """一轮回放中按顺序提供的录制调用，并记录 cassette 实际返回的内容"""
+
+    def __init__(self, turn: Turn):
+        self.calls = list(turn.calls)
+        self.fallback = turn.response
+        self.position = 0
+        self.served: List[dict] = []
+
+    def next_call(self) -> Optional[dict]:
+        if self.position < len(self.calls):
+            call = self.calls[self.position]
+        elif self.position == 0 and self.fallback is not None:
+            # 旧日志：只有最终回复正文
+            call = {"text": json.dumps({"response": self.fallback}, ensure_ascii=False)}
+        else:
+            call = None
+        self.position += 1
+        return call
+
+
+_tape: contextvars.ContextVar[Optional[Tape]] = contextvars.ContextVar("replay_tape", default=None)
+
+
+class CassetteLLM(BaseChatModel):
+    """按当前轮次的 Tape 返回录制的模型输出，并按录制（或模拟）的耗时逐块输出"""
+
+    model_name: str = "cassette"
+    speed: float = 1.0  # 耗时倍率，0 表示不等待
+    ttft_ms: float = DEFAULT_TTFT_MS
+    chars_per_second: float = DEFAULT_CHARS_PER_SECOND
+
+    @property
+    def _llm_type(self) -> str:
+        return "cassette"
+
+    def _plan(self, messages) -> tuple:
+        """取出本次调用要返回的文本，并计算各块之前的等待时间（秒）"""
+        tape = _tape.get()
+        call = tape.next_call() if tape is not None else None
+        if call is None:
+            # graph 比录制时多调用了模型，返回空结果并记为不一致
+            call = {"text": "", "extra": True}
+        text = call.get("text") or ""
+        pieces = [text[i:i + CHUNK_CHARS] for i in range(0, len(text), CHUNK_CHARS)] or [""]
+
+        ttft = call.get("first_token_ms")
+        latency = call.get("latency_ms")
+        if ttft is None:
+            ttft = self.ttft_ms
+            latency = ttft + len(text) / self.chars_per_second * 1000
+        gap = max((latency or ttft) - ttft, 0) / max(len(pieces) - 1, 1)
+        delays = [ttft / 1000 * self.speed] + [gap / 1000 * self.speed] * (len(pieces) - 1)
+
+        prompt_chars = sum(len(str(m.content)) for m in messages)
+        usage = {
+            "input_tokens": call.get("input_tokens") or _estimate_tokens(prompt_chars),
+            "output_tokens": call.get("output_tokens") or call.get("chunks") or _estimate_tokens(len(text)),
+        }
+        usage["total_tokens"] = usage["input_tokens"] + usage["output_tokens"]
+        if tape is not None:
+            tape.served.append({"prompt_chars": prompt_chars, "extra": bool(call.get("extra")), **usage})
+        return pieces, delays, usage
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        text = "".join(chunk.message.content for chunk in self._stream(messages, stop, run_manager, **kwargs))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def _chunk(self, piece: str, last: bool, usage: dict) -> ChatGenerationChunk:
+        return ChatGenerationChunk(message=AIMessageChunk(content=piece, usage_metadata=usage if last else None))
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        pieces, delays, usage = self._plan(messages)
+        for i, (piece, delay) in enumerate(zip(pieces, delays)):
+            if delay:
+                time.sleep(delay)
+            chunk = self._chunk(piece, i == len(pieces) - 1, usage)
+            if run_manager:
+                run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        pieces, delays, usage = self._plan(messages)
+        for i, (piece, delay) in enumerate(zip(pieces, delays)):
+            if delay:
+                await asyncio.sleep(delay)
+            chunk = self._chunk(piece, i == len(pieces) - 1, usage)
+            if run_manager:
+                await run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
+
+
+def _divergences(turn: Turn, output: dict, calls: List[dict], tape: Tape) -> List[dict]:
+    """回放结果与日志不一致的地方（只比较日志中有记录的部分）"""
+    found = []
+    if turn.calls:
+        logged = [call.get("agent") for call in turn.calls]
+        replayed = [call["agent"] for call in calls]
+        if logged != replayed:
+            found.append({"kind": "llm_calls", "logged": logged, "replayed": replayed})
+    elif any(served["extra"] for served in tape.served):
+        found.append({"kind": "llm_calls", "logged": 1, "replayed": len(tape.served)})
+    response = output.get("active_agent_response", "")
+    if turn.response is not None and response != turn.response:
+        found.append({"kind": "response", "logged": turn.response[:200], "replayed": response[:200]})
+    for field, value in (turn.logged_state or {}).items():
+        if output.get(field) != value:
+            found.append({"kind": f"state.{field}", "logged": value, "replayed": output.get(field)})
+    return found
+
+
+async def replay_turn(turn: Turn, carried: dict) -> dict:
+    """回放一轮，返回各节点耗时、token 数与不一致项"""
+    tape = Tape(turn)
+    _tape.set(tape)
+    calls: List[dict] = []
+    bind_call_recorder(calls)
+
+    started: Dict[str, float] = {}
+    nodes: Dict[str, float] = defaultdict(float)
+    llm_ms: Dict[str, float] = defaultdict(float)
+    output: dict = {}
+    error = None
+    turn_started = time.perf_counter()
+    try:
+        inputs = graph_inputs(turn.request(carried))
+        async for event in main_graph.astream_events(inputs, version="v2"):
+            kind = event["event"]
+            name = event["name"]
+            node = event.get("metadata", {}).get("langgraph_node")
+            if kind in ("on_chain_start", "on_chat_model_start") and (name in NODES or kind == "on_chat_model_start"):
+                started[event["run_id"]] = time.perf_counter()
+            elif kind == "on_chain_end" and name in NODES and event["run_id"] in started:
+                nodes[name] += (time.perf_counter() - started.pop(event["run_id"])) * 1000
+            elif kind == "on_chat_model_end" and event["run_id"] in started:
+                llm_ms[node] += (time.perf_counter() - started.pop(event["run_id"])) * 1000
+            elif kind == "on_chain_end" and name == "LangGraph":
+                output = event["data"]["output"]
+    except Exception as e:
+        traceback.print_exc()
+        error = str(e)
+
+    result = {
+        "session_key": turn.session_key,
+        "turn_index": turn.turn_index,
+        "stage": turn.stage,
+        "wall_ms": (time.perf_counter() - turn_started) * 1000,
+        "nodes": {name: {"ms": ms, "llm_ms": llm_ms.get(name, 0.0)} for name, ms in nodes.items()},
+        "input_tokens": sum(served["input_tokens"] for served in tape.served),
+        "output_tokens": sum(served["output_tokens"] for served in tape.served),
+        "prompt_chars": sum(served["prompt_chars"] for served in tape.served),
+        "divergences": [{"kind": "error", "replayed": error}] if error else _divergences(turn, output, calls, tape),
+    }
+    for field in REQUEST_STATE_FIELDS:
+        if output.get(field) is not None:
+            carried[field] = output[field]
+    return result
+
+
+async def replay_session(turns: List[Turn]) -> tuple:
+    carried: Dict[str, Any] = {}
+    results, skipped = [], defaultdict(int)
+    for turn in turns:
+        if turn.group_type == "control":
+            skipped["control"] += 1
+            continue
+        if turn.cancelled:
+            skipped["cancelled"] += 1
+            continue
+        if turn.response is None:
+            skipped["no_response"] += 1
+            continue
+        results.append(await replay_turn(turn, carried))
+    return results, skipped
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+def _summary(values: List[float]) -> dict:
+    return {
+        "count": len(values),
+        "mean": round(statistics.fmean(values), 2) if values else 0.0,
+        "p50": round(_percentile(values, 0.5), 2),
+        "p95": round(_percentile(values, 0.95), 2),
+    }
+
+
+def build_report(results: List[dict], skipped: Dict[str, int], elapsed: float, settings: dict) -> dict:
+    node_ms, node_overhead = defaultdict(list), defaultdict(list)
+    for result in results:
+        for name, timing in result["nodes"].items():
+            node_ms[name].append(timing["ms"])
+            # 节点耗时扣除模型耗时，即 prompt 渲染、解析等 graph 自身开销
+            node_overhead[name].append(max(timing["ms"] - timing["llm_ms"], 0.0))
+    divergences = defaultdict(int)
+    examples = []
+    for result in results:
+        for item in result["divergences"]:
+            divergences[item["kind"]] += 1
+            if len(examples) < 20:
+                examples.append({"session_key": result["session_key"], "turn_index": result["turn_index"], **item})
+    return {
+        "generated_at": datetime.datetime.utcnow().isoformat(),
+        "settings": settings,
+        "turns": len(results),
+        "sessions": len({result["session_key"] for result in results}),
+        "skipped": dict(skipped),
+        "elapsed_seconds": round(elapsed, 3),
+        "turns_per_second": round(len(results) / elapsed, 2) if elapsed else 0.0,
+        "wall_ms": _summary([result["wall_ms"] for result in results]),
+        "nodes": {
+            name: {"latency_ms": _summary(node_ms[name]), "overhead_ms": _summary(node_overhead[name])}
+            for name in sorted(node_ms)
+        },
+        "tokens": {
+            "input": sum(result["input_tokens"] for result in results),
+            "output": sum(result["output_tokens"] for result in results),
+            "prompt_chars": sum(result["prompt_chars"] for result in results),
+        },
+        "divergences": dict(divergences),
+        "divergence_turns": sum(1 for result in results if result["divergences"]),
+        "examples": examples,
+    }
+
+
+def compare(report: dict, baseline: dict, max_regression: float, min_delta_ms: float = 1.0) -> List[str]:
+    """与基线报告比较，返回超过 max_regression（相对增幅）的回退项；耗时差小于 min_delta_ms 的视为噪声"""
+    regressions = []
+
+    def check(label: str, current: float, base: float, floor: float = min_delta_ms):
+        if base > 0 and current - base > floor and (current - base) / base > max_regression:
+            regressions.append(f"{label}: {base:.2f} -> {current:.2f} (+{(current - base) / base:.0%})")
+
+    check("wall_ms.p50", report["wall_ms"]["p50"], baseline["wall_ms"]["p50"])
+    check("wall_ms.p95", report["wall_ms"]["p95"], baseline["wall_ms"]["p95"])
+    for name, current in report["nodes"].items():
+        base = baseline.get("nodes", {}).get(name)
+        if base is None:
+            continue
+        check(f"{name}.overhead_ms.p50", current["overhead_ms"]["p50"], base["overhead_ms"]["p50"])
+        check(f"{name}.latency_ms.p95", current["latency_ms"]["p95"], base["latency_ms"]["p95"])
+    check("tokens.input", report["tokens"]["input"], baseline["tokens"]["input"], floor=0)
+    check("tokens.output", report["tokens"]["output"], baseline["tokens"]["output"], floor=0)
+    if baseline["turns_per_second"] > 0 and report["turns_per_second"] > 0:
+        # 吞吐下降等价于每轮耗时上升
+        check("ms_per_turn", 1000 / report["turns_per_second"], 1000 / baseline["turns_per_second"])
+    return regressions
+
+
+async def run_replay(
+    sessions: Dict[str, List[Turn]],
+    speed: float = 1.0,
+    concurrency: int = 1,
+    ttft_ms: float = DEFAULT_TTFT_MS,
+    chars_per_second: float = DEFAULT_CHARS_PER_SECOND,
+) -> dict:
+    """用 cassette 替换模型，按会话回放（会话内顺序执行，会话之间最多 concurrency 个并发）"""
+    set_llm_override(CassetteLLM(speed=speed, ttft_ms=ttft_ms, chars_per_second=chars_per_second))
+    semaphore = asyncio.Semaphore(concurrency)
+    results: List[dict] = []
+    skipped: Dict[str, int] = defaultdict(int)
+
+    async def run(turns):
+        async with semaphore:
+            session_results, session_skipped = await replay_session(turns)
+        results.extend(session_results)
+        for reason, count in session_skipped.items():
+            skipped[reason] += count
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(run(turns) for turns in sessions.values()))
+    finally:
+        set_llm_override(None)
+    elapsed = time.perf_counter() - started
+    settings = {"speed": speed, "concurrency": concurrency, "ttft_ms": ttft_ms, "chars_per_second": chars_per_second}
+    return build_report(results, skipped, elapsed, settings)
+
+
+def print_report(report: dict) -> None:
+    print(f"Replayed {report['turns']} turns from {report['sessions']} sessions in {report['elapsed_seconds']}s "
+          f"({report['turns_per_second']} turns/s), skipped {report['skipped'] or 0}")
+    wall = report["wall_ms"]
+    print(f"  turn wall ms      p50 {wall['p50']:>9.1f}  p95 {wall['p95']:>9.1f}")
+    print(f"  {'node':<22}{'calls':>6}{'p50 ms':>10}{'p95 ms':>10}{'overhead p50':>14}{'overhead p95':>14}")
+    for name, stats in report["nodes"].items():
+        latency, overhead = stats["latency_ms"], stats["overhead_ms"]
+        print(f"  {name:<22}{latency['count']:>6}{latency['p50']:>10.1f}{latency['p95']:>10.1f}"
+              f"{overhead['p50']:>14.2f}{overhead['p95']:>14.2f}")
+    tokens = report["tokens"]
+    print(f"  tokens in {tokens['input']}  out {tokens['output']}  prompt chars {tokens['prompt_chars']}")
+    print(f"  divergent turns {report['divergence_turns']}: {report['divergences'] or '-'}")
+    for example in report["examples"][:5]:
+        print(f"    {example['session_key']}#{example['turn_index']} {example['kind']}: "
+              f"{str(example.get('logged'))[:60]!r} -> {str(example.get('replayed'))[:60]!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="M-CAST 对话日志离线回放")
+    parser.add_argument("--source", default=None, help="log_export 导出的 JSONL 文件；默认从数据库读取")
+    parser.add_argument("--since", type=datetime.datetime.fromisoformat, default=None)
+    parser.add_argument("--until", type=datetime.datetime.fromisoformat, default=None)
+    parser.add_argument("--group", default=None)
+    parser.add_argument("--student-id", default=None)
+    parser.add_argument("--limit-sessions", type=int, default=None)
+    parser.add_argument("--speed", type=float, default=1.0, help="模型耗时倍率，0 表示不等待")
+    parser.add_argument("--concurrency", type=int, default=1, help="同时回放的会话数")
+    parser.add_argument("--ttft", type=float, default=DEFAULT_TTFT_MS, help="旧日志模拟的首 token 时间（毫秒）")
+    parser.add_argument("--chars-per-second", type=float, default=DEFAULT_CHARS_PER_SECOND)
+    parser.add_argument("--out", default=None, help="把报告写入 JSON 文件，可作为之后的 --baseline")
+    parser.add_argument("--baseline", default=None, help="与之前的报告对比，回退超过阈值时退出码为 1")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    parser.add_argument("--min-delta-ms", type=float, default=1.0, help="小于该值的耗时差不算回退")
+    args = parser.parse_args()
+
+    if args.source:
+        sessions = load_sessions_jsonl(args.source)
+    else:
+        sessions = asyncio.run(load_sessions_db(args.since, args.until, args.group, args.student_id))
+    if args.limit_sessions is not None:
+        sessions = dict(list(sessions.items())[:args.limit_sessions])
+
+    report = asyncio.run(run_replay(sessions, args.speed, args.concurrency, args.ttft, args.chars_per_second))
+    print_report(report)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fd:
+            json.dump(report, fd, ensure_ascii=False, indent=2, default=str)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as fd:
+            baseline = json.load(fd)
+        if baseline.get("settings") != report["settings"]:
+            print(f"WARNING: replay settings differ from baseline ({baseline.get('settings')} vs {report['settings']})")
+        regressions = compare(report, baseline, args.max_regression, args.min_delta_ms)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions over {args.max_regression:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
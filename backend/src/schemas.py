@@ -0,0 +1,186 @@
+from pydantic import BaseModel, ConfigDict
+from typing import List, Optional, Dict
+import datetime
+import uuid
+
+from exec_trace import compact_trace
+
+class TraceEvent(BaseModel):
+    line: int
+    hit: int  # 该行第几次执行
+    vars: Optional[Dict[str, str]] = None  # 本步执行后发生变化的变量（repr，已截断）
+    branch: Optional[bool] = None  # if/while 条件行：条件是否成立
+
+class ExecutionTrace(BaseModel):
+    events: List[TraceEvent] = []
+    steps: int = 0  # 实际执行的总步数
+    dropped: int = 0  # 被采样跳过或被环形缓冲挤掉的步数
+    truncated: bool = False  # 步数超过上限后停止了跟踪
+
+class ChatRequest(BaseModel):
+    user_id: Optional[uuid.UUID] = None
+    student_id: Optional[str] = None  # Added student_id
+    stage: str
+    user_input: str
+    context: Optional[str] = ""
+    current_task: Optional[str] = ""
+    agent_a_sub_stage: Optional[str] = "presentation"
+    agent_a_turn_count: Optional[int] = 0
+    agent_c_sub_stage: Optional[str] = "flowchart"
+    agent_c_poe_state: Optional[str] = "none"
+    agent_c_current_code: Optional[str] = None
+    agent_c_execution_trace: Optional[ExecutionTrace] = None  # 最近一次 /api/execute 返回的轨迹
+    agent_d_reflection_sub_stage: Optional[str] = "recall"
+    agent_e_sub_stage: Optional[str] = "intro"
+    agent_e_quiz_index: Optional[int] = 0
+    group: Optional[str] = "experimental"
+    lesson_id: Optional[str] = None  # token 用量按课统计，未提供时记到 LESSON_ID
+    state_version: Optional[int] = None  # 客户端持有的状态版本，提供时 final 只下发变化字段
+
+class ChatResponse(BaseModel):
+    active_agent_response: str
+    stage: str
+    suggestions: List[str]
+    agent_a_sub_stage: Optional[str] = None
+    agent_a_turn_count: Optional[int] = None
+    agent_a_scenario_text: Optional[str] = None
+    agent_c_sub_stage: Optional[str] = None
+    agent_c_poe_state: Optional[str] = None
+    agent_c_current_code: Optional[str] = None
+    agent_c_flowchart_code: Optional[str] = None
+    agent_d_reflection_sub_stage: Optional[str] = None
+    agent_d_evaluation_scores: Optional[Dict[str, int]] = None
+    agent_b_flowchart_code: Optional[str] = None
+    agent_b_concept_diagram: Optional[str] = None
+    agent_c_code_template: Optional[str] = None
+    agent_e_transfer_tasks: Optional[List[str]] = None
+    agent_e_sub_stage: Optional[str] = None
+    agent_e_quiz_index: Optional[int] = None
+    state_version: Optional[int] = None
+    diff: Optional[bool] = None
+    resync: Optional[bool] = None
+
+class CodeExecutionRequest(BaseModel):
+    code: str
+    inputs: List[str] = []
+    trace: bool = False  # 为 true 时同时记录执行轨迹（POE 观察步骤使用）
+
+class CodeExecutionResponse(BaseModel):
+    output: str
+    error: Optional[str] = None
+    trace: Optional[ExecutionTrace] = None
+
+class SyntaxCheckRequest(BaseModel):
+    code: str
+
+class SyntaxCheckResponse(BaseModel):
+    is_valid: bool
+    errors: List[str] = []
+
+class FlowchartRequest(BaseModel):
+    code: str
+
+class FlowchartResponse(BaseModel):
+    flowchart: Optional[str] = None  # 代码有语法错误时为空
+
+class ChatLogEntry(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    user_id: Optional[uuid.UUID] = None
+    student_id: Optional[str] = None
+    role: Optional[str] = None
+    content: Optional[str] = None
+    group_type: Optional[str] = None
+    created_at: Optional[datetime.datetime] = None
+    meta: Optional[Dict] = None
+
+class ChatLogPage(BaseModel):
+    items: List[ChatLogEntry]
+    next_cursor: Optional[str] = None  # 传给下一次请求的 cursor 参数；为空表示没有更多数据
+
+
+def graph_inputs(request: ChatRequest) -> dict:
+    """把聊天请求转换为 main_graph 的输入"""
+    return {
+        "stage": request.stage,
+        "user_input": request.user_input,
+        "context": request.context,
+        "current_task": request.current_task,
+        "agent_a_sub_stage": request.agent_a_sub_stage,
+        "agent_a_turn_count": request.agent_a_turn_count,
+        "agent_c_sub_stage": request.agent_c_sub_stage,
+        "agent_c_poe_state": request.agent_c_poe_state,
+        "agent_c_current_code": request.agent_c_current_code or "",
+        "agent_c_execution_trace": compact_trace(
+            request.agent_c_execution_trace.model_dump(exclude_none=True) if request.agent_c_execution_trace else None,
+            request.agent_c_current_code,
+        ),
+        "agent_d_reflection_sub_stage": request.agent_d_reflection_sub_stage,
+        "agent_e_sub_stage": request.agent_e_sub_stage,
+        "agent_e_quiz_index": request.agent_e_quiz_index
+    }
+
+
+# 请求中随轮次变化的状态字段，写入学生消息日志的 meta，离线回放时据此还原请求
+REQUEST_STATE_FIELDS = [
+    "current_task",
+    "agent_a_sub_stage",
+    "agent_a_turn_count",
+    "agent_c_sub_stage",
+    "agent_c_poe_state",
+    "agent_c_current_code",
+    "agent_d_reflection_sub_stage",
+    "agent_e_sub_stage",
+    "agent_e_quiz_index",
+]
+
+def request_meta(request: ChatRequest) -> dict:
+    """学生消息日志的 meta：本轮请求的阶段与子阶段字段（context 可由之前的日志还原，只记长度）"""
+    meta = {"stage": request.stage, "context_chars": len(request.context or "")}
+    for field in REQUEST_STATE_FIELDS:
+        meta[field] = getattr(request, field)
+    return meta
+
+def response_meta(output: dict, calls: list) -> dict:
+    """智能体回复日志的 meta：本轮结束后的状态字段与各次 LLM 调用记录"""
+    state = {"stage": output.get("stage")}
+    for field in FINAL_STATE_FIELDS:
+        state[field] = output.get(field)
+    return {"state": state, "llm_calls": calls}
+
+# graph 输出中需要回传给前端的状态字段
+FINAL_STATE_FIELDS = [
+    "agent_a_sub_stage",
+    "agent_a_turn_count",
+    "agent_a_scenario_text",
+    "agent_c_sub_stage",
+    "agent_c_poe_state",
+    "agent_c_current_code",
+    "agent_c_flowchart_code",
+    "agent_d_reflection_sub_stage",
+    "agent_d_evaluation_scores",
+    "agent_b_flowchart_code",
+    "agent_b_concept_diagram",
+    "agent_c_code_template",
+    "agent_e_transfer_tasks",
+    "agent_e_sub_stage",
+    "agent_e_quiz_index",
+]
+
+def final_state(output: dict, request: ChatRequest) -> dict:
+    """从 graph 输出中提取一轮结束后回传给前端的完整状态"""
+    state = {
+        "active_agent_response": output.get("active_agent_response", ""),
+        "stage": output.get("stage", request.stage),
+        "suggestions": output.get("suggestions", []),
+    }
+    for field in FINAL_STATE_FIELDS:
+        state[field] = output.get(field)
+    return state
+
+def session_key(request: ChatRequest) -> Optional[str]:
+    """标识一个学生会话：优先 user_id，其次 student_id"""
+    if request.user_id:
+        return str(request.user_id)
+    return request.student_id or None
@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+# 多 worker 部署时各进程共享的本地状态（SQLite WAL）：计数器、带过期时间的缓存、教师看板的学生状态。
+# 以 WORKERS>1 启动 main.py 时自动开启；单进程时只有执行结果缓存使用它
+SHARED_STATE_ENABLED = os.getenv("SHARED_STATE", "0") != "0"
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH", "/tmp/mcast_shared_state.sqlite3")
+# 每写入这么多条缓存清理一次过期项
+PURGE_EVERY = 500
+
+
+class SharedState:
+    """每个线程一个 SQLite 连接；WAL 模式下读不阻塞写，多个进程可同时读写同一个文件"""
+
+    def __init__(self, path: str = SHARED_STATE_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS counters ("
+                " name TEXT PRIMARY KEY,"
+                " value REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                " namespace TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " value TEXT NOT NULL,"
+                " expires_at REAL NOT NULL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS dashboard_students ("
+                " lesson TEXT NOT NULL,"
+                " student_id TEXT NOT NULL,"
+                " record TEXT NOT NULL,"
+                " seq INTEGER NOT NULL,"
+                " PRIMARY KEY (lesson, student_id))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_dashboard_students_seq ON dashboard_students (seq)")
+            self._local.conn = conn
+        return conn
+
+    # ---- 计数器 ----
+
+    def add_counters(self, deltas: Dict[str, float]) -> None:
+        if not deltas:
+            return
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT INTO counters (name, value) VALUES (?, ?)"
+                " ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                list(deltas.items()),
+            )
+
+    def counters(self) -> Dict[str, float]:
+        return dict(self._connect().execute("SELECT name, value FROM counters"))
+
+    # ---- 缓存 ----
+
+    def cache_get(self, namespace: str, key: str) -> Optional[Any]:
+        row = self._connect().execute(
+            "SELECT value FROM cache WHERE namespace = ? AND key = ? AND expires_at > ?",
+            (namespace, key, time.time()),
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def cache_set(self, namespace: str, key: str, value: Any, ttl: float) -> None:
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                (namespace, key, json.dumps(value, ensure_ascii=False), time.time() + ttl),
+            )
+            self._writes += 1
+            if self._writes % PURGE_EVERY == 0:
+                conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+
+    # ---- 教师看板 ----
+
+    def put_student(self, lesson: str, student_id: str, record: dict) -> None:
+        """写入学生最新状态；seq 在写事务内递增，各 worker 据此增量读取变化"""
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO dashboard_students (lesson, student_id, record, seq)"
+                " VALUES (?, ?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM dashboard_students))",
+                (lesson, student_id, json.dumps(record, ensure_ascii=False)),
+            )
+
+    def get_student(self, lesson: str, student_id: str) -> Optional[dict]:
+        row = self._connect().execute(
+            "SELECT record FROM dashboard_students WHERE lesson = ? AND student_id = ?",
+            (lesson, student_id),
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def students_since(self, lesson: str, seq: int) -> List[Tuple[str, dict, int]]:
+        rows = self._connect().execute(
+            "SELECT student_id, record, seq FROM dashboard_students WHERE lesson = ? AND seq > ? ORDER BY seq",
+            (lesson, seq),
+        )
+        return [(student_id, json.loads(record), row_seq) for student_id, record, row_seq in rows]
+
+
+shared_state = SharedState()
@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import zlib
+import asyncio
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from fastapi.responses import StreamingResponse
+
+try:
+    import brotli
+except ImportError:  # brotli 为可选依赖，未安装时只提供 gzip
+    brotli = None
+
+# token 合帧窗口：缓冲的 token 超过该时长（毫秒）或字节数就合并成一帧发出，0 表示逐 token 发送
+SSE_COALESCE_MS = float(os.getenv("SSE_COALESCE_MS", "40"))
+SSE_COALESCE_BYTES = int(os.getenv("SSE_COALESCE_BYTES", "512"))
+# 客户端 Accept-Encoding 支持时压缩事件流
+SSE_COMPRESSION = os.getenv("SSE_COMPRESSION", "1") != "0"
+SSE_GZIP_LEVEL = int(os.getenv("SSE_GZIP_LEVEL", "6"))
+SSE_BROTLI_QUALITY = int(os.getenv("SSE_BROTLI_QUALITY", "5"))
+
+DONE_FRAME = "data: [DONE]\n\n"
+
+
+def encode_event(event: dict, event_id: Optional[str] = None) -> str:
+    """编码为一帧 SSE；中文直接输出 UTF-8，不转义为 \\uXXXX。带 id 时客户端可凭 Last-Event-ID 续传"""
+    data = f"data: {json.dumps(event, ensure_ascii=False, separators=(',', ':'))}\n\n"
+    return f"id: {event_id}\n{data}" if event_id is not None else data
+
+
+async def coalesce_tokens(
+    events: AsyncIterator[dict],
+    window_ms: float = SSE_COALESCE_MS,
+    max_bytes: int = SSE_COALESCE_BYTES,
+) -> AsyncIterator[dict]:
+    """把短时间内连续到达的 token 事件合并为一个，其他事件原样透传（并先冲刷缓冲）"""
+    if window_ms <= 0:
+        async for event in events:
+            yield event
+        return
+
+    # 由单独的任务读取上游，这样即使上游暂停产出，缓冲也能按时间窗口冲刷
+    queue: asyncio.Queue = asyncio.Queue()
+    finished = object()
+
+    async def pump():
+        try:
+            async for event in events:
+                await queue.put(event)
+        except Exception as e:
+            await queue.put(e)
+        finally:
+            await queue.put(finished)
+
+    pump_task = asyncio.create_task(pump())
+    buffer = []
+    buffered_bytes = 0
+    deadline = None
+    try:
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                item = None
+
+            if isinstance(item, dict) and item.get("type") == "token":
+                buffer.append(item["content"])
+                buffered_bytes += len(item["content"].encode("utf-8"))
+                if deadline is None:
+                    deadline = time.monotonic() + window_ms / 1000
+                if buffered_bytes < max_bytes and time.monotonic() < deadline:
+                    continue
+
+            if buffer:
+                yield {"type": "token", "content": "".join(buffer)}
+                buffer = []
+                buffered_bytes = 0
+                deadline = None
+
+            if item is finished:
+                break
+            if isinstance(item, Exception):
+                raise item
+            if isinstance(item, dict) and item.get("type") != "token":
+                yield item
+    finally:
+        pump_task.cancel()
+
+
+class StreamCompressor:
+    """对事件流做增量压缩，每帧后 flush，保证客户端能立即解压出已发送的事件"""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._brotli = brotli.Compressor(quality=SSE_BROTLI_QUALITY)
+        else:
+            self._zlib = zlib.compressobj(SSE_GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == "br":
+            return self._brotli.process(data) + self._brotli.flush()
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self._brotli.finish()
+        return self._zlib.flush(zlib.Z_FINISH)
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    if not SSE_COMPRESSION or not accept_encoding:
+        return None
+    accepted = {part.split(";")[0].strip().lower() for part in accept_encoding.split(",")}
+    if "br" in accepted and brotli is not None:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+async def _compress_frames(frames: AsyncIterator[str], encoding: Optional[str]) -> AsyncIterator[bytes]:
+    compressor = StreamCompressor(encoding) if encoding else None
+    async for frame in frames:
+        data = frame.encode("utf-8")
+        yield compressor.compress(data) if compressor else data
+    done = DONE_FRAME.encode("utf-8")
+    yield compressor.compress(done) + compressor.finish() if compressor else done
+
+
+async def encode_stream(
+    events: AsyncIterator[dict],
+    encoding: Optional[str] = None,
+    window_ms: Optional[float] = None,
+) -> AsyncIterator[bytes]:
+    """事件流 -> (可选压缩的) SSE 字节流，末尾追加 [DONE]"""
+    window_ms = SSE_COALESCE_MS if window_ms is None else window_ms
+    frames = (encode_event(event) async for event in coalesce_tokens(events, window_ms))
+    async for data in _compress_frames(frames, encoding):
+        yield data
+
+
+async def encode_numbered_stream(entries: AsyncIterator[Tuple[str, dict]], encoding: Optional[str] = None) -> AsyncIterator[bytes]:
+    """(事件 id, 事件) 流 -> SSE 字节流；事件在写入缓冲前已合帧"""
+    frames = (encode_event(event, event_id) async for event_id, event in entries)
+    async for data in _compress_frames(frames, encoding):
+        yield data
+
+
+def sse_response(
+    events: AsyncIterator,
+    accept_encoding: Optional[str] = None,
+    numbered: bool = False,
+    headers: Optional[Dict[str, str]] = None,
+) -> StreamingResponse:
+    """numbered 为 True 时 events 是 (事件 id, 事件) 流"""
+    encoding = negotiate_encoding(accept_encoding)
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no", **(headers or {})}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+        headers["Vary"] = "Accept-Encoding"
+    body = encode_numbered_stream(events, encoding) if numbered else encode_stream(events, encoding)
+    return StreamingResponse(body, media_type="text/event-stream", headers=headers)
@@ -0,0 +1,67 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import metrics
+
+# 每轮结束后只把与上一轮相比变化了的状态字段发给前端，减小 final 事件体积；
+# 设置 STATE_DIFF=0 关闭（多 worker 时基线不在进程间共享，必须关闭）
+STATE_DIFF = os.getenv("STATE_DIFF", "1") != "0"
+STATE_DIFF_MAX_SESSIONS = int(os.getenv("STATE_DIFF_MAX_SESSIONS", "5000"))
+
+# 即使未变化也总是下发的字段
+ALWAYS_SENT_FIELDS = ("active_agent_response", "stage", "suggestions")
+
+
+def _payload_size(payload: dict) -> int:
+    return len(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+
+
+class StateDiffer:
+    """按会话记录上一轮下发的完整状态与版本号，计算增量"""
+
+    def __init__(self, max_sessions: int):
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions: "OrderedDict[str, Tuple[int, Dict]]" = OrderedDict()
+
+    def diff(self, session_key: Optional[str], state: dict, client_version: Optional[int]) -> dict:
+        """返回应下发的状态字段。
+
+        client_version 为客户端持有的状态版本：与服务端记录一致时只下发变化字段，
+        不一致（或服务端已淘汰该会话）时下发完整状态并标记 resync；
+        为 None 表示客户端不支持增量，始终下发完整状态。
+        """
+        if not session_key or not STATE_DIFF:
+            return dict(state)
+
+        with self._lock:
+            version, previous = self._sessions.pop(session_key, (0, None))
+            new_version = version + 1
+            self._sessions[session_key] = (new_version, dict(state))
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+        if client_version is None:
+            payload = dict(state)
+        elif previous is not None and client_version == version:
+            payload = {
+                key: value for key, value in state.items()
+                if key in ALWAYS_SENT_FIELDS or previous.get(key) != value
+            }
+            payload["diff"] = True
+        else:
+            payload = dict(state)
+            payload["resync"] = True
+            metrics.incr("state_diff_resyncs")
+        payload["state_version"] = new_version
+
+        metrics.incr("state_diff_turns")
+        metrics.incr("state_diff_full_bytes", _payload_size(state))
+        metrics.incr("state_diff_sent_bytes", _payload_size(payload))
+        return payload
+
+
+state_differ = StateDiffer(STATE_DIFF_MAX_SESSIONS)
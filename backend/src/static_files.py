@@ -0,0 +1,207 @@
+"""前端静态文件：启动时索引 static/ 目录，按 Accept-Encoding 返回预压缩的 .br/.gz 版本，
+带 ETag 的请求未变化时返回 304；带哈希的 /assets/* 可长期缓存，index.html 常驻内存。
+
+预压缩文件与原文件放在一起（如 assets/index-1a2b3c.js.gz），可在前端构建后生成:
+
+用法（在 backend/src 目录下）:
+    python static_files.py ../static          # 为可压缩的文件生成 .gz（装有 brotli 时同时生成 .br）
+"""
+import os
+import sys
+import gzip
+import argparse
+import mimetypes
+from typing import Dict, Optional
+
+from starlette.responses import FileResponse, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 小于该大小的文件（及其压缩版本）读入内存，其余从磁盘发送
+STATIC_MEMORY_MAX_BYTES = int(os.getenv("STATIC_MEMORY_MAX_BYTES", "65536"))
+# 没有 .gz 文件时，可压缩的文件在第一次被请求时用 gzip 压缩并保存在内存中；设置 STATIC_GZIP=0 关闭
+STATIC_GZIP = os.getenv("STATIC_GZIP", "1") != "0"
+# 小于该大小的文件不值得压缩
+STATIC_COMPRESS_MIN_BYTES = 1024
+
+# 文件名带内容哈希（Vite 的构建产物），内容变化时文件名也会变化
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+# 其余文件每次使用前向服务端确认（未变化时只返回 304）
+REVALIDATE_CACHE = "no-cache"
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml", "application/xml")
+# 优先级从高到低
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def _compressible(media_type: str) -> bool:
+    return media_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def accepted_encodings(header: Optional[str]) -> set:
+    """Accept-Encoding 中可接受的编码（忽略 q=0 的项）"""
+    accepted = set()
+    for item in (header or "").split(","):
+        name, *params = [part.strip() for part in item.split(";")]
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name and q > 0:
+            accepted.add(name.lower())
+    return accepted
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """If-None-Match 是否包含该 ETag（弱比较）"""
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+
+class Variant:
+    """一个文件的某种编码版本；body 为 None 时从 path 发送"""
+
+    __slots__ = ("path", "stat", "body", "etag")
+
+    def __init__(self, path: Optional[str], stat: Optional[os.stat_result], body: Optional[bytes], etag: str):
+        self.path = path
+        self.stat = stat
+        self.body = body
+        self.etag = etag
+
+
+class StaticFile:
+    def __init__(self, path: str, stat: os.stat_result, immutable: bool):
+        self.path = path
+        self.media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if self.media_type.startswith("text/") or self.media_type == "application/javascript":
+            self.media_type += "; charset=utf-8"
+        self.cache_control = IMMUTABLE_CACHE if immutable else REVALIDATE_CACHE
+        base_etag = f"{stat.st_size:x}-{stat.st_mtime_ns:x}"
+        self.variants: Dict[str, Variant] = {"identity": self._variant(path, stat, f'"{base_etag}"')}
+        for encoding, suffix in ENCODINGS:
+            if os.path.isfile(path + suffix):
+                self.variants[encoding] = self._variant(path + suffix, os.stat(path + suffix), f'"{base_etag}-{encoding}"')
+        self.lazy_gzip = (
+            STATIC_GZIP and "gzip" not in self.variants
+            and _compressible(self.media_type) and stat.st_size >= STATIC_COMPRESS_MIN_BYTES
+        )
+        self.vary = len(self.variants) > 1 or self.lazy_gzip
+
+    @staticmethod
+    def _variant(path: str, stat: os.stat_result, etag: str) -> Variant:
+        if stat.st_size <= STATIC_MEMORY_MAX_BYTES:
+            with open(path, "rb") as fd:
+                return Variant(None, None, fd.read(), etag)
+        return Variant(path, stat, None, etag)
+
+    def _gzip(self) -> Variant:
+        identity = self.variants["identity"]
+        if identity.body is not None:
+            raw = identity.body
+        else:
+            with open(identity.path, "rb") as fd:
+                raw = fd.read()
+        variant = Variant(None, None, gzip.compress(raw, compresslevel=6, mtime=0), identity.etag[:-1] + '-gzip"')
+        self.variants["gzip"] = variant
+        self.lazy_gzip = False
+        return variant
+
+    def select(self, accept_encoding: Optional[str]) -> tuple:
+        """(编码, 版本)；编码为 identity 时不加 Content-Encoding"""
+        if len(self.variants) > 1 or self.lazy_gzip:
+            accepted = accepted_encodings(accept_encoding)
+            for encoding, _ in ENCODINGS:
+                if encoding in accepted and encoding in self.variants:
+                    return encoding, self.variants[encoding]
+            if self.lazy_gzip and "gzip" in accepted:
+                return "gzip", self._gzip()
+        return "identity", self.variants["identity"]
+
+
+class StaticSite:
+    """static/ 目录的索引；请求路径直接查表，不再访问文件系统"""
+
+    def __init__(self, root: str):
+        self.root = root
+        self.files: Dict[str, StaticFile] = {}
+        for directory, _, names in os.walk(root):
+            for name in names:
+                path = os.path.join(directory, name)
+                if name.endswith((".br", ".gz")) and os.path.isfile(path[:-3]):
+                    continue
+                relative = os.path.relpath(path, root).replace(os.sep, "/")
+                self.files[relative] = StaticFile(path, os.stat(path), immutable=relative.startswith("assets/"))
+        self.index = self.files.get("index.html")
+
+    def lookup(self, path: str) -> Optional[StaticFile]:
+        """不存在的路径交给前端路由（返回 index.html），/assets/ 下缺失的文件返回 None"""
+        path = path.lstrip("/")
+        found = self.files.get(path or "index.html")
+        if found is not None or path.startswith("assets/"):
+            return found
+        return self.index
+
+    def respond(self, path: str, headers) -> Response:
+        static_file = self.lookup(path)
+        if static_file is None:
+            return Response(status_code=404)
+        encoding, variant = static_file.select(headers.get("accept-encoding"))
+        response_headers = {"ETag": variant.etag, "Cache-Control": static_file.cache_control}
+        if static_file.vary:
+            response_headers["Vary"] = "Accept-Encoding"
+        if etag_matches(headers.get("if-none-match"), variant.etag):
+            return Response(status_code=304, headers=response_headers)
+        if encoding != "identity":
+            response_headers["Content-Encoding"] = encoding
+        if variant.body is not None:
+            return Response(variant.body, media_type=static_file.media_type, headers=response_headers)
+        return FileResponse(variant.path, stat_result=variant.stat, media_type=static_file.media_type, headers=response_headers)
+
+
+def precompress(root: str) -> None:
+    """为 root 下可压缩的文件生成 .gz（以及 .br）"""
+    written = 0
+    for directory, _, names in os.walk(root):
+        for name in names:
+            if name.endswith((".br", ".gz")):
+                continue
+            path = os.path.join(directory, name)
+            media_type = mimetypes.guess_type(path)[0] or ""
+            if not _compressible(media_type) or os.path.getsize(path) < STATIC_COMPRESS_MIN_BYTES:
+                continue
+            with open(path, "rb") as fd:
+                raw = fd.read()
+            outputs = [(".gz", gzip.compress(raw, compresslevel=9, mtime=0))]
+            if brotli is not None:
+                outputs.append((".br", brotli.compress(raw, quality=11)))
+            for suffix, data in outputs:
+                # 压缩后没有变小的不保存
+                if len(data) < len(raw):
+                    with open(path + suffix, "wb") as fd:
+                        fd.write(data)
+                    written += 1
+    print(f"Wrote {written} precompressed files under {root}" + ("" if brotli else " (brotli not installed, .gz only)"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="为前端构建产物生成预压缩文件")
+    parser.add_argument("root", help="static 目录")
+    args = parser.parse_args()
+    if not os.path.isdir(args.root):
+        print(f"Not a directory: {args.root}")
+        sys.exit(1)
+    precompress(args.root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import os
+import uuid
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import metrics
+from turns import Turn
+
+# 每轮事件流保留在服务端的帧数（合帧之后），断线重连时从中续传
+SSE_RESUME_BUFFER_EVENTS = int(os.getenv("SSE_RESUME_BUFFER_EVENTS", "512"))
+# 本轮结束后缓冲保留的时长（秒），超时后重连只能重新发起一轮
+SSE_RESUME_TTL_SECONDS = float(os.getenv("SSE_RESUME_TTL_SECONDS", "300"))
+# 所有连接都断开后等待重连的时长（秒），超时仍未重连才取消生成
+SSE_RESUME_GRACE_SECONDS = float(os.getenv("SSE_RESUME_GRACE_SECONDS", "20"))
+SSE_RESUME_MAX_STREAMS = int(os.getenv("SSE_RESUME_MAX_STREAMS", "2000"))
+
+
+# 重连位置早于缓冲起点、缺失的 token 已被挤出时发送：客户端保留已显示的部分，之后不再收到 token，
+# 以 final 中的完整回复为准
+RESYNC_EVENT = {"type": "resync"}
+
+
+class StreamBuffer:
+    """一轮对话的事件缓冲：事件按序编号（SSE id 为 "<stream_id>:<seq>"），连接断开不影响生成。
+
+    只保留最近 SSE_RESUME_BUFFER_EVENTS 帧，内存占用有上限；重连位置早于缓冲起点时先发送
+    resync 事件，再只发送 token 以外的事件。owner 为缓冲的归属，只有同一归属的请求可以续传。
+    """
+
+    def __init__(self, turn: Turn, owner: str, max_events: int = SSE_RESUME_BUFFER_EVENTS):
+        self.stream_id = uuid.uuid4().hex
+        self.turn = turn
+        self.owner = owner
+        self.seq = 0
+        self.events: deque = deque(maxlen=max_events)
+        # 是否有 token 被挤出了缓冲（此后无法再拼出完整的 token 文本）
+        self.truncated = False
+        # token 以外的事件（final / error）全部保留，数量很少
+        self._others: List[dict] = []
+        self.finished_at: Optional[float] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        self._grace: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.finished_at is not None
+
+    def append(self, event: dict) -> None:
+        self.seq += 1
+        if event.get("type") != "token":
+            self._others.append(event)
+        if len(self.events) == self.events.maxlen and self.events[0][1].get("type") == "token":
+            self.truncated = True
+        self.events.append((self.seq, event))
+        self._notify()
+
+    def condensed(self) -> List[dict]:
+        """整轮内容压缩为一个 token 事件加上 final 等事件，用于缓冲过期后重放；
+        token 已被挤出缓冲时以 resync 代替"""
+        if self.truncated:
+            return [RESYNC_EVENT, *self._others]
+        text = "".join(event["content"] for _, event in self.events if event.get("type") == "token")
+        return [{"type": "token", "content": text}, *self._others]
+
+    def finish(self) -> None:
+        self.finished_at = time.monotonic()
+        self._cancel_grace()
+        self._notify()
+
+    def _notify(self) -> None:
+        wakeup, self._wakeup = self._wakeup, asyncio.Event()
+        wakeup.set()
+
+    def read(self, after: int) -> List[Tuple[int, dict]]:
+        """seq 大于 after 的事件；after 早于缓冲起点时以 resync 事件开头"""
+        first = self.events[0][0] if self.events else self.seq + 1
+        entries = []
+        if after < first - 1:
+            metrics.incr("sse_resume_resyncs")
+            entries.append((first - 1, RESYNC_EVENT))
+        entries.extend(entry for entry in self.events if entry[0] > after)
+        return entries
+
+    def attach(self) -> None:
+        self.subscribers += 1
+        self._cancel_grace()
+
+    def detach(self) -> None:
+        self.subscribers -= 1
+        if self.subscribers == 0 and not self.finished:
+            self._grace = asyncio.get_running_loop().call_later(SSE_RESUME_GRACE_SECONDS, self._expire)
+
+    def _cancel_grace(self) -> None:
+        if self._grace is not None:
+            self._grace.cancel()
+            self._grace = None
+
+    def _expire(self) -> None:
+        self._grace = None
+        if self.subscribers == 0 and not self.finished:
+            self.turn.cancel("disconnected")
+
+    async def subscribe(self, after: int = 0, is_disconnected=None, interval: float = 0.5) -> AsyncIterator[Tuple[str, dict]]:
+        """从 after 之后开始输出 (事件 id, 事件)，直到本轮结束；客户端断开时只解除订阅，生成继续"""
+        self.attach()
+        resynced = False
+        try:
+            while True:
+                wakeup = self._wakeup
+                for seq, event in self.read(after):
+                    after = seq
+                    if event is RESYNC_EVENT:
+                        resynced = True
+                    elif resynced and event.get("type") == "token":
+                        continue
+                    yield f"{self.stream_id}:{seq}", event
+                if self.finished:
+                    return
+                try:
+                    await asyncio.wait_for(wakeup.wait(), interval)
+                except asyncio.TimeoutError:
+                    pass
+                # SSE 在没有数据可写时无法感知断开，定期检查
+                if is_disconnected is not None and await is_disconnected():
+                    return
+        finally:
+            self.detach()
+
+
+_streams: "OrderedDict[str, StreamBuffer]" = OrderedDict()
+_background_tasks = set()
+
+
+def _sweep() -> None:
+    """移除结束已超过 TTL 的缓冲；总数超限时先移除最早结束的"""
+    now = time.monotonic()
+    for stream_id, buffer in list(_streams.items()):
+        if buffer.finished and now - buffer.finished_at > SSE_RESUME_TTL_SECONDS:
+            del _streams[stream_id]
+    for stream_id, buffer in list(_streams.items()):
+        if len(_streams) <= SSE_RESUME_MAX_STREAMS:
+            break
+        if buffer.finished:
+            del _streams[stream_id]
+
+
+def open_stream(turn: Turn, events: AsyncIterator[dict], owner: str) -> StreamBuffer:
+    """在后台任务中把本轮事件写入新的缓冲，返回该缓冲"""
+    _sweep()
+    buffer = StreamBuffer(turn, owner)
+    _streams[buffer.stream_id] = buffer
+
+    async def publish():
+        try:
+            async for event in events:
+                buffer.append(event)
+        except Exception as e:
+            buffer.append({"type": "error", "content": str(e)})
+        finally:
+            buffer.finish()
+
+    buffer.task = asyncio.create_task(publish())
+    _background_tasks.add(buffer.task)
+    buffer.task.add_done_callback(_background_tasks.discard)
+    return buffer
+
+
+def parse_last_event_id(value: Optional[str]) -> Optional[Tuple[str, int]]:
+    """Last-Event-ID 形如 "<stream_id>:<seq>"；只有 stream_id 时从头续传"""
+    if not value:
+        return None
+    stream_id, _, seq = value.strip().partition(":")
+    try:
+        return stream_id, int(seq or 0)
+    except ValueError:
+        return None
+
+
+def find_stream(stream_id: str, owner: str) -> Optional[StreamBuffer]:
+    """按 id 查找仍在保留期内的缓冲；必须属于同一归属（学生会话、Idempotency-Key 或客户端地址）"""
+    _sweep()
+    buffer = _streams.get(stream_id)
+    if buffer is None or buffer.owner != owner:
+        return None
+    return buffer
@@ -0,0 +1,387 @@
+import os
+import time
+import asyncio
+import threading
+import contextvars
+from typing import Dict, List, Optional, Tuple
+
+import metrics
+
+# 每个学生在一节课内的 token 预算（输入 + 输出），0 表示不限制。
+# 超出软预算后改用便宜的模型 / 更短的 max_tokens，超出硬预算后进一步收紧
+TOKEN_BUDGET_SOFT = int(os.getenv("TOKEN_BUDGET_SOFT", "0"))
+TOKEN_BUDGET_HARD = int(os.getenv("TOKEN_BUDGET_HARD", "0"))
+# 同一分组（班级）在一节课内的总预算，0 表示不限制
+TOKEN_BUDGET_CLASS_SOFT = int(os.getenv("TOKEN_BUDGET_CLASS_SOFT", "0"))
+TOKEN_BUDGET_CLASS_HARD = int(os.getenv("TOKEN_BUDGET_CLASS_HARD", "0"))
+# 超出预算后使用的模型（为空则不换模型）与 max_tokens 上限
+TOKEN_BUDGET_SOFT_MODEL = os.getenv("TOKEN_BUDGET_SOFT_MODEL", "")
+TOKEN_BUDGET_SOFT_MAX_TOKENS = int(os.getenv("TOKEN_BUDGET_SOFT_MAX_TOKENS", "1500"))
+TOKEN_BUDGET_HARD_MODEL = os.getenv("TOKEN_BUDGET_HARD_MODEL", "") or TOKEN_BUDGET_SOFT_MODEL
+TOKEN_BUDGET_HARD_MAX_TOKENS = int(os.getenv("TOKEN_BUDGET_HARD_MAX_TOKENS", "600"))
+# 任一预算不为 0 时才从数据库加载历史用量并限制调用；全为 0 时只记账
+BUDGETS_ENABLED = any((TOKEN_BUDGET_SOFT, TOKEN_BUDGET_HARD, TOKEN_BUDGET_CLASS_SOFT, TOKEN_BUDGET_CLASS_HARD))
+# 加载历史用量失败（如数据库不可用）后，至少间隔多久再试（秒）
+TOKEN_LEDGER_RETRY_SECONDS = float(os.getenv("TOKEN_LEDGER_RETRY_SECONDS", "60"))
+# 内存中的增量至少间隔多久写一次数据库（秒）
+TOKEN_LEDGER_FLUSH_SECONDS = float(os.getenv("TOKEN_LEDGER_FLUSH_SECONDS", "10"))
+# 请求没有带 lesson_id 时记到哪节课
+DEFAULT_LESSON = os.getenv("LESSON_ID", "default")
+
+# (student_id, group_type, lesson)
+Key = Tuple[Optional[str], Optional[str], str]
+
+
+class Usage:
+    """一组调用累计的 token 数"""
+
+    __slots__ = ("prompt_tokens", "cached_tokens", "completion_tokens", "calls")
+
+    def __init__(self, prompt_tokens: int = 0, cached_tokens: int = 0, completion_tokens: int = 0, calls: int = 0):
+        self.prompt_tokens = prompt_tokens
+        self.cached_tokens = cached_tokens
+        self.completion_tokens = completion_tokens
+        self.calls = calls
+
+    @property
+    def total(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(self, other: "Usage") -> None:
+        self.prompt_tokens += other.prompt_tokens
+        self.cached_tokens += other.cached_tokens
+        self.completion_tokens += other.completion_tokens
+        self.calls += other.calls
+
+    def as_dict(self) -> dict:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total,
+            "calls": self.calls,
+        }
+
+    @classmethod
+    def from_metadata(cls, usage: dict) -> "Usage":
+        """LangChain 的 usage_metadata -> Usage"""
+        details = usage.get("input_token_details") or {}
+        return cls(
+            usage.get("input_tokens") or 0,
+            details.get("cache_read") or 0,
+            usage.get("output_tokens") or 0,
+            1,
+        )
+
+
+class Limits:
+    """超出预算时对本次调用的限制"""
+
+    def __init__(self, tier: str, model: Optional[str], max_tokens: int):
+        self.tier = tier
+        self.model = model
+        self.max_tokens = max_tokens
+
+
+def _tier(used: int, soft: int, hard: int) -> Optional[str]:
+    if hard and used >= hard:
+        return "hard"
+    if soft and used >= soft:
+        return "soft"
+    return None
+
+
+class TokenLedger:
+    """按学生 / 分组 / 课累计 token 用量并判断预算。
+
+    总量 = 数据库中汇总的用量 + 本进程尚未写入的增量；首次遇到该学生（分组）时在后台加载，
+    加载完成前只按本进程内的用量判断。
+    多个 worker 之间通过数据库同步：每个刷新周期写入本进程的增量后，重新汇总已加载的学生 / 分组，
+    其他 worker 的用量由此计入，预算判断大约滞后一到两个刷新周期（各 worker 轮次结束时才刷新）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._students: Dict[Key, Usage] = {}
+        self._classes: Dict[Tuple[Optional[str], str], Usage] = {}
+        # 尚未写入数据库的增量
+        self._pending: Dict[Key, Usage] = {}
+        self._loaded = set()
+        self._loading = set()
+        self._load_tasks = set()
+        self._load_failed_at: Optional[float] = None
+        self._last_flush = time.monotonic()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def record(self, key: Key, usage: Usage) -> None:
+        with self._lock:
+            for table, table_key in (
+                (self._students, key),
+                (self._classes, key[1:]),
+                (self._pending, key),
+            ):
+                table.setdefault(table_key, Usage()).add(usage)
+
+    def usage(self, key: Key) -> Usage:
+        with self._lock:
+            return self._students.get(key) or Usage()
+
+    def tier(self, key: Key) -> Optional[str]:
+        """学生或其分组超出的预算级别：hard / soft / None"""
+        with self._lock:
+            student = self._students.get(key)
+            group = self._classes.get(key[1:])
+        tiers = [
+            _tier(group.total if group else 0, TOKEN_BUDGET_CLASS_SOFT, TOKEN_BUDGET_CLASS_HARD),
+            # 匿名学生共用一条记录，不按学生限制
+            _tier(student.total if student else 0, TOKEN_BUDGET_SOFT, TOKEN_BUDGET_HARD) if key[0] else None,
+        ]
+        if "hard" in tiers:
+            return "hard"
+        if "soft" in tiers:
+            return "soft"
+        return None
+
+    def limits(self, key: Key) -> Optional[Limits]:
+        tier = self.tier(key)
+        if tier == "hard":
+            return Limits(tier, TOKEN_BUDGET_HARD_MODEL or None, TOKEN_BUDGET_HARD_MAX_TOKENS)
+        if tier == "soft":
+            return Limits(tier, TOKEN_BUDGET_SOFT_MODEL or None, TOKEN_BUDGET_SOFT_MAX_TOKENS)
+        return None
+
+    def load_in_background(self, key: Key) -> None:
+        """第一次遇到某个学生 / 分组时，在后台从数据库汇总其历史用量，不阻塞本轮对话；
+        加载失败后 TOKEN_LEDGER_RETRY_SECONDS 内不再尝试"""
+        wanted = [k for k in (key, key[1:]) if k not in self._loaded and k not in self._loading]
+        if not wanted:
+            return
+        if self._load_failed_at is not None and time.monotonic() - self._load_failed_at < TOKEN_LEDGER_RETRY_SECONDS:
+            return
+        self._loading.update(wanted)
+        task = asyncio.create_task(self.load(wanted))
+        self._load_tasks.add(task)
+        task.add_done_callback(self._load_tasks.discard)
+
+    async def load(self, wanted: List) -> None:
+        """从数据库汇总这些学生 / 分组的历史用量"""
+        try:
+            from sqlalchemy import select, func
+            import database
+            await database.ensure_db()
+            table = database.TokenUsage
+            sums = [
+                func.coalesce(func.sum(column), 0)
+                for column in (table.prompt_tokens, table.cached_tokens, table.completion_tokens, table.calls)
+            ]
+            loaded = {}
+            async with database.AsyncSessionLocal() as session:
+                for k in wanted:
+                    query = select(*sums).where(table.lesson == k[-1], table.group_type == k[-2])
+                    if len(k) == 3:
+                        query = query.where(table.student_id == k[0])
+                    row = (await session.execute(query)).one()
+                    loaded[k] = Usage(*(int(value) for value in row))
+        except Exception as e:
+            print(f"WARNING: Token ledger load failed, retrying in {TOKEN_LEDGER_RETRY_SECONDS:.0f}s: {e}")
+            self._load_failed_at = time.monotonic()
+            return
+        finally:
+            self._loading.difference_update(wanted)
+        self._load_failed_at = None
+        self._apply(loaded)
+
+    def _apply(self, loaded: Dict) -> None:
+        with self._lock:
+            for k, usage in loaded.items():
+                # 已写入数据库的部分以数据库为准，再加上尚未写入的增量
+                if len(k) == 3:
+                    pending = [self._pending.get(k)]
+                    target = self._students
+                else:
+                    pending = [u for pk, u in self._pending.items() if pk[1:] == k]
+                    target = self._classes
+                for u in pending:
+                    if u is not None:
+                        usage.add(u)
+                target[k] = usage
+                self._loaded.add(k)
+
+    def _take_pending(self) -> Dict[Key, Usage]:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        return pending
+
+    def _restore_pending(self, pending: Dict[Key, Usage]) -> None:
+        with self._lock:
+            for key, usage in pending.items():
+                self._pending.setdefault(key, Usage()).add(usage)
+
+    async def flush(self) -> int:
+        """把增量写入数据库，返回写入的行数；失败时增量保留到下次"""
+        pending = self._take_pending()
+        if not pending:
+            return 0
+        try:
+            import database
+            await database.ensure_db()
+            async with database.AsyncSessionLocal() as session:
+                session.add_all([
+                    database.TokenUsage(
+                        student_id=key[0],
+                        group_type=key[1],
+                        lesson=key[2],
+                        prompt_tokens=usage.prompt_tokens,
+                        cached_tokens=usage.cached_tokens,
+                        completion_tokens=usage.completion_tokens,
+                        calls=usage.calls,
+                    )
+                    for key, usage in pending.items()
+                ])
+                await session.commit()
+        except Exception as e:
+            print(f"WARNING: Token ledger flush failed: {e}")
+            self._restore_pending(pending)
+            return 0
+        metrics.incr("token_ledger_flushes")
+        return len(pending)
+
+    async def refresh(self) -> None:
+        """重新汇总已加载的学生 / 分组的用量（一次查询），计入其他 worker 写入的部分"""
+        with self._lock:
+            keys = list(self._loaded)
+        if not keys:
+            return
+        try:
+            from sqlalchemy import select, func
+            import database
+            table = database.TokenUsage
+            query = select(
+                table.student_id,
+                table.group_type,
+                table.lesson,
+                *(func.sum(column) for column in (table.prompt_tokens, table.cached_tokens, table.completion_tokens, table.calls)),
+            ).where(table.lesson.in_({k[-1] for k in keys})).group_by(table.student_id, table.group_type, table.lesson)
+            async with database.AsyncSessionLocal() as session:
+                rows = (await session.execute(query)).all()
+        except Exception as e:
+            print(f"WARNING: Token ledger refresh failed: {e}")
+            return
+        totals = {}
+        for student_id, group_type, lesson, *values in rows:
+            usage = Usage(*(int(value or 0) for value in values))
+            totals.setdefault((student_id, group_type, lesson), Usage()).add(usage)
+            totals.setdefault((group_type, lesson), Usage()).add(usage)
+        self._apply({k: totals.get(k) or Usage() for k in keys})
+        metrics.incr("token_ledger_refreshes")
+
+    async def sync(self) -> None:
+        """写入本进程的增量，开启预算时再读回所有 worker 的合计"""
+        await self.flush()
+        if BUDGETS_ENABLED:
+            await self.refresh()
+
+    def maybe_flush(self) -> None:
+        """距上次同步超过 TOKEN_LEDGER_FLUSH_SECONDS 时，在后台与数据库同步；
+        开启预算时即使本进程没有增量也要读回其他 worker 的用量"""
+        if self._flush_task is not None and not self._flush_task.done():
+            return
+        if not self._pending and not (BUDGETS_ENABLED and self._loaded):
+            return
+        if time.monotonic() - self._last_flush < TOKEN_LEDGER_FLUSH_SECONDS:
+            return
+        self._last_flush = time.monotonic()
+        self._flush_task = asyncio.create_task(self.sync())
+
+
+ledger = TokenLedger()
+
+# 当前轮次所属的 (学生, 分组, 课)；未绑定时（课前预热、离线回放）不记账也不限制
+_owner: contextvars.ContextVar[Optional[Key]] = contextvars.ContextVar("token_owner", default=None)
+
+
+def make_key(student_id: Optional[str], group: Optional[str], lesson: Optional[str] = None) -> Key:
+    return student_id, group, lesson or DEFAULT_LESSON
+
+
+def bind_owner(student_id: Optional[str], group: Optional[str], lesson: Optional[str] = None) -> Key:
+    """把本轮的学生绑定到当前上下文，之后启动的 graph 节点都会继承它（在事件循环中调用）"""
+    key = make_key(student_id, group, lesson)
+    if BUDGETS_ENABLED:
+        ledger.load_in_background(key)
+    _owner.set(key)
+    return key
+
+
+def record(usage: dict) -> None:
+    """记录一次上游调用的 usage_metadata"""
+    key = _owner.get()
+    if key is not None:
+        ledger.record(key, Usage.from_metadata(usage))
+
+
+def current_limits() -> Optional[Limits]:
+    """当前学生超出预算时对模型与 max_tokens 的限制"""
+    key = _owner.get()
+    if key is None or not BUDGETS_ENABLED:
+        return None
+    limits = ledger.limits(key)
+    if limits is not None:
+        metrics.incr(f"token_budget_{limits.tier}_calls")
+    return limits
+
+
+def budgets() -> dict:
+    return {
+        "student_soft": TOKEN_BUDGET_SOFT,
+        "student_hard": TOKEN_BUDGET_HARD,
+        "class_soft": TOKEN_BUDGET_CLASS_SOFT,
+        "class_hard": TOKEN_BUDGET_CLASS_HARD,
+    }
+
+
+REPORT_DIMENSIONS = {
+    "student": ("lesson", "group_type", "student_id"),
+    "group": ("lesson", "group_type"),
+    "lesson": ("lesson",),
+}
+
+
+async def report(by: str = "student", lesson: Optional[str] = None, group: Optional[str] = None, student_id: Optional[str] = None) -> List[dict]:
+    """按学生 / 分组 / 课汇总数据库中的用量（先写入内存中的增量）"""
+    from sqlalchemy import select, func
+    import database
+
+    await ledger.flush()
+    table = database.TokenUsage
+    dimensions = [getattr(table, name) for name in REPORT_DIMENSIONS[by]]
+    query = select(
+        *dimensions,
+        func.sum(table.prompt_tokens),
+        func.sum(table.cached_tokens),
+        func.sum(table.completion_tokens),
+        func.sum(table.calls),
+        func.max(table.created_at),
+    ).group_by(*dimensions).order_by(*dimensions)
+    if lesson is not None:
+        query = query.where(table.lesson == lesson)
+    if group is not None:
+        query = query.where(table.group_type == group)
+    if student_id is not None:
+        query = query.where(table.student_id == student_id)
+
+    rows = []
+    async with database.AsyncSessionLocal() as session:
+        for row in (await session.execute(query)).all():
+            names = REPORT_DIMENSIONS[by]
+            values = row[len(names):]
+            entry = dict(zip(names, row[:len(names)]))
+            entry.update(Usage(*(int(value or 0) for value in values[:4])).as_dict())
+            entry["last_used_at"] = values[4]
+            if by == "student":
+                entry["budget"] = _tier(entry["total_tokens"], TOKEN_BUDGET_SOFT, TOKEN_BUDGET_HARD) if entry["student_id"] else None
+            elif by == "group":
+                entry["budget"] = _tier(entry["total_tokens"], TOKEN_BUDGET_CLASS_SOFT, TOKEN_BUDGET_CLASS_HARD)
+            rows.append(entry)
+    return rows
@@ -0,0 +1,57 @@
+import asyncio
+import threading
+from typing import Dict, Optional
+
+import metrics
+
+
+class Turn:
+    """一轮正在进行的对话；取消时既通知线程池中的节点，也取消驱动 graph 的任务"""
+
+    def __init__(self, session_key: Optional[str]):
+        self.session_key = session_key
+        self.cancel_event = threading.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.cancel_reason: Optional[str] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def cancel(self, reason: str) -> None:
+        if self.cancelled:
+            return
+        self.cancel_reason = reason
+        self.cancel_event.set()
+        metrics.incr(f"turns_cancelled_{reason}")
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+
+# 每个学生会话同一时间只保留一轮生成
+_active_turns: Dict[str, Turn] = {}
+
+
+def start_turn(session_key: Optional[str]) -> Turn:
+    """登记新的一轮；同一会话仍在生成的上一轮会被取消（学生发了新消息）"""
+    turn = Turn(session_key)
+    if session_key:
+        previous = _active_turns.get(session_key)
+        if previous is not None:
+            previous.cancel("superseded")
+        _active_turns[session_key] = turn
+    return turn
+
+
+def end_turn(turn: Turn) -> None:
+    if turn.session_key and _active_turns.get(turn.session_key) is turn:
+        del _active_turns[turn.session_key]
+
+
+async def watch_disconnect(turn: Turn, is_disconnected, interval: float = 0.5) -> None:
+    """轮询客户端是否已断开（SSE 在没有数据可写时无法感知断开），断开则取消本轮"""
+    while not turn.cancelled:
+        if await is_disconnected():
+            turn.cancel("disconnected")
+            return
+        await asyncio.sleep(interval)
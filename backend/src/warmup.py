@@ -0,0 +1,116 @@
+"""课前预热：在上课前为每个智能体的开场 prompt 生成并缓存若干条回复变体。
+
+用法（在 backend/src 目录下）:
+    python warmup.py --variants 3
+    python warmup.py --variants 3 --reset    # 清空已有缓存后重新生成
+"""
+import os
+import sys
+import glob
+import json
+import time
+import asyncio
+import argparse
+import traceback
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import text
+
+from schemas import ChatRequest, graph_inputs
+from graphs.graph import main_graph
+from graphs.node import CONFIG_BASE_DIR, load_cfg, get_template, _get_llm
+from graphs.llm_stream import warmup_session
+from graphs.response_cache import response_cache
+
+WARMUP_PLAN = "config/warmup_plan.json"
+
+
+def _warm_registry() -> list:
+    """预加载所有智能体配置与模板，并初始化对应的 LLM 客户端"""
+    loaded = []
+    for cfg_file in sorted(glob.glob(os.path.join(CONFIG_BASE_DIR, "config", "agent_*_cfg.json"))):
+        llm_cfg = os.path.relpath(cfg_file, CONFIG_BASE_DIR)
+        cfg = load_cfg(llm_cfg)
+        get_template(llm_cfg, "up")
+        _get_llm(cfg.get("config", {}))
+        loaded.append(llm_cfg)
+    return loaded
+
+
+async def _warm_db() -> bool:
+    from database import engine
+    try:
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+        return True
+    except Exception as e:
+        print(f"WARNING: Warm-up database ping failed: {e}")
+        return False
+
+
+def _plan_requests(plan: dict):
+    for opening in plan.get("openings", []):
+        for context_name, context in plan.get("contexts", {"empty": ""}).items():
+            fields = {"current_task": plan.get("current_task", ""), **opening, "context": context}
+            yield context_name, ChatRequest(**fields)
+
+
+async def run_warmup(variants: int = 3, plan_path: str = WARMUP_PLAN, reset: bool = False) -> dict:
+    """按预热计划跑一遍 graph，把每个开场 prompt 补齐到 variants 条缓存回复，返回覆盖报告"""
+    started = time.time()
+    if reset:
+        response_cache.clear()
+
+    with open(os.path.join(CONFIG_BASE_DIR, plan_path), "r", encoding="utf-8") as fd:
+        plan = json.load(fd)
+
+    report = {
+        "variants": variants,
+        "configs": _warm_registry(),
+        "database": await _warm_db(),
+        "paths": [],
+    }
+
+    for context_name, request in _plan_requests(plan):
+        path = {
+            "stage": request.stage,
+            "user_input": request.user_input,
+            "context": context_name,
+        }
+        with warmup_session(variants) as run:
+            try:
+                result = await main_graph.ainvoke(graph_inputs(request))
+                path["next_stage"] = result.get("stage")
+                path["covered"] = bool(run.covered)
+            except Exception as e:
+                traceback.print_exc()
+                path["covered"] = False
+                path["error"] = str(e)
+        path["prompts"] = run.covered
+        report["paths"].append(path)
+
+    report["covered_paths"] = sum(1 for p in report["paths"] if p["covered"])
+    report["total_paths"] = len(report["paths"])
+    report["llm_calls"] = sum(c["generated_variants"] for p in report["paths"] for c in p["prompts"])
+    report["elapsed_seconds"] = round(time.time() - started, 2)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="M-CAST 课前预热")
+    parser.add_argument("--variants", type=int, default=3, help="每个开场 prompt 缓存的回复变体数")
+    parser.add_argument("--plan", default=WARMUP_PLAN, help="预热计划文件（相对 backend 目录）")
+    parser.add_argument("--reset", action="store_true", help="先清空已有的回复缓存")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_warmup(args.variants, args.plan, args.reset))
+    for path in report["paths"]:
+        mark = "OK " if path["covered"] else "ERR"
+        print(f"[{mark}] {path['stage']:<10} {path['context']:<8} {path['user_input']}")
+    print(f"Covered {report['covered_paths']}/{report['total_paths']} paths, "
+          f"{report['llm_calls']} LLM calls, {report['elapsed_seconds']}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 与 main.py 相同，以 backend/src 为导入根目录
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
@@ -0,0 +1,72 @@
+import pytest
+
+from graphs import context_index
+from graphs.context_index import CONTEXT_RECENT, CONTEXT_TOP_K, TurnIndex, bind_session, relevant_context, split_turns
+
+FILLER = ["今天天气不错", "我们去公园玩", "晚饭吃面条", "周末看电影", "小猫在睡觉", "明天要早起", "书包有点重"]
+
+
+def conversation(count, relevant=()):
+    """count 条消息；relevant 中的下标换成关于身高与票价的消息"""
+    turns = []
+    for i in range(count):
+        role = "user" if i % 2 == 0 else "assistant"
+        text = f"身高不到 120 厘米的票价是半价 {i}" if i in relevant else f"{FILLER[i % len(FILLER)]} {i}"
+        turns.append(f"{role}: {text}")
+    return "\n".join(turns)
+
+
+@pytest.fixture(autouse=True)
+def fresh_index(monkeypatch):
+    monkeypatch.setattr(context_index, "context_index", context_index.ContextIndex())
+    monkeypatch.setattr(context_index, "CONTEXT_RETRIEVAL_ENABLED", True)
+    bind_session("s1")
+
+
+def test_split_turns_keeps_multiline_messages():
+    assert split_turns("user: a\nb\nassistant: c\n") == ["user: a\nb", "assistant: c\n"]
+
+
+def test_short_or_disabled_context_is_unchanged(monkeypatch):
+    short = conversation(CONTEXT_TOP_K + CONTEXT_RECENT)
+    assert relevant_context(short, "票价") == short
+    long = conversation(30, relevant={3})
+    monkeypatch.setattr(context_index, "CONTEXT_RETRIEVAL_ENABLED", False)
+    assert relevant_context(long, "票价") == long
+
+
+def test_selects_relevant_and_recent_turns_in_order():
+    count = 30
+    result = relevant_context(conversation(count, relevant={3, 10}), "身高 票价").splitlines()
+    assert "user: 身高不到 120 厘米的票价是半价 10" in result
+    assert "assistant: 身高不到 120 厘米的票价是半价 3" in result
+    # 最近的 CONTEXT_RECENT 条总是保留在末尾
+    assert result[-CONTEXT_RECENT:] == conversation(count).splitlines()[-CONTEXT_RECENT:]
+    assert result[0] == "（省略 3 条与当前问题关系不大的消息）"
+    assert result.index("assistant: 身高不到 120 厘米的票价是半价 3") < result.index("user: 身高不到 120 厘米的票价是半价 10")
+    assert len([line for line in result if not line.startswith("（省略")]) <= CONTEXT_TOP_K + CONTEXT_RECENT
+
+
+def test_unrelated_query_keeps_only_recent_turns():
+    result = relevant_context(conversation(30), "xyz").splitlines()
+    assert result == ["（省略 26 条与当前问题关系不大的消息）"] + conversation(30).splitlines()[-CONTEXT_RECENT:]
+
+
+@pytest.mark.parametrize("history, added, expected_len", [
+    # 续写：只追加新消息
+    (["user: a", "assistant: b"], ["user: a", "assistant: b", "user: c"], 1),
+    # 已索引的最后一条被改写：重建索引
+    (["user: a", "assistant: b"], ["user: a", "assistant: x", "user: c"], 3),
+])
+def test_sync_appends_or_rebuilds(history, added, expected_len):
+    index = TurnIndex()
+    index.sync(history)
+    assert index.sync(added) == expected_len
+    assert index.turns == added
+
+
+def test_evicted_turns_keep_positions():
+    index = TurnIndex(max_turns=3)
+    index.sync(["user: 票价 0", "assistant: a", "user: b", "assistant: 票价 3", "user: c"])
+    assert (index.offset, index.turns) == (2, ["user: b", "assistant: 票价 3", "user: c"])
+    assert index.select("票价", top_k=1, recent=1) == [1, 2]
@@ -0,0 +1,111 @@
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+import exec_trace
+from exec_trace import compact_trace
+
+SCRIPT = exec_trace.__file__
+
+
+def run_traced(tmp_path, code, **env):
+    """像 run_code 一样在子进程中跟踪代码，返回 (stdout, 轨迹)"""
+    code_path = tmp_path / "student.py"
+    trace_path = tmp_path / "trace.json"
+    code_path.write_text(code, encoding="utf-8")
+    result = subprocess.run(
+        [sys.executable, SCRIPT, str(code_path), str(trace_path)],
+        capture_output=True, text=True, timeout=30,
+        env={**os.environ, **{name: str(value) for name, value in env.items()}},
+    )
+    return result.stdout, json.loads(trace_path.read_text(encoding="utf-8"))
+
+
+@pytest.mark.parametrize("code, events", [
+    (
+        "x = 1\nif x > 0:\n    y = 2\nelse:\n    y = 3\n",
+        [(1, 1, None, {"x": "1"}), (2, 1, True, None), (3, 1, None, {"y": "2"})],
+    ),
+    # 条件不成立且后面没有语句：离开本帧时判定分支
+    (
+        "x = 0\nif x > 0:\n    x = 1\n",
+        [(1, 1, None, {"x": "0"}), (2, 1, False, None)],
+    ),
+    (
+        "i = 0\nwhile i < 2:\n    i += 1\n",
+        [
+            (1, 1, None, {"i": "0"}),
+            (2, 1, True, None), (3, 1, None, {"i": "1"}),
+            (2, 2, True, None), (3, 2, None, {"i": "2"}),
+            (2, 3, False, None),
+        ],
+    ),
+    # 函数参数不算作变化；函数与模块名不记录
+    (
+        "import math\ndef f(a):\n    return a * 2\nprint(f(3))\n",
+        [(1, 1, None, None), (2, 1, None, None), (4, 1, None, None), (3, 1, None, None)],
+    ),
+])
+def test_lines_branches_and_variables(tmp_path, code, events):
+    _, trace = run_traced(tmp_path, code)
+    assert [(e["line"], e["hit"], e.get("branch"), e.get("vars")) for e in trace["events"]] == events
+    assert (trace["dropped"], trace["truncated"]) == (0, False)
+
+
+def test_long_loops_are_sampled(tmp_path):
+    _, trace = run_traced(
+        tmp_path, "for i in range(12):\n    pass\n",
+        EXEC_TRACE_LINE_HITS=2, EXEC_TRACE_SAMPLE_EVERY=5,
+    )
+    assert [e["hit"] for e in trace["events"] if e["line"] == 2] == [1, 2, 5, 10]
+    assert trace["steps"] == 25
+    assert trace["dropped"] == trace["steps"] - len(trace["events"])
+
+
+def test_tracing_stops_after_max_steps_but_program_finishes(tmp_path):
+    stdout, trace = run_traced(
+        tmp_path, "n = 0\nfor i in range(100):\n    n += i\nprint(n)\n",
+        EXEC_TRACE_MAX_STEPS=10,
+    )
+    assert stdout == "4950\n"
+    assert trace["truncated"] is True
+    assert trace["steps"] == 11
+
+
+def test_ring_buffer_keeps_latest_events(tmp_path):
+    _, trace = run_traced(tmp_path, "a = 1\nb = 2\nc = 3\nd = 4\n", EXEC_TRACE_MAX_EVENTS=2)
+    assert [e["line"] for e in trace["events"]] == [3, 4]
+    assert trace["dropped"] == 2
+
+
+CODE = "x = 5\nif x > 3:\n    print(x)\n"
+
+
+@pytest.mark.parametrize("trace, expected", [
+    (None, ""),
+    ({"events": []}, ""),
+    (
+        {"events": [
+            {"line": 1, "hit": 1, "vars": {"x": "5"}},
+            {"line": 2, "hit": 1, "branch": True},
+            {"line": 3, "hit": 1},
+        ], "steps": 3, "dropped": 0, "truncated": False},
+        "L1 x = 5 | x=5\nL2 if x > 3: → 成立\nL3 print(x)",
+    ),
+    (
+        {"events": [{"line": 2, "hit": 50, "branch": False}, {"line": 9, "hit": 1}], "steps": 400, "dropped": 398, "truncated": True},
+        "L2(第50次) if x > 3: → 不成立\nL9 \n（共执行 400 步，循环中的重复步骤已采样）\n（步数过多，之后未再跟踪）",
+    ),
+])
+def test_compact_trace(trace, expected):
+    assert compact_trace(trace, CODE) == expected
+
+
+def test_compact_trace_keeps_head_and_tail(monkeypatch):
+    monkeypatch.setattr(exec_trace, "EXEC_TRACE_PROMPT_EVENTS", 4)
+    events = [{"line": 1, "hit": hit} for hit in range(1, 11)]
+    lines = compact_trace({"events": events, "steps": 10}, CODE).splitlines()
+    assert lines == ["L1 x = 5", "L1(第2次) x = 5", "…（省略 6 步）", "L1(第9次) x = 5", "L1(第10次) x = 5"]
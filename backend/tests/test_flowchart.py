@@ -0,0 +1,88 @@
+import re
+import hashlib
+
+import pytest
+
+from graphs.flowchart import MAX_LABEL_CHARS, FlowchartCache, code_to_mermaid
+
+LESSON_CODE = """height = int(input())
+if height < 120:
+    print("半价 5 元")
+else:
+    print("全价 10 元")
+"""
+
+
+def edges(chart):
+    """流程图中的边：(起点文字, 边上文字, 终点文字)"""
+    labels = dict(re.findall(r"^\s+(N\d+)\W+\"(.*?)\"", chart, re.M))
+    return {
+        (labels[source], label or "", labels[target])
+        for source, label, target in re.findall(r"^\s+(N\d+)(?: -- (\w+) -->| -->) (N\d+)$", chart, re.M)
+    }
+
+
+def test_lesson_program():
+    assert code_to_mermaid(LESSON_CODE) == "\n".join([
+        "graph TD",
+        '    N1(["开始"])',
+        '    N2[/"输入 height"/]',
+        "    N1 --> N2",
+        '    N3{"height < 120?"}',
+        "    N2 --> N3",
+        "    N4[/\"输出 '半价 5 元'\"/]",
+        "    N3 -- Yes --> N4",
+        "    N5[/\"输出 '全价 10 元'\"/]",
+        "    N3 -- No --> N5",
+        '    N6(["结束"])',
+        "    N4 --> N6",
+        "    N5 --> N6",
+    ])
+
+
+@pytest.mark.parametrize("code", [None, "", "   \n", "if height < 120\n    print(1)", "# 只有注释"])
+def test_no_chart_for_empty_or_invalid_code(code):
+    assert code_to_mermaid(code) is None
+
+
+def test_if_without_else_falls_through():
+    chart = code_to_mermaid("if x > 1:\n    print(x)\nprint('end')")
+    assert edges(chart) == {
+        ("开始", "", "x > 1?"),
+        ("x > 1?", "Yes", "输出 x"),
+        ("x > 1?", "No", "输出 'end'"),
+        ("输出 x", "", "输出 'end'"),
+        ("输出 'end'", "", "结束"),
+    }
+
+
+def test_loop_with_break_and_continue():
+    code = "while n > 0:\n    if n == 3:\n        break\n    if n == 5:\n        continue\n    n -= 1\nprint(n)"
+    assert edges(code_to_mermaid(code)) == {
+        ("开始", "", "n > 0?"),
+        ("n > 0?", "Yes", "n == 3?"),
+        ("n == 3?", "Yes", "输出 n"),
+        ("n == 3?", "No", "n == 5?"),
+        ("n == 5?", "Yes", "n > 0?"),
+        ("n == 5?", "No", "n -= 1"),
+        ("n -= 1", "", "n > 0?"),
+        ("n > 0?", "No", "输出 n"),
+        ("输出 n", "", "结束"),
+    }
+
+
+def test_labels_are_quoted_and_truncated():
+    chart = code_to_mermaid('print("say \\"hi\\"")\nx = "' + "a" * 100 + '"')
+    assert "#quot;" in chart and '\\"' not in chart
+    long_label = re.search(r'N3\["(.*)"\]', chart).group(1)
+    assert len(long_label) == MAX_LABEL_CHARS and long_label.endswith("…")
+
+
+def test_cache_evicts_least_recently_used():
+    cache = FlowchartCache(max_entries=2)
+    cache.get("a = 1")
+    cache.get("b = 2")
+    cache.get("a = 1")
+    cache.get("c = 3")
+    kept = {hashlib.sha256(code.encode("utf-8")).hexdigest() for code in ("a = 1", "c = 3")}
+    assert set(cache._entries) == kept
@@ -0,0 +1,105 @@
+import os
+import sys
+import asyncio
+import subprocess
+
+import pytest
+
+import idempotency
+from idempotency import IdempotencyConflict, MemoryStore, SqliteStore
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+# 在独立进程中运行 run_once，模拟落在不同 worker 上的两次重试
+WORKER = """
+import asyncio, os, sys
+import idempotency
+
+async def compute():
+    with open(sys.argv[1], "a") as fd:
+        fd.write("ran\\n")
+    await asyncio.sleep(0.5)
+    return {"pid": os.getpid()}
+
+print(asyncio.run(idempotency.run_once("execute", "retry-1", "hash", compute))["pid"])
+"""
+
+
+@pytest.fixture
+def memory_store(monkeypatch):
+    store = MemoryStore()
+    monkeypatch.setattr(idempotency, "store", store)
+    return store
+
+
+def test_sqlite_claim_is_shared_between_connections(tmp_path):
+    path = str(tmp_path / "idempotency.sqlite3")
+    first, second = SqliteStore(path), SqliteStore(path)
+    assert first.claim("k", "h") is None
+    assert second.claim("k", "h") == ("h", None)
+    first.put("k", "h", {"output": "1"})
+    assert second.claim("k", "h") == ("h", {"output": "1"})
+
+
+def test_sqlite_release_frees_only_placeholders(tmp_path):
+    store = SqliteStore(str(tmp_path / "idempotency.sqlite3"))
+    assert store.claim("a", "h") is None
+    store.release("a")
+    assert store.claim("a", "h") is None
+    store.put("b", "h", [1])
+    store.release("b")
+    assert store.get("b") == ("h", [1])
+
+
+def test_run_once_coalesces_concurrent_duplicates(memory_store):
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"n": len(calls)}
+
+    async def main():
+        return await asyncio.gather(*(idempotency.run_once("chat", "k", "h", compute) for _ in range(3)))
+
+    assert asyncio.run(main()) == [{"n": 1}] * 3
+    assert len(calls) == 1
+    # 之后的重试直接返回保存的结果
+    assert asyncio.run(idempotency.run_once("chat", "k", "h", compute)) == {"n": 1}
+    assert len(calls) == 1
+
+
+def test_run_once_retries_after_failure(memory_store):
+    attempts = []
+
+    async def compute():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("boom")
+        return {"ok": True}
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(idempotency.run_once("execute", "k", "h", compute))
+    assert asyncio.run(idempotency.run_once("execute", "k", "h", compute)) == {"ok": True}
+
+
+def test_run_once_rejects_reused_key(memory_store):
+    async def compute():
+        return {}
+
+    asyncio.run(idempotency.run_once("execute", "k", "h1", compute))
+    with pytest.raises(IdempotencyConflict):
+        asyncio.run(idempotency.run_once("execute", "k", "h2", compute))
+
+
+def test_run_once_executes_once_across_processes(tmp_path):
+    ran = tmp_path / "ran.txt"
+    env = dict(os.environ, IDEMPOTENCY_STORE="sqlite", IDEMPOTENCY_DB_PATH=str(tmp_path / "idempotency.sqlite3"))
+    procs = [
+        subprocess.Popen([sys.executable, "-c", WORKER, str(ran)], cwd=SRC_DIR, env=env, stdout=subprocess.PIPE, text=True)
+        for _ in range(2)
+    ]
+    outputs = [proc.communicate(timeout=30)[0].strip() for proc in procs]
+    assert all(proc.returncode == 0 for proc in procs)
+    assert ran.read_text().count("ran") == 1
+    assert outputs[0] == outputs[1]
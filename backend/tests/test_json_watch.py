@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+from graphs.json_watch import JsonFieldWatcher
+
+REPLY = '{"response": "小于 120 半价 {注意}", "sub_stage": "coding", "scores": {"a": 1}, "count": 3, "extra": "很长的辅助字段"}'
+
+
+def feed_all(watcher, text, size):
+    """按 size 个字符一段喂给 watcher，返回截断后的完整文本；没有截断时返回 None"""
+    for start in range(0, len(text), size):
+        part = text[start:start + size]
+        cut = watcher.feed(part)
+        if cut is not None:
+            return text[:start + cut] + ("}" if watcher.needs_close else "")
+    return None
+
+
+@pytest.mark.parametrize("size", [1, 3, 7, len(REPLY)])
+@pytest.mark.parametrize("required, kept", [
+    (["response"], ["response"]),
+    (["response", "sub_stage"], ["response", "sub_stage"]),
+    (["scores"], ["response", "sub_stage", "scores"]),
+    (["count"], ["response", "sub_stage", "scores", "count"]),
+])
+def test_stops_after_required_fields(required, kept, size):
+    text = feed_all(JsonFieldWatcher(required), REPLY, size)
+    data = json.loads(text)
+    assert list(data) == kept
+    assert data == {key: json.loads(REPLY)[key] for key in kept}
+
+
+@pytest.mark.parametrize("size", [1, 5])
+def test_object_close_without_required_fields(size):
+    text = '```json\n{"response": "hi", "nested": {"x": "}"}}\n```'
+    watcher = JsonFieldWatcher([])
+    result = feed_all(watcher, text, size)
+    assert result == '```json\n{"response": "hi", "nested": {"x": "}"}}'
+    assert not watcher.needs_close
+
+
+def test_escaped_quotes_and_braces_in_strings():
+    text = '{"response": "他说 \\"}\\" 不对", "sub_stage": "x"}'
+    result = feed_all(JsonFieldWatcher(["response"]), text, 2)
+    assert json.loads(result) == {"response": '他说 "}" 不对'}
+
+
+def test_missing_required_field_waits_for_close():
+    watcher = JsonFieldWatcher(["flowchart_code"])
+    result = feed_all(watcher, '{"response": "a", "sub_stage": "b"}', 4)
+    assert json.loads(result) == {"response": "a", "sub_stage": "b"}
+    assert not watcher.needs_close
+
+
+def test_feed_after_done_returns_zero():
+    watcher = JsonFieldWatcher(["response"])
+    assert watcher.feed('{"response": "a",') is not None
+    assert watcher.feed('"more": 1}') == 0
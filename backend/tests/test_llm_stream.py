@@ -0,0 +1,125 @@
+import json
+import threading
+
+import pytest
+from langchain_core.messages import AIMessageChunk, HumanMessage
+
+from graphs import llm_stream
+from graphs.llm_stream import GenerationCancelled, SingleFlight
+
+
+class FakeLLM:
+    """每次 stream 依次返回 parts 中的文本"""
+
+    model_name = "fake"
+    temperature = 0.0
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.calls = 0
+
+    def stream(self, messages):
+        self.calls += 1
+        for part in self.parts:
+            yield AIMessageChunk(content=part)
+
+
+@pytest.fixture(autouse=True)
+def no_response_cache(monkeypatch):
+    monkeypatch.setattr(llm_stream, "RESPONSE_CACHE_ENABLED", False)
+    monkeypatch.setattr(llm_stream, "COALESCE_ENABLED", True)
+
+
+def test_unfollow_clears_followers():
+    flights = SingleFlight()
+    flight, leader = flights.join("k")
+    follower_flight, follower = flights.join("k")
+    assert leader and not follower and follower_flight is flight
+    assert flight.has_followers
+    flights.unfollow(flight)
+    assert not flight.has_followers
+
+
+def test_follower_shares_leader_output():
+    llm = FakeLLM(["a", "b", "c"])
+    messages = [HumanMessage(content="hi")]
+    leader = llm_stream.stream_llm(llm, messages, "agent_t")
+    first = next(leader)
+    follower = llm_stream.stream_llm(llm, messages, "agent_t")
+    received = [next(follower).content]
+    rest = [chunk.content for chunk in leader]
+    received += [chunk.content for chunk in follower]
+    assert first.content + "".join(rest) == "abc"
+    assert received == ["a", "b", "c"]
+    assert llm.calls == 1
+
+
+def test_leader_honours_cancel_after_follower_leaves():
+    llm = FakeLLM(["a", "b", "c"])
+    messages = [HumanMessage(content="bye")]
+    cancel = threading.Event()
+    token = llm_stream._cancel_event.set(cancel)
+    try:
+        leader = llm_stream.stream_llm(llm, messages, "agent_t")
+        next(leader)
+        follower = llm_stream.stream_llm(llm, messages, "agent_t")
+        next(follower)
+        # 跟随者被新消息取代
+        follower.close()
+        cancel.set()
+        with pytest.raises(GenerationCancelled):
+            next(leader)
+    finally:
+        llm_stream._cancel_event.reset(token)
+
+
+def test_early_stop_truncates_and_skips_output_stats(monkeypatch):
+    recorded = []
+    monkeypatch.setattr(llm_stream, "EARLY_STOP_ENABLED", True)
+    monkeypatch.setattr(llm_stream.output_stats, "record", lambda *args: recorded.append(args))
+    llm = FakeLLM(['{"response": "好', '的", "sub_stage": "coding", ', '"extra": "不需要"}'])
+    messages = [HumanMessage(content="early")]
+    response = llm_stream.invoke_llm(llm, messages, "agent_t", ["response", "sub_stage"], "coding")
+    assert json.loads(response.content) == {"response": "好的", "sub_stage": "coding"}
+    # 提前结束的输出比完整输出短，不计入输出长度统计
+    assert recorded == []
+
+
+def test_natural_completion_records_output_stats(monkeypatch):
+    recorded = []
+    monkeypatch.setattr(llm_stream, "EARLY_STOP_ENABLED", True)
+    monkeypatch.setattr(llm_stream.output_stats, "record", lambda *args: recorded.append(args))
+    llm = FakeLLM(['{"response": "好的"', "}"])
+    llm_stream.invoke_llm(llm, [HumanMessage(content="natural")], "agent_t", ["flowchart_code"], "coding")
+    assert [(agent, sub_stage) for agent, sub_stage, *_ in recorded] == [("agent_t", "coding")]
+
+
+def test_follower_with_different_max_tokens_starts_its_own_generation():
+    params = {"model": "fake", "temperature": 0.0, "top_p": None, "max_tokens": 4000}
+    llm = FakeLLM(["a", "b"])
+    smaller = FakeLLM(["x", "y"])
+    # 同一配置，但 max_tokens 按输出统计收紧过
+    llm.metadata = smaller.metadata = {llm_stream.CONFIG_PARAMS_METADATA: params}
+    llm.max_tokens, smaller.max_tokens = 4000, 600
+    messages = [HumanMessage(content="limits")]
+    leader = llm_stream.stream_llm(llm, messages, "agent_t")
+    next(leader)
+    other = [chunk.content for chunk in llm_stream.stream_llm(smaller, messages, "agent_t")]
+    list(leader)
+    assert other == ["x", "y"]
+    assert (llm.calls, smaller.calls) == (1, 1)
+
+
+def test_budget_limited_calls_do_not_share_keys(monkeypatch):
+    from graphs import node
+    from token_ledger import Limits
+    messages = [HumanMessage(content="budget")]
+    config = {"model": "normal", "max_completion_tokens": 4000}
+    monkeypatch.setenv("OPENAI_API_KEY", "x")
+    monkeypatch.delenv("LLM_MODEL", raising=False)
+    monkeypatch.setattr(node, "_llm_cache", {})
+    normal = node._get_llm(config)
+    monkeypatch.setattr(node.token_ledger, "current_limits", lambda: Limits("hard", "cheap", 600))
+    limited = node._get_llm(config)
+    assert (limited.model_name, limited.max_tokens) == ("cheap", 600)
+    assert llm_stream.prompt_key(normal, messages, "agent_t") != llm_stream.prompt_key(limited, messages, "agent_t")
@@ -0,0 +1,71 @@
+import datetime
+import uuid
+from types import SimpleNamespace
+
+from log_export import DEFAULT_STAGE, Sessionizer
+
+U1 = uuid.UUID(int=1)
+U2 = uuid.UUID(int=2)
+
+
+def row(role, content, student_id="s1", user_id=U1, row_id=1):
+    return SimpleNamespace(
+        id=row_id, user_id=user_id, student_id=student_id, role=role,
+        content=content, content_hash=None, content_encoding=None, content_data=None,
+        group_type="experimental", created_at=datetime.datetime(2026, 10, 1), meta=None,
+    )
+
+
+def annotate(rows, prior=None):
+    sessionizer = Sessionizer(prior)
+    return [(r["session_key"], r["stage"], r["turn_index"], r["role"]) for r in map(sessionizer.annotate, rows)]
+
+
+def test_turns_and_stages_within_a_session():
+    rows = [
+        row("user", "你好"),
+        row("agent", "欢迎"),
+        row("user", "请开始算法设计阶段的教学内容"),
+        row("agent", "我们来画流程图"),
+        row("user", "if height < 120:"),
+    ]
+    assert annotate(rows) == [
+        ("s1", DEFAULT_STAGE, 1, "user"),
+        ("s1", DEFAULT_STAGE, 1, "agent"),
+        ("s1", "logic", 2, "user"),
+        ("s1", "logic", 2, "agent"),
+        ("s1", "logic", 3, "user"),
+    ]
+
+
+def test_new_session_resets_counters():
+    rows = [
+        row("user", "请开始迁移应用阶段的教学内容"),
+        row("user", "你好", student_id="s2"),
+        # 没有学号的会话按 user_id 区分
+        row("user", "你好", student_id=None, user_id=U2),
+    ]
+    assert annotate(rows) == [
+        ("s1", "transfer", 1, "user"),
+        ("s2", DEFAULT_STAGE, 1, "user"),
+        (str(U2), DEFAULT_STAGE, 1, "user"),
+    ]
+
+
+def test_unknown_stage_name_is_kept():
+    assert annotate([row("user", "请开始复习阶段的教学内容")])[0][1] == "复习"
+
+
+def test_incremental_export_continues_from_prior():
+    rows = [row("agent", "接着上次"), row("user", "继续")]
+    assert annotate(rows, prior={"s1": (4, "assessment")}) == [
+        ("s1", "assessment", 4, "agent"),
+        ("s1", "assessment", 5, "user"),
+    ]
+
+
+def test_annotated_row_fields():
+    annotated = Sessionizer().annotate(row("user", "你好", row_id=7))
+    assert annotated["user_id"] == str(U1)
+    assert annotated["content"] == "你好"
+    assert annotated["id"] == 7
@@ -0,0 +1,73 @@
+import datetime
+
+import pytest
+from sqlalchemy import create_engine
+
+from database import Base, ChatLog, ChatLogContent
+from logs import build_logs_query, decode_cursor, encode_cursor, page_from_rows
+
+T0 = datetime.datetime(2026, 10, 1, 8, 0, 0, 123456)
+
+
+@pytest.fixture
+def conn():
+    """内存 SQLite 上的 chatlog：同一时刻写入的多行用 id 区分先后"""
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine, tables=[ChatLog.__table__, ChatLogContent.__table__])
+    times = [T0, T0, T0 + datetime.timedelta(seconds=1), T0 + datetime.timedelta(seconds=1), T0 + datetime.timedelta(seconds=2)]
+    with engine.begin() as connection:
+        connection.execute(ChatLog.__table__.insert(), [
+            {"id": i, "student_id": "s1" if i != 4 else "s2", "role": "user", "content": f"m{i}", "group_type": "experimental", "created_at": created_at}
+            for i, created_at in enumerate(times, start=1)
+        ])
+    with engine.connect() as connection:
+        yield connection
+
+
+def pages(conn, limit, **filters):
+    """沿 next_cursor 翻完所有页，返回每页的 id"""
+    result, cursor = [], None
+    while True:
+        page = page_from_rows(list(conn.execute(build_logs_query(limit=limit, cursor=cursor, **filters))), limit)
+        result.append([item["id"] for item in page["items"]])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return result
+
+
+@pytest.mark.parametrize("created_at, log_id", [
+    (T0, 7),
+    (datetime.datetime(2026, 1, 1), 0),
+    (datetime.datetime(2026, 10, 1, 8, 0, tzinfo=datetime.timezone.utc), 2 ** 40),
+])
+def test_cursor_round_trip(created_at, log_id):
+    cursor = encode_cursor(created_at, log_id)
+    assert decode_cursor(cursor) == (created_at, log_id)
+    # 游标放在查询参数中，不需要再转义
+    assert "+" not in cursor and "/" not in cursor
+
+
+@pytest.mark.parametrize("cursor", ["", "not-base64!", "WzFd", encode_cursor(T0, 1)[:-4]])
+def test_invalid_cursor(cursor):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        decode_cursor(cursor)
+
+
+@pytest.mark.parametrize("limit, filters, expected", [
+    (2, {}, [[1, 2], [3, 4], [5]]),
+    # 恰好整页时多取的一行判断出没有下一页
+    (5, {}, [[1, 2, 3, 4, 5]]),
+    (3, {"descending": True}, [[5, 4, 3], [2, 1]]),
+    # 同一 created_at 的行跨页也不重复、不遗漏
+    (1, {}, [[1], [2], [3], [4], [5]]),
+    (2, {"student_id": "s1"}, [[1, 2], [3, 5]]),
+    (2, {"since": T0 + datetime.timedelta(seconds=1)}, [[3, 4], [5]]),
+])
+def test_keyset_pages(conn, limit, filters, expected):
+    assert pages(conn, limit, **filters) == expected
+
+
+def test_page_items_carry_content(conn):
+    page = page_from_rows(list(conn.execute(build_logs_query(limit=1))), 1)
+    assert page["items"][0]["content"] == "m1"
+    assert decode_cursor(page["next_cursor"]) == (T0, 1)
@@ -0,0 +1,48 @@
+import pytest
+
+from graphs.misconception import NONE, canned_response, classify, match_rules
+
+# (学生输入, 期望的规则标签)；本课规则：小于 120cm 半价 5 元，其余全价 10 元
+RULE_CASES = [
+    # 普通回答与正确的写法不算误区
+    ("else", None),
+    ("Else", None),
+    ("身高大于等于120就买全票", None),
+    ("小于120半价", None),
+    ("if height >= 120:\n    print('全价 10 元')\nelse:\n    print('半价 5 元')", None),
+    ("if height < 120:\n    print('半价 5 元')\nelse:\n    print('全价 10 元')", None),
+    # 条件与结果对应反了
+    ("大于120半价", "reversed_condition"),
+    ("身高超过 120cm 买儿童票", "reversed_condition"),
+    ("小于120就是全价", "reversed_condition"),
+    # 把正好 120cm 划进了半价一边
+    ("小于等于120半价", "comparison_operator"),
+    ("if height <= 120:\n    print('半价 5 元')", "comparison_operator"),
+    # 问边界值
+    ("正好120算哪种票", "boundary_120"),
+    ("身高等于120cm呢", "boundary_120"),
+    # 语法
+    ("if height < 120", "missing_colon"),
+    ("if height < 120\n    print('半价')", "missing_colon"),
+    ("SyntaxError: expected ':'", "missing_colon"),
+    ("IndentationError: expected an indented block", "indentation"),
+    ("if height < 120:\nprint('半价')", "indentation"),
+]
+
+
+@pytest.mark.parametrize("text,label", RULE_CASES)
+def test_rules(text, label):
+    assert match_rules(text) == label
+
+
+@pytest.mark.parametrize("text,canned", [
+    # 单独一行可能只是在回答问题：只作为提示
+    ("if height < 120", False),
+    # 贴出的是代码或报错：直接给出审核过的回复
+    ("if height < 120\n    print('半价')", True),
+    ("SyntaxError: expected ':'", True),
+])
+def test_canned_only_for_code(text, canned):
+    result = classify(text)
+    assert result is not None and result.label != NONE
+    assert bool(canned_response(result, "agent_b", "knowledge")) is canned
@@ -0,0 +1,81 @@
+import json
+import asyncio
+
+from langchain_core.messages import HumanMessage
+
+import replay
+from replay import CassetteLLM, Tape, build_turns, compare
+
+
+def record(role, content, turn_index=1, meta=None):
+    return {
+        "session_key": "s1", "turn_index": turn_index, "group_type": "experimental",
+        "stage": "scenario", "role": role, "content": content, "meta": meta,
+    }
+
+
+def test_build_turns_pairs_messages_and_builds_context():
+    turns = build_turns([
+        record("agent", "孤立的回复"),
+        record("user", "你好", meta={"stage": "coding", "agent_c_sub_stage": "coding"}),
+        record("agent", "欢迎", meta={"state": {"stage": "coding"}, "llm_calls": [{"agent": "agent_c", "text": "{}"}]}),
+        record("user", "再见", turn_index=2),
+        record("cancelled", None, turn_index=2),
+    ])
+    assert len(turns) == 2
+    first, second = turns
+    assert (first.stage, first.fields, first.context) == ("coding", {"agent_c_sub_stage": "coding"}, "")
+    assert (first.response, first.logged_state, len(first.calls)) == ("欢迎", {"stage": "coding"}, 1)
+    assert second.context == "user: 你好\nassistant: 欢迎"
+    assert second.cancelled and second.response is None
+
+
+def test_tape_falls_back_to_logged_reply_once():
+    turn = build_turns([record("user", "hi"), record("agent", "旧日志回复")])[0]
+    tape = Tape(turn)
+    assert json.loads(tape.next_call()["text"]) == {"response": "旧日志回复"}
+    assert tape.next_call() is None
+
+
+def test_cassette_replays_recorded_calls_in_order():
+    turn = build_turns([
+        record("user", "hi"),
+        record("agent", "x", meta={"llm_calls": [{"text": "第一次调用"}, {"text": "第二次", "output_tokens": 9}]}),
+    ])[0]
+    tape = Tape(turn)
+    llm = CassetteLLM(speed=0)
+
+    async def main():
+        token = replay._tape.set(tape)
+        try:
+            first = await llm.ainvoke([HumanMessage(content="a")])
+            second = await llm.ainvoke([HumanMessage(content="b")])
+            extra = await llm.ainvoke([HumanMessage(content="c")])
+        finally:
+            replay._tape.reset(token)
+        return first, second, extra
+
+    first, second, extra = asyncio.run(main())
+    assert (first.content, second.content, extra.content) == ("第一次调用", "第二次", "")
+    assert [served["extra"] for served in tape.served] == [False, False, True]
+    assert tape.served[1]["output_tokens"] == 9
+
+
+def report(p50, tokens_in=100, overhead=5.0):
+    return {
+        "wall_ms": {"p50": p50, "p95": p50 * 2},
+        "nodes": {"agent_c": {"overhead_ms": {"p50": overhead}, "latency_ms": {"p95": 50.0}}},
+        "tokens": {"input": tokens_in, "output": 50},
+        "turns_per_second": 1000 / p50,
+    }
+
+
+def test_compare_flags_only_regressions_beyond_threshold():
+    assert compare(report(100), report(100), 0.1) == []
+    # 变慢 5%：低于阈值
+    assert compare(report(105), report(100), 0.1) == []
+    regressions = compare(report(150, tokens_in=130), report(100), 0.1)
+    assert any(item.startswith("wall_ms.p50") for item in regressions)
+    assert any(item.startswith("tokens.input") for item in regressions)
+    # 耗时差小于 min_delta_ms 视为噪声
+    assert compare(report(100, overhead=1.5), report(100, overhead=1.0), 0.1) == []
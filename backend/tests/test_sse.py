@@ -0,0 +1,96 @@
+import zlib
+import asyncio
+
+import pytest
+
+from sse import DONE_FRAME, coalesce_tokens, encode_event, encode_stream
+
+
+def token(content):
+    return {"type": "token", "content": content}
+
+
+async def produce(items):
+    """items 中的数字表示暂停的秒数，异常会被抛出，其余是事件"""
+    for item in items:
+        if isinstance(item, (int, float)):
+            await asyncio.sleep(item)
+        elif isinstance(item, Exception):
+            raise item
+        else:
+            yield item
+
+
+def coalesced(items, window_ms=1000, max_bytes=512):
+    async def main():
+        return [event async for event in coalesce_tokens(produce(items), window_ms, max_bytes)]
+
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize("items, window_ms, max_bytes, expected", [
+    # 窗口为 0：逐 token 透传
+    ([token("a"), token("b")], 0, 512, [token("a"), token("b")]),
+    # 窗口内连续到达的 token 合为一帧
+    ([token("a"), token("b"), token("c")], 1000, 512, [token("abc")]),
+    # 其他事件先冲刷缓冲，保持顺序
+    (
+        [token("a"), token("b"), {"type": "final", "x": 1}, token("c")],
+        1000, 512,
+        [token("ab"), {"type": "final", "x": 1}, token("c")],
+    ),
+    # 缓冲达到字节上限就立即发出（中文按 UTF-8 字节计）
+    ([token("你好"), token("世界"), token("!")], 1000, 6, [token("你好"), token("世界"), token("!")]),
+    ([token("ab"), token("cd"), token("e")], 1000, 4, [token("abcd"), token("e")]),
+    # 上游暂停超过窗口时按时间冲刷
+    ([token("a"), 0.2, token("b")], 20, 512, [token("a"), token("b")]),
+])
+def test_coalesce_tokens(items, window_ms, max_bytes, expected):
+    assert coalesced(items, window_ms, max_bytes) == expected
+
+
+def test_window_flushes_while_upstream_is_paused():
+    async def main():
+        received = []
+        upstream_resumed = asyncio.Event()
+
+        async def events():
+            yield token("a")
+            await asyncio.sleep(0.3)
+            upstream_resumed.set()
+            yield token("b")
+
+        async for event in coalesce_tokens(events(), window_ms=20):
+            received.append((event["content"], upstream_resumed.is_set()))
+        return received
+
+    # 第一帧在上游恢复之前就已发出
+    assert asyncio.run(main()) == [("a", False), ("b", True)]
+
+
+def test_upstream_error_flushes_buffer_first():
+    received = []
+
+    async def main():
+        async for event in coalesce_tokens(produce([token("a"), token("b"), RuntimeError("boom")]), 1000):
+            received.append(event)
+
+    with pytest.raises(RuntimeError, match="boom"):
+        asyncio.run(main())
+    assert received == [token("ab")]
+
+
+def test_encode_event_keeps_utf8_and_id():
+    assert encode_event({"content": "你好"}) == 'data: {"content":"你好"}\n\n'
+    assert encode_event({"type": "done"}, "s:3") == 'id: s:3\ndata: {"type":"done"}\n\n'
+
+
+def test_gzip_stream_decodes_frame_by_frame():
+    async def main():
+        return [chunk async for chunk in encode_stream(produce([token("a"), {"type": "final"}]), "gzip", window_ms=0)]
+
+    chunks = asyncio.run(main())
+    decoder = zlib.decompressobj(31)
+    # 每帧压缩后立即 flush，单独解压即可得到完整的帧
+    frames = [decoder.decompress(chunk).decode("utf-8") for chunk in chunks]
+    assert frames == [encode_event(token("a")), encode_event({"type": "final"}), DONE_FRAME]
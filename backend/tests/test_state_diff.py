@@ -0,0 +1,60 @@
+from state_diff import StateDiffer
+
+STATE = {"active_agent_response": "你好", "stage": "coding", "suggestions": [], "agent_c_sub_stage": "coding", "code": "x = 1"}
+
+
+def test_anonymous_session_gets_full_state():
+    differ = StateDiffer(10)
+    assert differ.diff(None, STATE, 1) == STATE
+
+
+def test_first_turn_is_full_then_only_changes():
+    differ = StateDiffer(10)
+    first = differ.diff("s1", STATE, 0)
+    assert first["state_version"] == 1
+    assert {k: v for k, v in first.items() if k in STATE} == STATE
+
+    second = differ.diff("s1", {**STATE, "code": "x = 2"}, first["state_version"])
+    assert second == {
+        "active_agent_response": "你好",
+        "stage": "coding",
+        "suggestions": [],
+        "code": "x = 2",
+        "diff": True,
+        "state_version": 2,
+    }
+
+
+def test_version_mismatch_resyncs():
+    differ = StateDiffer(10)
+    differ.diff("s1", STATE, 0)
+    payload = differ.diff("s1", STATE, 7)
+    assert payload["resync"] is True
+    assert "diff" not in payload
+    assert payload["code"] == "x = 1"
+
+
+def test_client_without_versions_always_gets_full_state():
+    differ = StateDiffer(10)
+    differ.diff("s1", STATE, None)
+    payload = differ.diff("s1", STATE, None)
+    assert "diff" not in payload and "resync" not in payload
+    assert payload["code"] == "x = 1"
+
+
+def test_evicted_session_resyncs():
+    differ = StateDiffer(1)
+    version = differ.diff("s1", STATE, 0)["state_version"]
+    differ.diff("s2", STATE, 0)
+    payload = differ.diff("s1", STATE, version)
+    assert payload["resync"] is True
+    assert payload["state_version"] == 1
+
+
+def test_disabled_diff_sends_full_state_without_version(monkeypatch):
+    import state_diff
+    monkeypatch.setattr(state_diff, "STATE_DIFF", False)
+    differ = StateDiffer(10)
+    differ.diff("s1", STATE, 0)
+    payload = differ.diff("s1", {**STATE, "code": "x = 2"}, 1)
+    assert payload == {**STATE, "code": "x = 2"}
@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+
+import stream_buffer
+from stream_buffer import RESYNC_EVENT, StreamBuffer, find_stream, open_stream, parse_last_event_id
+from turns import Turn
+
+
+def token(text):
+    return {"type": "token", "content": text}
+
+
+def filled(count, max_events=4):
+    buffer = StreamBuffer(Turn(None), "client:1", max_events=max_events)
+    for i in range(count):
+        buffer.append(token(str(i)))
+    return buffer
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, None),
+    ("", None),
+    ("abc:12", ("abc", 12)),
+    ("abc", ("abc", 0)),
+    (" abc:3 ", ("abc", 3)),
+    ("abc:x", None),
+])
+def test_parse_last_event_id(value, expected):
+    assert parse_last_event_id(value) == expected
+
+
+def test_read_within_window_resumes_after_seq():
+    buffer = filled(3)
+    assert buffer.read(1) == [(2, token("1")), (3, token("2"))]
+    assert buffer.read(3) == []
+
+
+def test_ring_is_bounded():
+    buffer = filled(100)
+    assert len(buffer.events) == 4
+    assert buffer.truncated
+
+
+def test_read_before_window_starts_with_resync():
+    buffer = filled(6)
+    entries = buffer.read(1)
+    assert entries[0] == (2, RESYNC_EVENT)
+    assert [seq for seq, _ in entries[1:]] == [3, 4, 5, 6]
+
+
+def test_condensed_joins_tokens_until_truncated():
+    buffer = filled(3)
+    buffer.append({"type": "final", "stage": "coding"})
+    assert buffer.condensed() == [token("012"), {"type": "final", "stage": "coding"}]
+    buffer = filled(6)
+    buffer.append({"type": "final"})
+    assert buffer.condensed() == [RESYNC_EVENT, {"type": "final"}]
+
+
+def test_subscribe_skips_tokens_after_resync():
+    async def main():
+        buffer = filled(6)
+        buffer.append({"type": "final"})
+        buffer.finish()
+        return [event async for _, event in buffer.subscribe(after=0)]
+
+    assert asyncio.run(main()) == [RESYNC_EVENT, {"type": "final"}]
+
+
+def test_find_stream_checks_owner():
+    async def events():
+        yield token("hi")
+
+    async def main():
+        buffer = open_stream(Turn(None), events(), "idempotency:k1")
+        await buffer.task
+        return buffer
+
+    buffer = asyncio.run(main())
+    try:
+        assert find_stream(buffer.stream_id, "idempotency:k1") is buffer
+        assert find_stream(buffer.stream_id, "idempotency:k2") is None
+        assert find_stream(buffer.stream_id, "client:") is None
+    finally:
+        stream_buffer._streams.pop(buffer.stream_id, None)
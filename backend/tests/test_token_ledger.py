@@ -0,0 +1,108 @@
+import sys
+import types
+import asyncio
+
+import pytest
+
+import token_ledger
+from token_ledger import TokenLedger, Usage
+
+
+@pytest.fixture
+def ledger(monkeypatch):
+    ledger = TokenLedger()
+    monkeypatch.setattr(token_ledger, "ledger", ledger)
+    return ledger
+
+
+def bind_in_loop(*args):
+    """在事件循环中绑定学生，等后台加载结束后返回本轮的限制"""
+    async def main():
+        token_ledger.bind_owner(*args)
+        limits = token_ledger.current_limits()
+        await asyncio.gather(*token_ledger.ledger._load_tasks)
+        return limits
+
+    return asyncio.run(main())
+
+
+def test_no_budget_skips_load_and_limits(ledger, monkeypatch):
+    monkeypatch.setattr(token_ledger, "BUDGETS_ENABLED", False)
+    loads = []
+    monkeypatch.setattr(ledger, "load", lambda wanted: loads.append(wanted))
+    ledger.record(("s1", "experimental", "L"), Usage(10 ** 9, 0, 0, 1))
+    assert bind_in_loop("s1", "experimental", "L") is None
+    assert loads == []
+
+
+def test_budget_applies_and_loads_in_background(ledger, monkeypatch):
+    monkeypatch.setattr(token_ledger, "BUDGETS_ENABLED", True)
+    monkeypatch.setattr(token_ledger, "TOKEN_BUDGET_SOFT", 100)
+    loads = []
+
+    async def load(wanted):
+        loads.append(wanted)
+        ledger._loading.difference_update(wanted)
+        ledger._loaded.update(wanted)
+
+    monkeypatch.setattr(ledger, "load", load)
+    ledger.record(("s1", "experimental", "L"), Usage(150, 0, 0, 1))
+    limits = bind_in_loop("s1", "experimental", "L")
+    assert limits is not None and limits.tier == "soft"
+    assert loads == [[("s1", "experimental", "L"), ("experimental", "L")]]
+    # 已加载的学生不再查询数据库
+    bind_in_loop("s1", "experimental", "L")
+    assert len(loads) == 1
+
+
+def test_failed_load_backs_off(ledger, monkeypatch, capsys):
+    monkeypatch.setattr(token_ledger, "BUDGETS_ENABLED", True)
+    attempts = []
+
+    async def unreachable():
+        attempts.append(1)
+        raise ConnectionRefusedError("database unreachable")
+
+    monkeypatch.setitem(sys.modules, "database", types.SimpleNamespace(ensure_db=unreachable))
+    bind_in_loop("s1", "experimental", "L")
+    bind_in_loop("s2", "experimental", "L")
+    assert len(attempts) == 1
+    assert capsys.readouterr().out.count("Token ledger load failed") == 1
+
+
+def test_sync_counts_usage_written_by_other_workers(ledger, monkeypatch):
+    import database
+    monkeypatch.setattr(token_ledger, "BUDGETS_ENABLED", True)
+    monkeypatch.setattr(token_ledger, "TOKEN_BUDGET_CLASS_SOFT", 1000)
+    # 数据库中已有两个 worker 写入的用量：s1 的 300 + 另一个 worker 上 s2 的 800
+    rows = [("s1", "experimental", "L", 300, 0, 0, 1), ("s2", "experimental", "L", 800, 0, 0, 2)]
+
+    class Session:
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            return False
+
+        async def execute(self, query):
+            return types.SimpleNamespace(all=lambda: rows)
+
+    async def flush():
+        ledger._take_pending()
+        return 0
+
+    monkeypatch.setattr(database, "AsyncSessionLocal", Session)
+    monkeypatch.setattr(ledger, "flush", flush)
+    key = ("s1", "experimental", "L")
+    ledger._loaded.update([key, key[1:]])
+    ledger.record(key, Usage(100, 0, 0, 1))
+    assert ledger.tier(key) is None
+
+    async def main():
+        ledger._last_flush = 0
+        ledger.maybe_flush()
+        await ledger._flush_task
+
+    asyncio.run(main())
+    assert ledger.usage(key).prompt_tokens == 300
+    assert ledger.tier(key) == "soft"
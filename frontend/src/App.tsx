@@ -84,6 +84,16 @@ interface Message {
   content: string;
 }
 
+// 对话流断线后凭 Last-Event-ID 续传的最大重试次数
+const MAX_STREAM_RETRIES = 3;
+
+// 每次发送生成一个幂等键，重试时服务端不会重复运行同一轮对话
+// crypto.randomUUID 只在安全上下文（HTTPS / localhost）可用
+const newIdempotencyKey = () =>
+  typeof crypto !== 'undefined' && typeof crypto.randomUUID === 'function'
+    ? crypto.randomUUID()
+    : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+
 const STAGES = [
   { id: 'scenario', name: '情境体验', icon: Layout },
   { id: 'knowledge', name: '新知学习', icon: Lightbulb },
@@ -154,6 +164,11 @@ function App() {
   const [poePrediction, setPoePrediction] = useState('');
   const [poeQuestion, setPoeQuestion] = useState('');
   const abortControllerRef = useRef<AbortController | null>(null);
+  // 服务端按版本号下发增量状态，这里保存上一轮合并后的完整状态
+  const stateVersionRef = useRef<number | null>(null);
+  const lastFinalRef = useRef<Record<string, any>>({});
+  // POE 观察步骤运行代码时得到的执行轨迹，随下一轮对话发送给 Agent C
+  const executionTraceRef = useRef<Record<string, any> | null>(null);
 
   const messagesEndRef = useRef<HTMLDivElement>(null);
 
@@ -233,34 +248,34 @@ function App() {
 
     try {
       const apiBaseUrl = import.meta.env.VITE_API_BASE_URL || '/api';
-      
-      const response = await fetch(`${apiBaseUrl}/chat_stream`, {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        signal: abortController.signal,
-        body: JSON.stringify({
-          stage: stageOverride || stage,
-          user_input: userMessage,
-          group: isControlGroup ? "control" : "experimental",
-          student_id: studentId,
-          context: messages.map(m => `${m.role}: ${m.content}`).join('\n'),
-          current_task: '公园购票',
-          agent_a_sub_stage: agentASubStage,
-          agent_a_turn_count: agentATurnCount,
-          agent_c_sub_stage: agentCSubStage,
-          agent_c_poe_state: agentCPoeState,
-          agent_c_current_code: code,
-          agent_d_reflection_sub_stage: agentDReflectionSubStage,
-          agent_e_sub_stage: agentESubStage,
-          agent_e_quiz_index: agentEQuizIndex
-        })
+      const requestBody = JSON.stringify({
+        stage: stageOverride || stage,
+        user_input: userMessage,
+        group: isControlGroup ? "control" : "experimental",
+        student_id: studentId,
+        context: messages.map(m => `${m.role}: ${m.content}`).join('\n'),
+        current_task: '公园购票',
+        agent_a_sub_stage: agentASubStage,
+        agent_a_turn_count: agentATurnCount,
+        agent_c_sub_stage: agentCSubStage,
+        agent_c_poe_state: agentCPoeState,
+        agent_c_current_code: code,
+        agent_c_execution_trace: executionTraceRef.current,
+        agent_d_reflection_sub_stage: agentDReflectionSubStage,
+        agent_e_sub_stage: agentESubStage,
+        agent_e_quiz_index: agentEQuizIndex,
+        state_version: stateVersionRef.current
       });
+      executionTraceRef.current = null;
 
-      if (!response.body) throw new Error('ReadableStream not supported');
-      const reader = response.body.getReader();
-      const decoder = new TextDecoder();
       let accumulatedResponse = '';
       let isFinalReceived = false;
+      // 断线太久、缺失的 token 已不在服务端缓冲中：保留已显示的部分，等 final 中的完整回复
+      let isResynced = false;
+      // 服务端为本轮缓存事件流：断线后带上最后收到的事件 id 重新请求即可续传，不会重新生成
+      let streamId: string | null = null;
+      let lastEventId: string | null = null;
+      const idempotencyKey = newIdempotencyKey();
 
       // 辅助函数：过滤思考过程和 JSON 结构
       const filterThinking = (text: string) => {
@@ -284,89 +299,137 @@ function App() {
         return filtered.trim();
       };
 
-      while (true) {
-        const { value, done } = await reader.read();
-        if (done) break;
+      for (let attempt = 0; ; attempt++) {
+        try {
+          const headers: Record<string, string> = { 'Content-Type': 'application/json', 'Idempotency-Key': idempotencyKey };
+          if (streamId) headers['Last-Event-ID'] = lastEventId || `${streamId}:0`;
+          const response = await fetch(`${apiBaseUrl}/chat_stream`, {
+            method: 'POST',
+            headers,
+            signal: abortController.signal,
+            body: requestBody
+          });
+          streamId = response.headers.get('X-Stream-Id') || streamId;
 
-        const chunk = decoder.decode(value);
-        const lines = chunk.split('\n');
-        
-        for (const line of lines) {
-          if (line.startsWith('data: ')) {
-            const dataStr = line.slice(6);
-            if (dataStr === '[DONE]') break;
+          if (!response.body) throw new Error('ReadableStream not supported');
+          const reader = response.body.getReader();
+          const decoder = new TextDecoder();
+          // 服务端会合并 token 成较大的帧，一帧可能跨越多次 read，未完整的行留到下一次处理
+          let pending = '';
+          // 帧的 id 行在 data 行之前，data 处理完才算收到该事件
+          let frameId: string | null = null;
+          let streamDone = false;
+
+          while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+
+            pending += decoder.decode(value, { stream: true });
+            const lines = pending.split('\n');
+            pending = lines.pop() || '';
             
-            try {
-              const data = JSON.parse(dataStr);
-              if (data.type === 'token' && !isFinalReceived) {
-                accumulatedResponse += data.content;
-                // 更新最后一条消息（AI 消息）的内容
-                setMessages(prev => {
-                  const newMessages = [...prev];
-                  const lastMessage = newMessages[newMessages.length - 1];
-                  if (lastMessage && lastMessage.role === 'assistant') {
-                    lastMessage.content = filterThinking(accumulatedResponse);
-                  }
-                  return newMessages;
-                });
-              } else if (data.type === 'final') {
-                isFinalReceived = true;
-                // 最终结构化数据到达，以 final 中的内容为准
-                const finalContent = data.active_agent_response || accumulatedResponse;
-                setMessages(prev => {
-                  const newMessages = [...prev];
-                  const lastMessage = newMessages[newMessages.length - 1];
-                  if (lastMessage && lastMessage.role === 'assistant') {
-                    lastMessage.content = filterThinking(finalContent);
-                  }
-                  return newMessages;
-                });
+            for (const line of lines) {
+              if (line.startsWith('id: ')) {
+                frameId = line.slice(4);
+              } else if (line.startsWith('data: ')) {
+                const dataStr = line.slice(6);
+                if (dataStr === '[DONE]') {
+                  streamDone = true;
+                  break;
+                }
                 
-                if (data.stage) setStage(data.stage);
-                if (data.agent_a_sub_stage) setAgentASubStage(data.agent_a_sub_stage);
-                if (data.agent_a_turn_count !== undefined) setAgentATurnCount(data.agent_a_turn_count);
-                if (data.agent_c_sub_stage) setAgentCSubStage(data.agent_c_sub_stage);
-                if (data.agent_c_poe_state) {
-                  setAgentCPoeState(data.agent_c_poe_state);
-                  // 如果进入 predict 状态且有提问，准备显示弹窗
-                  if (data.agent_c_poe_state === 'predict' && data.active_agent_response) {
-                    setPoeQuestion(data.active_agent_response);
+                try {
+                  const parsed = JSON.parse(dataStr);
+                  // 增量 final 只包含变化的字段，与上一轮的完整状态合并
+                  const data = parsed.type === 'final' && parsed.diff
+                    ? { ...lastFinalRef.current, ...parsed }
+                    : parsed;
+                  if (data.type === 'resync') {
+                    isResynced = true;
+                  } else if (data.type === 'token' && !isFinalReceived && !isResynced) {
+                    accumulatedResponse += data.content;
+                    // 更新最后一条消息（AI 消息）的内容
+                    setMessages(prev => {
+                      const newMessages = [...prev];
+                      const lastMessage = newMessages[newMessages.length - 1];
+                      if (lastMessage && lastMessage.role === 'assistant') {
+                        lastMessage.content = filterThinking(accumulatedResponse);
+                      }
+                      return newMessages;
+                    });
+                  } else if (data.type === 'final') {
+                    isFinalReceived = true;
+                    lastFinalRef.current = data;
+                    stateVersionRef.current = data.state_version ?? null;
+                    // 最终结构化数据到达，以 final 中的内容为准
+                    const finalContent = data.active_agent_response || accumulatedResponse;
+                    setMessages(prev => {
+                      const newMessages = [...prev];
+                      const lastMessage = newMessages[newMessages.length - 1];
+                      if (lastMessage && lastMessage.role === 'assistant') {
+                        lastMessage.content = filterThinking(finalContent);
+                      }
+                      return newMessages;
+                    });
+                    
+                    if (data.stage) setStage(data.stage);
+                    if (data.agent_a_sub_stage) setAgentASubStage(data.agent_a_sub_stage);
+                    if (data.agent_a_turn_count !== undefined) setAgentATurnCount(data.agent_a_turn_count);
+                    if (data.agent_c_sub_stage) setAgentCSubStage(data.agent_c_sub_stage);
+                    if (data.agent_c_poe_state) {
+                      setAgentCPoeState(data.agent_c_poe_state);
+                      // 如果进入 predict 状态且有提问，准备显示弹窗
+                      if (data.agent_c_poe_state === 'predict' && data.active_agent_response) {
+                        setPoeQuestion(data.active_agent_response);
+                      }
+                    }
+                    if (data.agent_d_reflection_sub_stage) {
+                      setAgentDReflectionSubStage(data.agent_d_reflection_sub_stage);
+                    }
+                    if (data.agent_d_evaluation_scores) {
+                      setEvaluationScores(data.agent_d_evaluation_scores);
+                    }
+                    if (data.agent_e_sub_stage) {
+                      setAgentESubStage(data.agent_e_sub_stage);
+                    }
+                    if (data.agent_e_quiz_index !== undefined) {
+                      setAgentEQuizIndex(data.agent_e_quiz_index);
+                    }
+                    setVisualData(prev => ({
+                      ...prev,
+                      scenario: data.agent_a_scenario_text || prev.scenario,
+                      flowchart: data.agent_c_flowchart_code || data.agent_b_flowchart_code || prev.flowchart,
+                      conceptDiagram: data.agent_b_concept_diagram || prev.conceptDiagram,
+                      code: data.agent_c_code_template || prev.code,
+                      suggestions: data.suggestions || prev.suggestions,
+                      transferTasks: data.agent_e_transfer_tasks || prev.transferTasks
+                    }));
+                    if (data.agent_c_code_template) {
+                      setCode(data.agent_c_code_template);
+                    }
+                    if (data.agent_c_syntax_errors) {
+                      setSyntaxErrors(data.agent_c_syntax_errors);
+                    }
+                  } else if (data.type === 'error') {
+                    console.error('Stream Error:', data.content);
                   }
+                } catch (e) {
+                  // 忽略部分解析失败的 JSON
                 }
-                if (data.agent_d_reflection_sub_stage) {
-                  setAgentDReflectionSubStage(data.agent_d_reflection_sub_stage);
-                }
-                if (data.agent_d_evaluation_scores) {
-                  setEvaluationScores(data.agent_d_evaluation_scores);
-                }
-                if (data.agent_e_sub_stage) {
-                  setAgentESubStage(data.agent_e_sub_stage);
-                }
-                if (data.agent_e_quiz_index !== undefined) {
-                  setAgentEQuizIndex(data.agent_e_quiz_index);
+                if (frameId) {
+                  lastEventId = frameId;
+                  frameId = null;
                 }
-                setVisualData(prev => ({
-                  ...prev,
-                  scenario: data.agent_a_scenario_text || prev.scenario,
-                  flowchart: data.agent_c_flowchart_code || data.agent_b_flowchart_code || prev.flowchart,
-                  conceptDiagram: data.agent_b_concept_diagram || prev.conceptDiagram,
-                  code: data.agent_c_code_template || prev.code,
-                  suggestions: data.suggestions || prev.suggestions,
-                  transferTasks: data.agent_e_transfer_tasks || prev.transferTasks
-                }));
-                if (data.agent_c_code_template) {
-                  setCode(data.agent_c_code_template);
-                }
-                if (data.agent_c_syntax_errors) {
-                  setSyntaxErrors(data.agent_c_syntax_errors);
-                }
-              } else if (data.type === 'error') {
-                console.error('Stream Error:', data.content);
               }
-            } catch (e) {
-              // 忽略部分解析失败的 JSON
             }
           }
+          if (!streamDone && !isFinalReceived) throw new Error('Stream closed before [DONE]');
+          break;
+        } catch (error: any) {
+          // 用户主动停止或已收到 final 时不再重试；还没拿到流 id 时靠幂等键避免重复生成
+          if (error.name === 'AbortError' || isFinalReceived || attempt >= MAX_STREAM_RETRIES) throw error;
+          console.warn('Stream interrupted, resuming after', lastEventId, error);
+          await new Promise(resolve => setTimeout(resolve, 1000 * (attempt + 1)));
         }
       }
     } catch (error: any) {
@@ -483,7 +546,10 @@ function App() {
       }
 
       const apiBaseUrl = import.meta.env.VITE_API_BASE_URL || 'http://localhost:8000';
-      const response = await axios.post(`${apiBaseUrl}/execute`, { code, inputs });
+      // 逐行追踪会拖慢循环较多的程序，只在 POE 预测/观察步骤需要轨迹时才请求
+      const trace = agentCPoeState === 'predict' || agentCPoeState === 'observe';
+      const response = await axios.post(`${apiBaseUrl}/execute`, { code, inputs, trace });
+      executionTraceRef.current = response.data.trace || null;
       let realOutput = response.data.output || '';
       if (response.data.error) {
         // 提取报错的关键信息，避免冗长的 Traceback